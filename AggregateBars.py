@@ -0,0 +1,212 @@
+import struct
+import numpy as np
+
+# column name and dtype of every aggregate field, always stored little-endian
+COLUMNS = [
+    ("timestamp", np.dtype("<i8")),
+    ("open", np.dtype("<f8")),
+    ("high", np.dtype("<f8")),
+    ("low", np.dtype("<f8")),
+    ("close", np.dtype("<f8")),
+    ("volume", np.dtype("<f8")),
+    ("vwap", np.dtype("<f8")),
+    ("transactions", np.dtype("<i8"))
+    ]
+
+# bytes header - magic, format version, number of bars. 16 bytes so the columns stay 8 byte aligned
+_MAGIC = b"AGGB"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sIQ")
+
+# number of bars allocated at a time while reading list_aggs
+_BLOCK_SIZE = 4096
+
+
+class AggregateBars:
+    '''AggregateBars is a class that holds aggregates column by column, with one NumPy
+       array per field (timestamp int64, open/high/low/close/volume/vwap float64, transactions int64)
+       instead of one Python dict per bar. Missing prices are stored as NaN and missing
+       transaction counts as 0
+    '''
+
+    def __init__(self, columns):
+        '''Constructor
+           Inputs:
+              columns - dict of column name to 1-D array, every column in COLUMNS must be present
+                 and all columns must have the same length
+        '''
+        self.columns = {}
+        length = None
+        for name, dtype in COLUMNS:
+            # asarray does not copy when the array already has the right dtype
+            column = np.asarray(columns[name], dtype=dtype)
+            if length is None:
+                length = len(column)
+            elif len(column) != length:
+                raise ValueError("column {} has {} bars, expected {}".format(name, len(column), length))
+            self.columns[name] = column
+
+    def __len__(self):
+        return len(self.columns["timestamp"])
+
+    def __getattr__(self, name):
+        # give attribute access to the columns, such as bars.close
+        columns = self.__dict__.get("columns")
+        if columns is not None and name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, index):
+        '''Slices every column at once, basic slices return views and do not copy
+           Inputs:
+              index - slice, integer array or boolean mask
+           Returns:
+              AggregateBars holding the selected bars
+        '''
+        return AggregateBars({name: column[index] for name, column in self.columns.items()})
+
+    @classmethod
+    def empty(cls):
+        '''Returns:
+              AggregateBars without any bars
+        '''
+        return cls({name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS})
+
+    @classmethod
+    def from_aggs(cls, aggs):
+        '''Builds the columns straight from the Agg objects returned by RESTClient.list_aggs,
+           filling preallocated blocks so no per-bar dict or list is created
+           Inputs:
+              aggs - iterable of polygon.io Agg objects
+           Returns:
+              AggregateBars holding the bars
+        '''
+        blocks = []
+        block = None
+        position = _BLOCK_SIZE
+
+        for agg in aggs:
+            if position == _BLOCK_SIZE:
+                block = {name: np.empty(_BLOCK_SIZE, dtype=dtype) for name, dtype in COLUMNS}
+                blocks.append(block)
+                position = 0
+            block["timestamp"][position] = agg.timestamp
+            block["open"][position] = _float(agg.open)
+            block["high"][position] = _float(agg.high)
+            block["low"][position] = _float(agg.low)
+            block["close"][position] = _float(agg.close)
+            block["volume"][position] = _float(agg.volume)
+            block["vwap"][position] = _float(agg.vwap)
+            block["transactions"][position] = agg.transactions or 0
+            position += 1
+
+        if not blocks:
+            return cls.empty()
+
+        # trim the unused end of the last block
+        blocks[-1] = {name: column[:position] for name, column in blocks[-1].items()}
+        if len(blocks) == 1:
+            return cls(blocks[0])
+        return cls({name: np.concatenate([b[name] for b in blocks]) for name, dtype in COLUMNS})
+
+    @classmethod
+    def from_records(cls, records):
+        '''Builds the columns from the bar dicts stored in RedisJSON (see PolygonIoAPIWrapper.aggregates)
+           Inputs:
+              records - list of dicts with date, open, high, low, close, volume, vwap and transactions keys
+           Returns:
+              AggregateBars holding the bars
+        '''
+        columns = {}
+        for name, dtype in COLUMNS:
+            field = "date" if name == "timestamp" else name
+            if dtype.kind == "f":
+                values = (_float(record.get(field)) for record in records)
+            else:
+                values = (record.get(field) or 0 for record in records)
+            columns[name] = np.fromiter(values, dtype=dtype, count=len(records))
+        return cls(columns)
+
+    def to_records(self):
+        '''Converts back to the bar dicts stored in RedisJSON, with the same keys in the same order.
+           Missing prices (NaN) become None, since RedisJSON does not accept NaN
+           Returns:
+              list of dicts, one per bar
+        '''
+        fields = ["date" if name == "timestamp" else name for name, dtype in COLUMNS]
+        lists = [self.columns[name].tolist() for name, dtype in COLUMNS]
+        records = []
+        for values in zip(*lists):
+            records.append({field: None if value != value else value for field, value in zip(fields, values)})
+        return records
+
+    def to_numpy(self):
+        '''Returns:
+              dict of column name to NumPy array, the arrays are shared and not copied
+        '''
+        return dict(self.columns)
+
+    def to_pandas(self):
+        '''Converts to a pandas DataFrame indexed by the bar date. pandas is only imported here
+           Returns:
+              DataFrame with one column per field
+        '''
+        import pandas as pd
+
+        index = pd.DatetimeIndex(self.columns["timestamp"].astype("datetime64[ms]"), name="date")
+        data = {name: column for name, column in self.columns.items() if name != "timestamp"}
+        return pd.DataFrame(data, index=index, copy=False)
+
+    def to_bytes(self):
+        '''Serializes the bars as a small header followed by every column packed as
+           little-endian binary, about 64 bytes per bar
+           Returns:
+              bytes
+        '''
+        parts = [_HEADER.pack(_MAGIC, FORMAT_VERSION, len(self))]
+        for name, dtype in COLUMNS:
+            parts.append(np.ascontiguousarray(self.columns[name]).tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''Reads bars serialized with to_bytes. The columns are read-only views over data,
+           nothing is copied or parsed
+           Inputs:
+              data - bytes, bytearray or memoryview holding the serialized bars
+           Returns:
+              AggregateBars holding the bars
+        '''
+        magic, version, count = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError("not serialized AggregateBars")
+        if version != FORMAT_VERSION:
+            raise ValueError("unsupported AggregateBars version {}".format(version))
+
+        columns = {}
+        offset = _HEADER.size
+        for name, dtype in COLUMNS:
+            columns[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += count * dtype.itemsize
+        return cls(columns)
+
+    @classmethod
+    def concatenate(cls, parts):
+        '''Joins several AggregateBars in order
+           Inputs:
+              parts - list of AggregateBars
+           Returns:
+              AggregateBars holding every bar, the part itself if there is only one
+        '''
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls.empty()
+        if len(parts) == 1:
+            return parts[0]
+        return cls({name: np.concatenate([part.columns[name] for part in parts]) for name, dtype in COLUMNS})
+
+
+def _float(value):
+    '''Converts a possibly missing number to float, None becomes NaN
+    '''
+    return np.nan if value is None else value
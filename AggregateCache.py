@@ -0,0 +1,358 @@
+import collections
+import sys
+import threading
+import time
+import redis
+from AggregateBars import AggregateBars
+from MarketMovers import columns_from_records
+from RedisJSONStore import RedisJSONStore, aggregate_key, decode_json_document, version_key, VERSION_KEY_PREFIX
+
+# invalidation modes
+INVALIDATE_VERSION = "version"  # compare the version counter of the key, at most every check_interval seconds
+INVALIDATE_NOTIFY = "notify"    # drop entries when Redis keyspace notifications report a write
+
+# keyspace notification flags needed - K keyspace events, A every event class (including module events such as JSON.SET)
+_NOTIFY_FLAGS = "KA"
+
+
+class _Entry:
+    '''Parsed value of one key and kind, its approximate size in bytes, the Redis version it was read at
+       and when it was loaded and last checked
+    '''
+
+    def __init__(self, value, version, loaded):
+        self.value = value
+        self.nbytes = _nbytes(value)
+        self.version = version
+        self.loaded = loaded
+        self.checked = loaded
+
+
+class AggregateCache:
+    '''AggregateCache is a class that keeps parsed aggregates and snapshot documents in memory in
+       front of Redis. Values are stored ready to use (AggregateBars with read-only columns, snapshot
+       columns), so a repeated read costs no parsing and, while the entry is known to be current,
+       no network round trip. Entries are known to be current either because Redis keyspace
+       notifications reported no write to the key, or because its version counter did not change
+       at the last check. An LRU bounded by number of keys and by bytes, and an optional TTL limit what is kept
+    '''
+
+    def __init__(self, redis_store=None, max_entries=512, max_bytes=256 * 1024 * 1024, ttl=None, mode=INVALIDATE_VERSION,
+                 check_interval=1.0, clock=time.monotonic):
+        '''Constructor
+           Inputs:
+              redis_store - RedisJSONStore used to read the documents, a new one is created if None
+              max_entries - maximum number of keys kept, the least recently used are dropped first
+              max_bytes - approximate memory the cached values may use, the least recently used are dropped
+                 first. Bars count the bytes of their columns, documents and snapshots an estimate
+              ttl - seconds an entry is used before it is read again whatever its version, None for no limit
+              mode - INVALIDATE_VERSION or INVALIDATE_NOTIFY. Notify mode falls back to version
+                 checks when the server does not allow enabling keyspace notifications, or while
+                 the subscription is down
+              check_interval - seconds an entry is served in version mode before its version is checked again,
+                 0 to check on every read
+              clock - function returning the current time in seconds, can be replaced in tests
+        '''
+        if mode not in (INVALIDATE_VERSION, INVALIDATE_NOTIFY):
+            raise ValueError("unknown invalidation mode {}".format(mode))
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+
+        if redis_store is None:
+            redis_store = RedisJSONStore()
+
+        self.redis_store = redis_store
+        self.redis_connection = redis_store.redis_connection
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.mode = mode
+        self.check_interval = check_interval
+        self.clock = clock
+
+        self._entries = collections.OrderedDict()
+        # sum of the nbytes of the cached entries
+        self._bytes = 0
+        # bumped on every invalidation of a key, so a load that raced with a write is not cached
+        self._generations = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+        self._pubsub = None
+        self._listening = False
+        if mode == INVALIDATE_NOTIFY:
+            self._listen()
+
+    def bars(self, ticker, timespan="day"):
+        '''Reads the stored aggregates of a ticker
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - timespan the bars were stored with
+           Returns:
+              AggregateBars with read-only columns, empty if the key does not exist
+        '''
+        return self.bars_with_version(ticker, timespan)[0]
+
+    def bars_with_version(self, ticker, timespan="day"):
+        '''Reads the stored aggregates of a ticker with the version they were read at
+           Returns:
+              tuple (AggregateBars, version)
+        '''
+        entry = self._read([aggregate_key(ticker, timespan)], "bars")[0]
+        return entry.value, entry.version
+
+    def bars_many(self, tickers, timespan="day"):
+        '''Reads the stored aggregates of many tickers, loading every miss in one round trip
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              timespan - timespan the bars were stored with
+           Returns:
+              dict of ticker to AggregateBars with read-only columns
+        '''
+        entries = self._read([aggregate_key(ticker, timespan) for ticker in tickers], "bars")
+        return {ticker: entry.value for ticker, entry in zip(tickers, entries)}
+
+    def closes(self, tickers, timespan="day"):
+        '''Reads the timestamp and close columns of many tickers, for the correlation step
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              timespan - timespan the bars were stored with
+           Returns:
+              dict of ticker to (timestamp array, close array)
+        '''
+        return {ticker: (bars.timestamp, bars.close) for ticker, bars in self.bars_many(tickers, timespan).items()}
+
+    def snapshot_columns(self, key='stocks:snapshots'):
+        '''Reads a stored list of snapshots converted to columns (see MarketMovers.columns_from_records)
+           Inputs:
+              key - Redis key of the snapshot document, such as stocks:snapshots or stocks:gainers
+           Returns:
+              dict of column name to list of values, shared between callers and not to be modified
+        '''
+        return self._read([key], "snapshots")[0].value
+
+    def document(self, key):
+        '''Reads any stored JSON document
+           Inputs:
+              key - Redis key of the document
+           Returns:
+              the decoded document, shared between callers and not to be modified, None if it does not exist
+        '''
+        return self._read([key], "document")[0].value
+
+    def invalidate(self, key=None):
+        '''Drops a cached key, or every key
+           Inputs:
+              key - Redis key of the document, None for every key
+        '''
+        with self._lock:
+            if key is None:
+                for cached, kind in self._entries:
+                    self._generations[cached] += 1
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                self._drop(key)
+            self._stats["invalidations"] += 1
+
+    def stats(self):
+        '''Returns:
+              dict with the number of hits, misses, stale entries read again, invalidations, evictions,
+              version checks, the hit ratio, the number of cached keys and their approximate bytes and
+              whether notifications are used
+        '''
+        with self._lock:
+            stats = {name: self._stats[name] for name in ("hits", "misses", "stale", "invalidations", "evictions", "version_checks")}
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        reads = stats["hits"] + stats["misses"] + stats["stale"]
+        stats["hit_ratio"] = stats["hits"] / reads if reads else None
+        stats["notifications"] = self._listening
+        return stats
+
+    def close(self):
+        '''Stops listening for keyspace notifications
+        '''
+        self._listening = False
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+
+    def _read(self, keys, kind):
+        '''Returns the entries of keys parsed as kind (see _PARSERS), reading the missing and
+           outdated ones from Redis together
+        '''
+        now = self.clock()
+        entries = {}
+        to_check = []
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get((key, kind))
+                if entry is None or (self.ttl is not None and now - entry.loaded >= self.ttl):
+                    continue
+                if self._listening or now - entry.checked < self.check_interval:
+                    entries[key] = entry
+                    self._entries.move_to_end((key, kind))
+                    self._stats["hits"] += 1
+                else:
+                    to_check.append(key)
+
+        if to_check:
+            versions = self.redis_store.get_versions(to_check)
+            with self._lock:
+                self._stats["version_checks"] += len(to_check)
+                for key in to_check:
+                    entry = self._entries.get((key, kind))
+                    if entry is not None and entry.version == versions[key]:
+                        entry.checked = now
+                        entries[key] = entry
+                        self._entries.move_to_end((key, kind))
+                        self._stats["hits"] += 1
+
+        missing = [key for key in dict.fromkeys(keys) if key not in entries]
+        if missing:
+            entries.update(self._load(missing, kind, now))
+
+        return [entries[key] for key in keys]
+
+    def _load(self, keys, kind, now):
+        '''Reads and parses keys with one round trip, then caches them unless they were invalidated meanwhile
+        '''
+        parse = _PARSERS[kind]
+        with self._lock:
+            generations = {key: self._generations[key] for key in keys}
+            for key in keys:
+                self._stats["stale" if (key, kind) in self._entries else "misses"] += 1
+
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        pipeline.mget([version_key(key) for key in keys])
+        pipeline.json().mget(keys, '.')
+        for key in keys:
+            pipeline.exists(key + ':chunks')
+        versions, values, *chunked = pipeline.execute()
+        # backfilled bars are stored in chunks under the key, in front of any document written since
+        values = [self.redis_store.with_chunked(key, decode_json_document(value)) if has_chunks else value
+                  for key, value, has_chunks in zip(keys, values, chunked)]
+
+        loaded = {}
+        for key, version, value in zip(keys, versions, values):
+            loaded[key] = _Entry(parse(value), int(version or 0), now)
+
+        with self._lock:
+            for key, entry in loaded.items():
+                if self._generations[key] != generations[key]:
+                    continue
+                replaced = self._entries.pop((key, kind), None)
+                if replaced is not None:
+                    self._bytes -= replaced.nbytes
+                self._entries[(key, kind)] = entry
+                self._bytes += entry.nbytes
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                evicted = self._entries.popitem(last=False)[1]
+                self._bytes -= evicted.nbytes
+                self._stats["evictions"] += 1
+
+        return loaded
+
+    def _drop(self, key):
+        '''Drops every parsed form of a key, the lock must be held
+           Returns:
+              True if anything was cached for the key
+        '''
+        self._generations[key] += 1
+        dropped = False
+        for kind in _PARSERS:
+            entry = self._entries.pop((key, kind), None)
+            if entry is not None:
+                self._bytes -= entry.nbytes
+                dropped = True
+        return dropped
+
+    def _listen(self):
+        '''Enables keyspace notifications if needed and subscribes to writes of the stocks:* keys
+           and of their version counters. Falls back to version checks when that is not possible
+        '''
+        try:
+            flags = self.redis_connection.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+            missing = "".join(flag for flag in _NOTIFY_FLAGS if flag not in flags)
+            if missing:
+                self.redis_connection.config_set("notify-keyspace-events", flags + missing)
+        except redis.ResponseError:
+            # managed servers often refuse CONFIG, version checks still keep the cache correct
+            return
+
+        db = self.redis_connection.connection_pool.connection_kwargs.get("db", 0)
+        self._prefix = "__keyspace@{}__:".format(db)
+        self._pubsub = self.redis_connection.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.psubscribe(self._prefix + "stocks:*", self._prefix + VERSION_KEY_PREFIX + "*")
+        self._listening = True
+        threading.Thread(target=self._run_listener, daemon=True).start()
+
+    def _run_listener(self):
+        '''Drops the entry of every key written, until the subscription fails or close() is called
+        '''
+        try:
+            for message in self._pubsub.listen():
+                if not self._listening:
+                    return
+                channel = message.get("channel")
+                if not isinstance(channel, str) or not channel.startswith(self._prefix):
+                    continue
+                key = channel[len(self._prefix):]
+                if key.startswith(VERSION_KEY_PREFIX):
+                    key = key[len(VERSION_KEY_PREFIX):]
+                with self._lock:
+                    if self._drop(key):
+                        self._stats["invalidations"] += 1
+        except Exception:
+            pass
+        finally:
+            # writes may have been missed while the subscription was failing
+            if self._listening:
+                self._listening = False
+                self.invalidate()
+
+
+def _parse_bars(value):
+    '''Parses a stored aggregate document into bars whose columns can be shared safely
+    '''
+    bars = AggregateBars.from_records(decode_json_document(value) or [])
+    for column in bars.columns.values():
+        column.flags.writeable = False
+    return bars
+
+
+def _parse_snapshots(value):
+    '''Parses a stored snapshot document into columns
+    '''
+    return columns_from_records(decode_json_document(value) or [])
+
+
+def _nbytes(value):
+    '''Approximate memory used by a cached value - the column bytes of bars, and the size of
+       every container, string and number of a decoded document or snapshot columns
+    '''
+    if isinstance(value, AggregateBars):
+        return sum(column.nbytes for column in value.columns.values())
+    size = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return size
+
+
+# how a stored value is parsed, for each kind of cached entry
+_PARSERS = {
+    "bars": _parse_bars,
+    "snapshots": _parse_snapshots,
+    "document": decode_json_document
+    }
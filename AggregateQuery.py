@@ -0,0 +1,185 @@
+import collections
+import threading
+import numpy as np
+from AggregateBars import AggregateBars
+from LocalHistoryStore import to_millis
+from RedisJSONStore import RedisJSONStore, aggregate_key
+
+_MINUTE = 60 * 1000
+_HOUR = 60 * _MINUTE
+_DAY = 24 * _HOUR
+
+# fixed length timespans, in milliseconds
+FIXED_TIMESPANS = {
+    "1m": _MINUTE,
+    "minute": _MINUTE,
+    "5m": 5 * _MINUTE,
+    "15m": 15 * _MINUTE,
+    "30m": 30 * _MINUTE,
+    "1h": _HOUR,
+    "hour": _HOUR,
+    "day": _DAY
+    }
+
+
+def _combine(bars, starts, timestamps):
+    '''Combines groups of consecutive bars into one bar each. The open is the first open, the close
+       the last close, the high and low the extremes, volume and transactions are summed and
+       the vwap is the volume weighted average of the vwaps
+       Inputs:
+          bars - AggregateBars in date order
+          starts - sorted int array, index of the first bar of every group
+          timestamps - int64 array, timestamp of every group
+       Returns:
+          AggregateBars with one bar per group
+    '''
+    ends = np.append(starts[1:], len(bars)) - 1
+    volume = np.add.reduceat(np.nan_to_num(bars.volume), starts)
+    weighted = np.add.reduceat(np.nan_to_num(bars.vwap * bars.volume), starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vwap = np.where(volume > 0, weighted / volume, np.nan)
+
+    return AggregateBars({
+        "timestamp": timestamps,
+        "open": bars.open[starts],
+        # fmax / fmin skip missing (NaN) prices instead of propagating them
+        "high": np.fmax.reduceat(bars.high, starts),
+        "low": np.fmin.reduceat(bars.low, starts),
+        "close": bars.close[ends],
+        "volume": volume,
+        "vwap": vwap,
+        "transactions": np.add.reduceat(bars.transactions, starts)
+        })
+
+
+def resample(bars, timespan):
+    '''Resamples bars to a coarser timespan, with buckets aligned to the start of the period in UTC
+       Inputs:
+          bars - AggregateBars in date order
+          timespan - one of FIXED_TIMESPANS, week (starting Monday) or month
+       Returns:
+          AggregateBars with one bar per period that has data, stamped with the start of the period
+    '''
+    if len(bars) == 0:
+        return bars
+
+    timestamp = bars.timestamp
+    if timespan in FIXED_TIMESPANS:
+        interval = FIXED_TIMESPANS[timespan]
+        buckets = timestamp // interval
+        period_start = buckets * interval
+    elif timespan == "week":
+        # 1970-01-01 was a Thursday, shifting by 3 days makes the weeks start on Monday
+        buckets = (timestamp // _DAY + 3) // 7
+        period_start = (buckets * 7 - 3) * _DAY
+    elif timespan == "month":
+        buckets = timestamp.astype("datetime64[ms]").astype("datetime64[M]").astype(np.int64)
+        period_start = buckets.astype("datetime64[M]").astype("datetime64[ms]").astype(np.int64)
+    else:
+        raise ValueError("unsupported timespan {}".format(timespan))
+
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    return _combine(bars, starts, period_start[starts])
+
+
+def downsample(bars, points):
+    '''Reduces bars to at most a number of points by combining runs of consecutive bars,
+       keeping the OHLCV meaning of every point so the chart shape is preserved
+       Inputs:
+          bars - AggregateBars in date order
+          points - maximum number of bars returned
+       Returns:
+          AggregateBars, the bars themselves when there are already few enough
+    '''
+    if points < 1:
+        raise ValueError("points must be at least 1")
+    if len(bars) <= points:
+        return bars
+
+    starts = np.unique((np.arange(points) * len(bars)) // points)
+    return _combine(bars, starts, bars.timestamp[starts])
+
+
+class AggregateQuery:
+    '''AggregateQuery is a class that answers date range, resampling and downsampling queries
+       over the stored aggregates, so callers such as the chart server only receive the bars they
+       need. Results are kept in a bounded LRU cache keyed by the query and the version counter
+       of the Redis document, so a write to the document makes its cached results unreachable
+    '''
+
+    def __init__(self, redis_store=None, cache_size=256):
+        '''Constructor
+           Inputs:
+              redis_store - RedisJSONStore used to read the aggregates, a new one is created if None
+              cache_size - maximum number of query results kept in memory
+        '''
+        if redis_store is None:
+            redis_store = RedisJSONStore()
+
+        self.redis_store = redis_store
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def bars(self, ticker, timespan="day", from_=None, to=None, resample_to=None, points=None):
+        '''Reads stored bars
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - timespan the bars were stored with
+              from_ - first date to include (YYYY-MM-DD or timestamp in milliseconds), None for the first bar
+              to - last date to include (YYYY-MM-DD or timestamp in milliseconds), None for the last bar
+              resample_to - coarser timespan to resample to (see resample), None to keep the stored timespan
+              points - maximum number of bars returned (see downsample), None for all
+           Returns:
+              AggregateBars
+        '''
+        key = aggregate_key(ticker, timespan)
+        version = self.redis_store.get_versions([key])[key]
+
+        query = (key, version, from_, to, resample_to, points)
+        result = self._cached(query)
+        if result is not None:
+            return result
+
+        # the full document is cached too, so different ranges of the same ticker load it once
+        full = self._cached((key, version))
+        if full is None:
+            full = self.redis_store.get_bars(key)
+            self._store((key, version), full)
+
+        result = full
+        if from_ is not None or to is not None:
+            start = 0 if from_ is None else int(np.searchsorted(result.timestamp, to_millis(from_), side="left"))
+            stop = len(result) if to is None else int(np.searchsorted(result.timestamp, to_millis(to, end_of_day=True), side="right"))
+            result = result[start:stop]
+        if resample_to is not None and resample_to != timespan:
+            result = resample(result, resample_to)
+        if points is not None:
+            result = downsample(result, points)
+
+        self._store(query, result)
+        return result
+
+    def clear(self):
+        '''Drops every cached result
+        '''
+        with self._lock:
+            self._cache.clear()
+
+    def _cached(self, query):
+        '''Returns a cached result and marks it as recently used, None if it is not cached
+        '''
+        with self._lock:
+            result = self._cache.get(query)
+            if result is not None:
+                self._cache.move_to_end(query)
+            return result
+
+    def _store(self, query, result):
+        '''Caches a result, evicting the least recently used ones past cache_size
+        '''
+        with self._lock:
+            self._cache[query] = result
+            self._cache.move_to_end(query)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
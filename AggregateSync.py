@@ -0,0 +1,202 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from RedisJSONStore import RedisJSONStore, aggregate_key, decode_json_document, version_key
+from AggregateBars import AggregateBars
+
+# hash holding the timestamp of the last stored bar, one field per <ticker>:<timespan>
+# kept outside stocks:aggregate:* so it can not collide with a ticker's key or show up in aggregate scans
+WATERMARKS_KEY = 'stocks:watermarks'
+# where the hash lived before, moved once by migrate_watermarks
+OLD_WATERMARKS_KEY = 'stocks:aggregate:watermarks'
+
+
+def watermark_field(ticker, timespan):
+    '''Builds the field name of a ticker and timespan in the watermarks hash
+       Inputs:
+          ticker - string containing a stock's ticker symbol
+          timespan - string containing a timespan window (second, minute, hour, day, month)
+       Returns:
+          string such as lmt:day
+    '''
+    return ticker.lower() + ':' + timespan
+
+
+def migrate_watermarks(redis_connection):
+    '''Moves the watermarks of OLD_WATERMARKS_KEY into WATERMARKS_KEY. Fields already written to
+       the new hash are newer and win
+       Inputs:
+          redis_connection - Redis connection holding the hashes
+       Returns:
+          number of fields moved
+    '''
+    old = redis_connection.hgetall(OLD_WATERMARKS_KEY)
+    if not old:
+        return 0
+    pipeline = redis_connection.pipeline(transaction=True)
+    for field, watermark in old.items():
+        pipeline.hsetnx(WATERMARKS_KEY, field, watermark)
+    pipeline.delete(OLD_WATERMARKS_KEY)
+    return sum(pipeline.execute()[:-1])
+
+
+class AggregateSync:
+    '''AggregateSync is a class that keeps the stored aggregates up to date incrementally.
+       It remembers the timestamp of the last stored bar for each ticker and timespan, only asks
+       polygon.io for newer bars and appends them to the existing RedisJSON array
+    '''
+
+    def __init__(self, polygon_client, redis_store=None, history_store=None):
+        '''Constructor
+           Inputs:
+              polygon_client - PolygonIoAPIWrapper used to download the bars
+              redis_store - RedisJSONStore used to store the bars, a new one is created if None
+              history_store - optional LocalHistoryStore that receives a local copy of every synced bar
+        '''
+        if redis_store is None:
+            redis_store = RedisJSONStore()
+
+        self.polygon_client = polygon_client
+        self.redis_store = redis_store
+        self.redis_connection = redis_store.redis_connection
+        self.history_store = history_store
+        self._migrated = False
+
+    def get_watermark(self, ticker, timespan):
+        '''Returns the timestamp of the last stored bar
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+           Returns:
+              timestamp in milliseconds, or None if the ticker has never been synced
+        '''
+        if not self._migrated:
+            migrate_watermarks(self.redis_connection)
+            self._migrated = True
+        watermark = self.redis_connection.hget(WATERMARKS_KEY, watermark_field(ticker, timespan))
+        return int(watermark) if watermark is not None else None
+
+    def sync(self, ticker, timespan, from_, to):
+        '''Brings the stored aggregates of a ticker up to date. The first sync downloads and stores
+           the full from_ - to window, later syncs only download bars from the watermark onwards
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              from_ - start time of the window in YYYY-MM-DD, only used for the first sync
+              to - end time of the window in YYYY-MM-DD
+           Returns:
+              number of bars written to Redis
+        '''
+        key = aggregate_key(ticker, timespan)
+        watermark = self.get_watermark(ticker, timespan)
+
+        # older keys hold a double-encoded string that can not be appended to, rebuild them
+        if watermark is not None and self.redis_connection.json().type(key) != 'array':
+            watermark = None
+
+        if watermark is None:
+            bars = self.polygon_client.aggregates(ticker, timespan, from_, to)
+            pipeline = self.redis_connection.pipeline(transaction=True)
+            pipeline.json().set(key, '.', bars)
+            pipeline.incr(version_key(key))
+            self._set_watermark(pipeline, ticker, timespan, bars)
+            pipeline.execute()
+            self._write_history(ticker, timespan, bars, rebuild=True)
+            return len(bars)
+
+        # start at the watermark itself - the last stored bar may have been partial when it was stored
+        bars = self.polygon_client.aggregates(ticker, timespan, watermark, to)
+        bars = [bar for bar in bars if bar["date"] >= watermark]
+        if not bars:
+            return 0
+
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        if bars[0]["date"] == watermark:
+            pipeline.json().set(key, '$[-1]', bars[0])
+        new_bars = [bar for bar in bars if bar["date"] > watermark]
+        if new_bars:
+            pipeline.json().arrappend(key, '$', *new_bars)
+        pipeline.incr(version_key(key))
+        self._set_watermark(pipeline, ticker, timespan, bars)
+        pipeline.execute()
+        self._write_history(ticker, timespan, bars)
+
+        return len(bars)
+
+    def sync_many(self, tickers, timespan, from_, to, max_workers=8):
+        '''Syncs many tickers at once on a bounded thread pool
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              from_ - start time of the window in YYYY-MM-DD, only used for the first sync
+              to - end time of the window in YYYY-MM-DD
+              max_workers - maximum number of tickers synced at the same time
+           Returns:
+              tuple of two dicts keyed by ticker - (number of bars written, exception raised for that ticker)
+        '''
+        results = {}
+        errors = {}
+
+        if not tickers:
+            return results, errors
+
+        workers = max(1, min(max_workers, len(tickers)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for ticker in tickers:
+                futures[ticker] = executor.submit(self.sync, ticker, timespan, from_, to)
+
+            for ticker, future in futures.items():
+                try:
+                    results[ticker] = future.result()
+                except Exception as e:
+                    errors[ticker] = e
+
+        return results, errors
+
+    def _set_watermark(self, pipeline, ticker, timespan, bars):
+        '''Queues the update of the watermark to the timestamp of the last bar
+        '''
+        if bars:
+            pipeline.hset(WATERMARKS_KEY, watermark_field(ticker, timespan), bars[-1]["date"])
+
+    def history_matches(self, ticker, timespan):
+        '''Checks that the local history copy holds as many bars as Redis and the same last bar
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+           Returns:
+              True if they match, or if there is no history store
+        '''
+        if self.history_store is None:
+            return True
+        key = aggregate_key(ticker, timespan)
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        pipeline.json().arrlen(key)
+        pipeline.json().get(key, '$[-1]')
+        length, last = pipeline.execute()
+        # ARRLEN comes back as a list from some RedisJSON versions
+        if isinstance(length, list):
+            length = length[0] if length else None
+
+        local = self.history_store.query(ticker, timespan)
+        if len(local) != (length or 0):
+            return False
+        if len(local) == 0:
+            return True
+        stored = AggregateBars.from_records(last)
+        return all(np.array_equal(local.columns[name][-1:], stored.columns[name], equal_nan=True) for name in stored.columns)
+
+    def _write_history(self, ticker, timespan, bars, rebuild=False):
+        '''Appends the synced bars to the local history store, if there is one, then checks it
+           still matches Redis and copies the full history again if it drifted
+        '''
+        if self.history_store is None or not bars:
+            return
+        if rebuild:
+            self.history_store.clear(ticker, timespan)
+        self.history_store.append(ticker, timespan, AggregateBars.from_records(bars))
+        if not self.history_matches(ticker, timespan):
+            self.history_store.clear(ticker, timespan)
+            # a copy of the synced document, get_bars would also add the backfilled chunks in front of it
+            document = decode_json_document(self.redis_store.get(aggregate_key(ticker, timespan)))
+            self.history_store.append(ticker, timespan, AggregateBars.from_records(document or []))
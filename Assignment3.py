@@ -29,160 +29,257 @@
 # NOTE: I had to pip install polygon-api-client
 # API requires Python 3.8 or greater
 
+import argparse
 import sys
 from PolygonIoAPIWrapper import PolygonIoAPIWrapper
-import pandas as pd
 from db_config import get_redis_connection
-import json
-from StockDataProcessing import StockDataProcessing
-
-# what are we running?
-print(sys.version)
-
-polygonClient = PolygonIoAPIWrapper()
-redis_connection = get_redis_connection()
-
-#######################################################
-# Data #1
-# list aggregates - (each timespans - open, close, high)
-lmt_aggregate_json = polygonClient.json_aggregates(ticker="LMT", timespan="day", from_="2023-01-01", to="2024-02-29")
-#print(lmt_aggregate_json)
-rtx_aggregate_json = polygonClient.json_aggregates(ticker="RTX", timespan="day", from_="2023-01-01", to="2024-02-29")
-ba_aggregate_json = polygonClient.json_aggregates(ticker="BA", timespan="day", from_="2023-01-01", to="2024-02-29")
-noc_aggregate_json = polygonClient.json_aggregates(ticker="NOC", timespan="day", from_="2023-01-01", to="2024-02-29")
-gd_aggregate_json = polygonClient.json_aggregates(ticker="GD", timespan="day", from_="2023-01-01", to="2024-02-29")
-lhx_aggregate_json = polygonClient.json_aggregates(ticker="LHX", timespan="day", from_="2023-01-01", to="2024-02-29")
-hii_aggregate_json = polygonClient.json_aggregates(ticker="HII", timespan="day", from_="2023-01-01", to="2024-02-29")
-ldos_aggregate_json = polygonClient.json_aggregates(ticker="LDOS", timespan="day", from_="2023-01-01", to="2024-02-29")
-
-
-# insert JSON into redis
-redis_connection.json().set('stocks:aggregate:lmt', '.', json.dumps(lmt_aggregate_json))
-redis_connection.json().set('stocks:aggregate:rtx', '.', json.dumps(rtx_aggregate_json))
-redis_connection.json().set('stocks:aggregate:ba', '.', json.dumps(ba_aggregate_json))
-redis_connection.json().set('stocks:aggregate:noc', '.', json.dumps(noc_aggregate_json))
-redis_connection.json().set('stocks:aggregate:gd', '.', json.dumps(gd_aggregate_json))
-redis_connection.json().set('stocks:aggregate:lhx', '.', json.dumps(lhx_aggregate_json))
-redis_connection.json().set('stocks:aggregate:hii', '.', json.dumps(hii_aggregate_json))
-redis_connection.json().set('stocks:aggregate:ldos', '.', json.dumps(ldos_aggregate_json))
-
-# Get JSON
-json_data = redis_connection.json().get('stocks:aggregate:lmt')
-data = json.loads(json_data)
-#print(json_data)
-
-#######################################################
-# Data #2
-# ticker snapshots
-# tickers we are interested in - top US defense contractors
-tickers = ["LMT", "RTX", "BA", "NOC", "GD", "LHX", "HII", "LDOS"]
-defense_snapshots_json = polygonClient.json_snapshots(tickers)
-#print(defense_snapshots_json)
-
-# insert JSON into redis
-redis_connection.json().set('stocks:snapshots', '.', json.dumps(defense_snapshots_json))
-
-# Get JSON
-json_data = redis_connection.json().get('stocks:snapshots')
-data = json.loads(json_data)
-#print(json_data)
-
-#######################################################
-# Data #3
-# get biggest gainers
-biggest_gainers_json = polygonClient.json_biggest_gainers()
-#print(biggest_gainers_json)
-
-# insert JSON into redis
-redis_connection.json().set('stocks:gainers', '.', json.dumps(biggest_gainers_json))
-
-# Get JSON
-json_data = redis_connection.json().get('stocks:gainers')
-data = json.loads(json_data)
-#print(json_data)
-
-#######################################################
-# Data #4
-# get biggest losers
-biggest_losers_json = polygonClient.json_biggest_losers()
-#print(biggest_losers_json)
-
-# insert JSON into redis
-redis_connection.json().set('stocks:losers', '.', json.dumps(biggest_losers_json))
-
-# Get JSON
-json_data = redis_connection.json().get('stocks:losers')
-data = json.loads(json_data)
-#print(json_data)
-
-#######################################################
-# Data #5
-# get list of exchanges
-exchanges_json = polygonClient.json_exchanges()
-#print(exchanges_json)
-
-# insert JSON into redis
-redis_connection.json().set('exchanges', '.', json.dumps(exchanges_json))
-
-# Get JSON
-json_data = redis_connection.json().get('exchanges')
-data = json.loads(json_data)
-#print(json_data)
-
-#######################################################
-# Data #6
-# can get conditions but not using it, just printing the data
-polygonClient.print_conditions()
-
-#######################################################
-# Data #7
-# print the news on a stock (again not using it)
-polygonClient.print_news(ticker="LMT")
-
-#######################################################
-# Processing #1
-# Using a heatmap to see how correlated stocks are
-stockDataProcessing = StockDataProcessing()
-
-comparison_matrix = []
-
-# Get JSON and put each day's close data into a df
-tickers = ["lmt", "rtx", "ba", "noc", "gd", "lhx", "hii", "ldos"]
-for ticker in tickers:
-    json_data = redis_connection.json().get('stocks:aggregate:'+ticker)
-    data = json.loads(json.loads(json_data))
-
-    df = pd.DataFrame(data, columns=["date", "close"])
-    df["date"] = pd.to_datetime(df["date"], unit="ms")
-    df.set_index("date", inplace=True)
-    df.rename(columns={"close": ticker}, inplace=True)
-    comparison_matrix.append(df)
-
-comparison_matrix = pd.concat(comparison_matrix, axis=1)
-daily_returns = comparison_matrix.pct_change().dropna()
-correlation_matrix = daily_returns.corr()
-print(correlation_matrix)
-
-stockDataProcessing.plot_correlation_heatmap(correlation_matrix);
-
-#######################################################
-# Processing #2
-# snapshot percent change
-json_data = redis_connection.json().get('stocks:snapshots')
-
-stockDataProcessing.snapshot_percent_change(json_data)
-
-#######################################################
-# Processing #3
-# Using highcharts.com visualize the aggregates
-# Get JSON for the aggregate placed in redis
-json_data = redis_connection.json().get('stocks:aggregate:lmt')
-
-stockDataProcessing.visualize_aggregates(json_data)
-
-exit()
-
-#get single snapshot
-polygonClient.print_single_snapshot(ticker="LMT")
-
+from RedisJSONStore import RedisJSONStore, aggregate_key
+from AggregateCache import AggregateCache
+from AggregateSync import AggregateSync
+from LocalHistoryStore import LocalHistoryStore
+from CorrelationEngine import CorrelationEngine
+from IndicatorEngine import IndicatorEngine
+from MarketMovers import rank_movers
+from SearchIndexes import SearchIndexes
+from NewsIngest import NewsIngest
+from ReferenceDataCache import ReferenceDataCache
+from Pipeline import Pipeline, Stage, print_results
+import Metrics
 
+# tickers we are interested in - top US defense contractors
+TICKERS = ["LMT", "RTX", "BA", "NOC", "GD", "LHX", "HII", "LDOS"]
+
+# stages that only move data from the API into Redis, run by Ingest.py
+INGEST_STAGES = ["indexes", "aggregates", "snapshots", "gainers", "losers", "exchanges", "news"]
+
+
+class Assignment3:
+    '''Assignment3 is a class that runs the application as a pipeline of stages - every
+       Data # step reads JSON from the API and inserts it into RedisJSON, every Processing #
+       step reads it back from Redis. Independent stages run at the same time
+    '''
+
+    def __init__(self):
+        '''Constructor that creates the polygon.io wrapper and the Redis access objects. Nothing
+           connects to polygon.io or Redis until a stage uses it
+        '''
+        self.polygonClient = PolygonIoAPIWrapper()
+        self.redis_connection = get_redis_connection()
+        self.redis_store = RedisJSONStore(self.redis_connection, batch_size=100)
+        # the processing stages read the same documents, keep them parsed between stages
+        self.aggregateCache = AggregateCache(self.redis_store)
+        self.searchIndexes = SearchIndexes(self.redis_connection)
+        self.referenceData = ReferenceDataCache(self.polygonClient, self.redis_connection, path="reference")
+
+    def build_pipeline(self):
+        '''Declares the stages and their dependencies
+           Returns:
+              Pipeline
+        '''
+        pipeline = Pipeline(self.redis_connection)
+        pipeline.add(Stage("indexes", self.searchIndexes.ensure_indexes, max_age=24 * 60 * 60))
+        pipeline.add(Stage("aggregates", self.sync_aggregates, max_age=6 * 60 * 60))
+        pipeline.add(Stage("snapshots", self.store_snapshots, max_age=60))
+        pipeline.add(Stage("gainers", self.store_gainers, depends=["indexes"], max_age=60))
+        pipeline.add(Stage("losers", self.store_losers, depends=["indexes"], max_age=60))
+        pipeline.add(Stage("exchanges", self.store_exchanges, depends=["indexes"], max_age=24 * 60 * 60))
+        pipeline.add(Stage("conditions", self.print_conditions))
+        pipeline.add(Stage("news", self.ingest_news, max_age=5 * 60))
+        pipeline.add(Stage("correlation", self.correlation, depends=["aggregates"], main_thread=True))
+        pipeline.add(Stage("percent_change", self.percent_change, depends=["snapshots"]))
+        pipeline.add(Stage("chart", self.visualize, depends=["aggregates"], main_thread=True))
+        pipeline.add(Stage("indicators", self.indicators, depends=["aggregates"]))
+        return pipeline
+
+    #######################################################
+    # Data #1
+    # list aggregates - (each timespans - open, close, high)
+    def sync_aggregates(self):
+        '''Insert JSON into redis - the first run stores the full window as native JSON arrays,
+           later runs only download and append the bars newer than the last stored one.
+           A local memory mapped copy is kept in ./history for offline analysis
+        '''
+        aggregateSync = AggregateSync(self.polygonClient, self.redis_store, LocalHistoryStore("history"))
+        synced_bars, aggregate_errors = aggregateSync.sync_many(TICKERS, timespan="day", from_="2023-01-01", to="2024-02-29")
+        #print(synced_bars)
+        for ticker, error in aggregate_errors.items():
+            print("failed to sync aggregates for", ticker, error)
+        # fail the stage, so it is not recorded as fresh and the stages reading the aggregates do not run
+        if aggregate_errors:
+            raise RuntimeError("failed to sync aggregates for {}".format(", ".join(sorted(aggregate_errors))))
+
+    #######################################################
+    # Data #2
+    # ticker snapshots
+    def store_snapshots(self):
+        '''Insert the snapshots of the tickers into redis
+        '''
+        defense_snapshots = self.polygonClient.snapshots(TICKERS)
+        #print(defense_snapshots)
+        self.redis_store.set('stocks:snapshots', defense_snapshots)
+
+    #######################################################
+    # Data #3
+    # get biggest gainers
+    def store_gainers(self):
+        '''Insert the biggest gainers into redis, as one document and one indexed document per ticker
+        '''
+        biggest_gainers = self.polygonClient.biggest_gainers()
+        #print(biggest_gainers)
+        self.redis_store.set('stocks:gainers', biggest_gainers)
+        self.searchIndexes.store_movers("gainers", biggest_gainers)
+
+    #######################################################
+    # Data #4
+    # get biggest losers
+    def store_losers(self):
+        '''Insert the biggest losers into redis, as one document and one indexed document per ticker
+        '''
+        biggest_losers = self.polygonClient.biggest_losers()
+        #print(biggest_losers)
+        self.redis_store.set('stocks:losers', biggest_losers)
+        self.searchIndexes.store_movers("losers", biggest_losers)
+
+    #######################################################
+    # Data #5
+    # get list of exchanges
+    def store_exchanges(self):
+        '''Insert the exchanges into redis - reference data is cached in redis and ./reference,
+           so the API is only hit once a day
+        '''
+        exchanges = self.referenceData.exchanges()
+        #print(exchanges)
+        self.redis_store.set('exchanges', exchanges)
+        self.searchIndexes.store_exchanges(exchanges)
+
+        # search inside redis instead of scanning the documents in Python
+        #print(self.searchIndexes.exchange_by_mic("XNYS"))
+        #print(self.searchIndexes.search_movers(direction="gainers", min_change=5, min_volume=1000000))
+
+    #######################################################
+    # Data #6
+    # can get conditions but not using it, just printing the data
+    def print_conditions(self):
+        '''Print the conditions, from the reference data cache
+        '''
+        print(self.referenceData.conditions())
+
+    #######################################################
+    # Data #7
+    # store the news of every ticker
+    def ingest_news(self):
+        '''Store the news of every ticker - only articles published since the last run are
+           downloaded - and print the latest news on a stock straight from redis
+        '''
+        newsIngest = NewsIngest(self.polygonClient, self.redis_connection)
+        new_articles, news_errors = newsIngest.ingest_many(TICKERS)
+        for ticker, error in news_errors.items():
+            print("failed to get news for", ticker, error)
+
+        for article in newsIngest.latest("LMT", 21):
+            print("{:<25}{:<15}".format(article["published_utc"], article["title"]))
+        if news_errors:
+            raise RuntimeError("failed to get news for {}".format(", ".join(sorted(news_errors))))
+
+    #######################################################
+    # Processing #1
+    # Using a heatmap to see how correlated stocks are
+    def correlation(self):
+        '''Get the date and close columns of every ticker from the aggregate cache, align them
+           into one price matrix and correlate the daily returns
+        '''
+        tickers = [ticker.lower() for ticker in TICKERS]
+
+        correlationEngine = CorrelationEngine(tickers)
+        correlationEngine.add_series(self.aggregateCache.closes(tickers))
+        correlation_matrix = correlationEngine.to_frame(correlationEngine.correlation())
+        print(correlation_matrix)
+
+        # plotting libraries are only imported by the stages that draw, ingest runs never load them
+        from StockDataProcessing import StockDataProcessing
+        StockDataProcessing().plot_correlation_heatmap(correlation_matrix)
+
+    #######################################################
+    # Processing #2
+    # snapshot percent change
+    def percent_change(self):
+        '''Print the previous day's percent change of the stored snapshots, then rank
+           today's biggest gainers among them
+        '''
+        from StockDataProcessing import StockDataProcessing
+        json_data = self.aggregateCache.document('stocks:snapshots')
+        StockDataProcessing().snapshot_percent_change(json_data)
+
+        for mover in rank_movers(self.aggregateCache.snapshot_columns('stocks:snapshots'), k=3, by="intraday"):
+            print("{:<15}{:.2f} %".format(mover["ticker"], mover["percent_change"]))
+
+    #######################################################
+    # Processing #3
+    # Using highcharts.com visualize the aggregates
+    def visualize(self):
+        '''Get JSON for the aggregate placed in redis and serve it as a candlestick chart
+        '''
+        from StockDataProcessing import StockDataProcessing
+        json_data = self.aggregateCache.document(aggregate_key("LMT"))
+        StockDataProcessing().visualize_aggregates(json_data)
+
+    #######################################################
+    # Processing #4
+    # technical indicators
+    def indicators(self):
+        '''Update the indicators stored next to the aggregates from the new bars only, then
+           print the latest value of the main ones
+        '''
+        tickers = [ticker.lower() for ticker in TICKERS]
+        indicatorEngine = IndicatorEngine(self.redis_store)
+        indicatorEngine.update(tickers)
+
+        names = ["sma_20", "ema_20", "rsi_14", "macd", "atr_14", "vwap_20"]
+        print("{:<8}".format("ticker") + "".join("{:>12}".format(name) for name in names))
+        for ticker, values in indicatorEngine.indicators(tickers, last=1).items():
+            if values:
+                print("{:<8}".format(ticker) + "".join("{:>12.2f}".format(values[name][-1]) for name in names))
+
+
+def main(argv=None):
+    '''Command line entry point
+       Inputs:
+          argv - command line arguments, sys.argv if None
+    '''
+    assignment = Assignment3()
+    pipeline = assignment.build_pipeline()
+
+    parser = argparse.ArgumentParser(description="Load stock data from polygon.io into Redis and process it")
+    parser.add_argument("stages", nargs="*", help="stages to run, with the stages they depend on (default: all)")
+    parser.add_argument("--force", action="store_true", help="run stages even when their output is still fresh")
+    parser.add_argument("--list", action="store_true", help="list the stages and exit")
+    parser.add_argument("--metrics", action="store_true", help="record timings and print them at the end")
+    parser.add_argument("--metrics-port", type=int, help="also serve the metrics for Prometheus on this port")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, stage in pipeline.stages.items():
+            print("{:<20}{}".format(name, ", ".join(stage.depends)))
+        return
+
+    unknown = [name for name in args.stages if name not in pipeline.stages]
+    if unknown:
+        parser.error("unknown stages: {}".format(", ".join(unknown)))
+
+    if args.metrics or args.metrics_port:
+        Metrics.enable()
+    if args.metrics_port:
+        Metrics.serve(args.metrics_port)
+
+    # what are we running?
+    print(sys.version)
+
+    results = pipeline.run(args.stages or None, force=args.force)
+    print_results(results)
+
+    if Metrics.REGISTRY.enabled:
+        print(Metrics.summary())
+
+
+if __name__ == "__main__":
+    main()
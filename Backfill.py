@@ -0,0 +1,238 @@
+import argparse
+import calendar
+import datetime
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import config
+from db_config import get_redis_connection
+from PolygonIoAPIWrapper import PolygonIoAPIWrapper
+from RedisJSONStore import RedisJSONStore, aggregate_key
+from RequestScheduler import RequestScheduler
+
+# set of the partitions of a job that are stored, backfill:<job>:done
+BACKFILL_KEY_PREFIX = 'backfill:'
+
+# objects created once in every worker process by _init_worker
+_worker = {}
+
+
+def done_key(job):
+    '''Builds the key of the set of completed partitions of a job
+       Inputs:
+          job - name of the backfill job
+       Returns:
+          string containing the Redis key
+    '''
+    return BACKFILL_KEY_PREFIX + job + ':done'
+
+
+def month_partitions(tickers, from_, to):
+    '''Splits a backfill into one task per ticker and calendar month. Month bounds are UTC
+       milliseconds, so every bar of a task falls in the month chunk set_chunked writes it to
+       and tasks never write to each other's chunks
+       Inputs:
+          tickers - list of strings containing stock ticker symbols
+          from_ - first day of the backfill in YYYY-MM-DD
+          to - last day of the backfill in YYYY-MM-DD
+       Returns:
+          list of (ticker, partition id such as 2023-01, start millis, end millis) tuples
+    '''
+    first = datetime.date.fromisoformat(from_)
+    last = datetime.date.fromisoformat(to)
+    if last < first:
+        raise ValueError("to must not be before from_")
+
+    months = []
+    year, month = first.year, first.month
+    while (year, month) <= (last.year, last.month):
+        start = max(first, datetime.date(year, month, 1))
+        end = min(last, datetime.date(year, month, calendar.monthrange(year, month)[1]))
+        months.append(("{:04d}-{:02d}".format(year, month), _millis(start), _millis(end + datetime.timedelta(days=1)) - 1))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    return [(ticker.upper(), partition, start, end) for ticker in tickers for partition, start, end in months]
+
+
+def _millis(date):
+    '''Converts a date to milliseconds since the epoch at UTC midnight
+    '''
+    return calendar.timegm(date.timetuple()) * 1000
+
+
+def _init_worker(requests_per_minute, batch_size):
+    '''Creates the API wrapper and the Redis store of a worker process, once per process
+    '''
+    # a worker's share of the quota can be below one request a minute, it still needs a whole token
+    scheduler = RequestScheduler(requests_per_minute, burst=max(1.0, requests_per_minute)) if requests_per_minute else None
+    _worker["polygon_client"] = PolygonIoAPIWrapper(scheduler=scheduler)
+    _worker["redis_store"] = RedisJSONStore(get_redis_connection(), batch_size=batch_size)
+
+
+def _run_partition(job, timespan, task):
+    '''Downloads and stores one partition inside a worker process, then records it as done.
+       Bars are merged into the month chunk by timestamp, so a partition that is retried after a
+       crash never leaves duplicate bars, and a partial month does not drop the rest of the chunk
+       Returns:
+          tuple (task, number of bars stored)
+    '''
+    ticker, partition, start, end = task
+    polygon_client = _worker["polygon_client"]
+    redis_store = _worker["redis_store"]
+
+    bars = redis_store.set_chunked(aggregate_key(ticker.lower(), timespan),
+                                   polygon_client.iter_aggregates(ticker, timespan, start, end), chunk="month", merge=True)
+    redis_store.redis_connection.sadd(done_key(job), _member(task))
+    return task, bars
+
+
+def _member(task):
+    '''Names a partition in the done set, such as LMT:2023-01
+    '''
+    return task[0] + ':' + task[1]
+
+
+class Backfill:
+    '''Backfill is a class that loads long histories of bars for many tickers. The work is split
+       into (ticker, month) partitions that run on a pool of processes, each with its own API
+       client and Redis connection. Completed partitions are recorded in Redis, so a job that is
+       interrupted picks up where it stopped when it is started again
+    '''
+
+    def __init__(self, job, timespan="minute", redis_connection=None, workers=4, requests_per_minute=None, batch_size=100):
+        '''Constructor
+           Inputs:
+              job - name of the backfill job, the done set is kept per job
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              redis_connection - Redis connection object, a new one is created from config.yaml if None
+              workers - number of worker processes
+              requests_per_minute - request quota shared by all workers, config.PolygonRequestsPerMinute
+                 if None, requests are not paced when that setting is missing too
+              batch_size - number of keys read or written per Redis round trip by the worker stores
+        '''
+        if redis_connection is None:
+            redis_connection = get_redis_connection()
+        if requests_per_minute is None:
+            requests_per_minute = getattr(config, "PolygonRequestsPerMinute", None)
+
+        self.job = job
+        self.timespan = timespan
+        self.redis_connection = redis_connection
+        self.workers = max(1, workers)
+        self.requests_per_minute = requests_per_minute
+        self.batch_size = batch_size
+
+    def pending(self, tasks):
+        '''Leaves out the partitions already recorded as done
+           Inputs:
+              tasks - list of tasks from month_partitions
+           Returns:
+              list of tasks still to run
+        '''
+        if not tasks:
+            return []
+        done = self.redis_connection.smismember(done_key(self.job), [_member(task) for task in tasks])
+        return [task for task, finished in zip(tasks, done) if not finished]
+
+    def reset(self):
+        '''Forgets the completed partitions, so the next run loads everything again
+        '''
+        self.redis_connection.delete(done_key(self.job))
+
+    def run(self, tasks, report=print, report_interval=10.0):
+        '''Runs the partitions that are not done yet
+           Inputs:
+              tasks - list of tasks from month_partitions
+              report - function called with a progress line, None for no progress
+              report_interval - seconds between progress lines
+           Returns:
+              dict with the number of partitions skipped, done and failed, bars stored, seconds
+              and failures (dict of partition to exception)
+        '''
+        todo = self.pending(tasks)
+        summary = {"skipped": len(tasks) - len(todo), "done": 0, "failed": 0, "bars": 0, "seconds": 0.0, "failures": {}}
+        if not todo:
+            return summary
+
+        # the quota is per API key, every worker gets an equal share of it
+        worker_rate = self.requests_per_minute / self.workers if self.requests_per_minute else None
+
+        start = time.perf_counter()
+        last_report = start
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                 initargs=(worker_rate, self.batch_size)) as executor:
+            futures = {executor.submit(_run_partition, self.job, self.timespan, task): task for task in todo}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    task, bars = future.result()
+                    summary["done"] += 1
+                    summary["bars"] += bars
+                except Exception as e:
+                    summary["failed"] += 1
+                    summary["failures"][_member(task)] = e
+
+                now = time.perf_counter()
+                last = summary["done"] + summary["failed"] == len(todo)
+                if report is not None and (now - last_report >= report_interval or last):
+                    report(progress_line(summary, len(todo), now - start))
+                    last_report = now
+
+        summary["seconds"] = time.perf_counter() - start
+        return summary
+
+
+def progress_line(summary, total, seconds):
+    '''Formats the progress of a run with its throughput and estimated time left
+       Inputs:
+          summary - summary dict of Backfill.run
+          total - number of partitions in the run
+          seconds - seconds since the run started
+       Returns:
+          string
+    '''
+    finished = summary["done"] + summary["failed"]
+    rate = finished / seconds if seconds > 0 else 0.0
+    eta = (total - finished) / rate if rate > 0 else float("inf")
+    return "{}/{} partitions ({} failed)  {:.2f} partitions/s  {:.0f} bars/s  ETA {}".format(
+        finished, total, summary["failed"], rate, summary["bars"] / seconds if seconds > 0 else 0.0,
+        datetime.timedelta(seconds=int(eta)) if eta != float("inf") else "unknown")
+
+
+def main(argv=None):
+    '''Command line entry point
+       Inputs:
+          argv - command line arguments, sys.argv if None
+    '''
+    parser = argparse.ArgumentParser(description="Backfill aggregates from polygon.io into Redis, resuming interrupted jobs")
+    parser.add_argument("tickers", nargs="*", help="tickers to load")
+    parser.add_argument("--tickers-file", help="file with one ticker per line, such as the S&P 500 members")
+    parser.add_argument("--from", dest="from_", required=True, help="first day in YYYY-MM-DD")
+    parser.add_argument("--to", required=True, help="last day in YYYY-MM-DD")
+    parser.add_argument("--timespan", default="minute", help="bar timespan (default: minute)")
+    parser.add_argument("--job", help="job name used for the checkpoints (default: <timespan>:<from>:<to>)")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes (default: 4)")
+    parser.add_argument("--requests-per-minute", type=float, help="request quota shared by the workers (default: config.py)")
+    parser.add_argument("--reset", action="store_true", help="forget the completed partitions and start over")
+    args = parser.parse_args(argv)
+
+    tickers = list(args.tickers)
+    if args.tickers_file:
+        with open(args.tickers_file, "r") as file:
+            tickers.extend(line.strip() for line in file if line.strip() and not line.startswith("#"))
+    if not tickers:
+        parser.error("no tickers given")
+
+    backfill = Backfill(args.job or "{}:{}:{}".format(args.timespan, args.from_, args.to), args.timespan,
+                        workers=args.workers, requests_per_minute=args.requests_per_minute)
+    if args.reset:
+        backfill.reset()
+
+    summary = backfill.run(month_partitions(tickers, args.from_, args.to))
+    print("{} partitions done, {} failed, {} already done, {} bars in {:.1f} s".format(
+        summary["done"], summary["failed"], summary["skipped"], summary["bars"], summary["seconds"]))
+    for partition, error in summary["failures"].items():
+        print("failed", partition, error)
+
+
+if __name__ == "__main__":
+    main()
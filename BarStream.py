@@ -0,0 +1,442 @@
+import abc
+import argparse
+import json
+import queue
+import threading
+import time
+import numpy as np
+import config
+from AggregateSync import WATERMARKS_KEY, watermark_field
+from RedisJSONStore import RedisJSONStore, aggregate_key, decode_json_document, version_key
+
+# websocket aggregate events - AM is one bar per minute, A one bar per second
+EVENT_TIMESPANS = {"AM": "minute", "A": "second"}
+
+
+def parse_message(message):
+    '''Turns a message in Polygon's websocket format into bars. A message is a JSON array of
+       events such as {"ev": "AM", "sym": "LMT", "o": 1.0, "h": 1.0, "l": 1.0, "c": 1.0, "v": 100,
+       "vw": 1.0, "s": 1709215200000, "e": 1709215260000}, status and other events are ignored
+       Inputs:
+          message - JSON text or bytes, a single event dict or a list of event dicts
+       Returns:
+          list of (ticker, timespan, bar dict) tuples, the bar dicts have the fields of
+          PolygonIoAPIWrapper.iter_aggregates
+    '''
+    if isinstance(message, (str, bytes)):
+        message = json.loads(message)
+    if isinstance(message, dict):
+        message = [message]
+
+    bars = []
+    for event in message:
+        timespan = EVENT_TIMESPANS.get(event.get("ev"))
+        if timespan is None:
+            continue
+        bars.append((event["sym"], timespan, {
+            "date": event["s"],
+            "open": event["o"],
+            "high": event["h"],
+            "low": event["l"],
+            "close": event["c"],
+            "volume": event["v"],
+            "vwap": event.get("vw"),
+            "transactions": event.get("n")
+            }))
+    return bars
+
+
+class BarSource(abc.ABC):
+    '''BarSource is the base class of the sources read by BarStreamProcessor. Iterating over a
+       source yields one list of (ticker, timespan, bar dict) tuples per message received
+    '''
+
+    @abc.abstractmethod
+    def __iter__(self):
+        '''Returns:
+              iterator of lists of (ticker, timespan, bar dict) tuples
+        '''
+
+
+class PolygonWebSocketSource(BarSource):
+    '''PolygonWebSocketSource is a class that streams live aggregate bars from the polygon.io
+       websocket. The client runs on its own thread and hands raw messages over through a queue,
+       so a slow consumer never blocks the socket until the queue is full
+    '''
+
+    def __init__(self, tickers, timespan="minute", client=None, max_queue=10000):
+        '''Constructor
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              timespan - minute or second
+              client - object with the polygon WebSocketClient interface delivering raw messages,
+                 a WebSocketClient using the API key from config.py is created if None
+              max_queue - number of messages buffered before the client thread waits
+        '''
+        events = {timespan: event for event, timespan in EVENT_TIMESPANS.items()}
+        if timespan not in events:
+            raise ValueError("timespan must be minute or second")
+
+        if client is None:
+            from polygon import WebSocketClient
+
+            client = WebSocketClient(api_key=config.PolygonKey, raw=True,
+                                     subscriptions=[events[timespan] + "." + ticker.upper() for ticker in tickers])
+        self.client = client
+        self._queue = queue.Queue(max_queue)
+
+    def __iter__(self):
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        while True:
+            message = self._queue.get()
+            if message is None:
+                return
+            if isinstance(message, Exception):
+                raise message
+            bars = parse_message(message)
+            if bars:
+                yield bars
+
+    def _run(self):
+        '''Runs the websocket client until it stops, then ends the iteration
+        '''
+        try:
+            self.client.run(self._queue.put)
+        except Exception as e:
+            self._queue.put(e)
+            return
+        self._queue.put(None)
+
+
+class FileReplaySource(BarSource):
+    '''FileReplaySource is a class that replays recorded websocket messages from a file with one
+       message per line, keeping the original spacing between bars divided by a speed factor
+    '''
+
+    def __init__(self, path, speed=1.0, sleep=time.sleep, clock=time.monotonic):
+        '''Constructor
+           Inputs:
+              path - file with one message in Polygon's websocket format per line
+              speed - replay speed, 60 plays one minute of bars per second. None or 0 replays as fast as possible
+              sleep - function used to wait between messages, can be replaced in tests
+              clock - function returning the current time in seconds, can be replaced in tests
+        '''
+        self.path = path
+        self.speed = speed
+        self.sleep = sleep
+        self.clock = clock
+
+    def __iter__(self):
+        first_bar = None
+        started = self.clock()
+        with open(self.path, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                bars = parse_message(line)
+                if not bars:
+                    continue
+
+                if self.speed:
+                    bar_time = min(bar["date"] for ticker, timespan, bar in bars)
+                    if first_bar is None:
+                        first_bar = bar_time
+                    delay = (bar_time - first_bar) / 1000.0 / self.speed - (self.clock() - started)
+                    if delay > 0:
+                        self.sleep(delay)
+
+                yield bars
+
+
+class BarStreamProcessor:
+    '''BarStreamProcessor is a class that applies streamed bars to the stored stocks:aggregate:*
+       arrays as they arrive. A bar with the same timestamp as the last stored one replaces it
+       (the bar was still forming), newer bars are appended, and the watermark and version of the
+       key move with every write, so AggregateSync and the readers keyed by version stay consistent.
+       Each message is written with one pipeline, then handed to the consumers
+    '''
+
+    def __init__(self, redis_store=None, consumers=()):
+        '''Constructor
+           Inputs:
+              redis_store - RedisJSONStore used to store the bars, a new one is created if None
+              consumers - functions called as consumer(ticker, timespan, bars) after the bars of a
+                 ticker are stored, bars being a list of bar dicts in date order
+        '''
+        if redis_store is None:
+            redis_store = RedisJSONStore()
+
+        self.redis_store = redis_store
+        self.redis_connection = redis_store.redis_connection
+        self.consumers = list(consumers)
+
+        self._watermarks = {}
+        self.stats = {"messages": 0, "bars": 0, "late": 0, "seconds": 0.0}
+
+    def run(self, source, max_messages=None):
+        '''Applies every message of a source
+           Inputs:
+              source - BarSource
+              max_messages - stop after this many messages, None to run until the source ends
+           Returns:
+              dict with the number of messages, bars stored, late bars ignored and seconds spent writing
+        '''
+        for count, bars in enumerate(source, start=1):
+            self.apply(bars)
+            if max_messages is not None and count >= max_messages:
+                break
+        return self.stats
+
+    def apply(self, bars):
+        '''Stores the bars of one message and notifies the consumers
+           Inputs:
+              bars - list of (ticker, timespan, bar dict) tuples
+           Returns:
+              dict of (ticker, timespan) to the list of bars stored
+        '''
+        start = time.perf_counter()
+
+        grouped = {}
+        for ticker, timespan, bar in bars:
+            grouped.setdefault((ticker.lower(), timespan), []).append(bar)
+        self._load_watermarks([series for series in grouped if series not in self._watermarks])
+
+        stored = {}
+        pipeline = self.redis_connection.pipeline(transaction=False)
+        for (ticker, timespan), series_bars in grouped.items():
+            key = aggregate_key(ticker, timespan)
+            watermark = self._watermarks[(ticker, timespan)]
+            applied = []
+            for bar in sorted(series_bars, key=lambda bar: bar["date"]):
+                if watermark is None:
+                    # first bar of a key that does not exist yet, or of an empty array
+                    pipeline.json().set(key, '.', [bar])
+                elif bar["date"] == watermark:
+                    pipeline.json().set(key, '$[-1]', bar)
+                elif bar["date"] > watermark:
+                    pipeline.json().arrappend(key, '$', bar)
+                else:
+                    self.stats["late"] += 1
+                    continue
+                watermark = bar["date"]
+                applied.append(bar)
+
+            if applied:
+                pipeline.incr(version_key(key))
+                pipeline.hset(WATERMARKS_KEY, watermark_field(ticker, timespan), watermark)
+                self._watermarks[(ticker, timespan)] = watermark
+                stored[(ticker, timespan)] = applied
+
+        if stored:
+            pipeline.execute()
+
+        self.stats["messages"] += 1
+        self.stats["bars"] += sum(len(applied) for applied in stored.values())
+        self.stats["seconds"] += time.perf_counter() - start
+
+        for (ticker, timespan), applied in stored.items():
+            for consumer in self.consumers:
+                consumer(ticker, timespan, applied)
+
+        return stored
+
+    def _load_watermarks(self, series):
+        '''Reads the watermarks of the tickers seen for the first time. Arrays without a watermark
+           (written by RedisJSONStore.set or before AggregateSync) continue from their last bar, and
+           old double-encoded string documents are rewritten as arrays first, so stored history is
+           never replaced. Only keys that do not exist start over with the next bar
+        '''
+        if not series:
+            return
+        pipeline = self.redis_connection.pipeline(transaction=False)
+        for ticker, timespan in series:
+            pipeline.json().type(aggregate_key(ticker, timespan))
+            # the watermarks hash has no field for arrays stored without AggregateSync, the last bar is what counts
+            pipeline.json().get(aggregate_key(ticker, timespan), '$[-1].date')
+        results = pipeline.execute()
+
+        for index, (ticker, timespan) in enumerate(series):
+            key_type, last_date = results[2 * index], results[2 * index + 1]
+            # the type comes back as a list from some RedisJSON versions
+            if isinstance(key_type, list):
+                key_type = key_type[0] if key_type else None
+
+            if key_type is None:
+                watermark = None
+            elif key_type == 'array':
+                watermark = last_date[0] if last_date else None
+            else:
+                watermark = self._migrate(ticker, timespan)
+            self._watermarks[(ticker, timespan)] = int(watermark) if watermark is not None else None
+
+    def _migrate(self, ticker, timespan):
+        '''Rewrites an old double-encoded aggregate document as a native array
+           Returns:
+              timestamp of the last bar, None if the document holds no bars
+        '''
+        key = aggregate_key(ticker, timespan)
+        records = decode_json_document(self.redis_connection.json().get(key)) or []
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        pipeline.json().set(key, '.', records)
+        pipeline.incr(version_key(key))
+        pipeline.execute()
+        return records[-1]["date"] if records else None
+
+
+def chart_consumer(chart_server):
+    '''Builds a consumer that drops the cached chart payloads of a ticker as soon as new bars
+       are stored, instead of waiting for the next version check
+       Inputs:
+          chart_server - ChartServer
+       Returns:
+          consumer function for BarStreamProcessor
+    '''
+    def consumer(ticker, timespan, bars):
+        if timespan == chart_server.timespan:
+            chart_server.invalidate(ticker)
+    return consumer
+
+
+def indicator_consumer(indicator_engine):
+    '''Builds a consumer that updates the stored indicators of a ticker as soon as new bars
+       are stored, computing only from the bar the saved state stopped at
+       Inputs:
+          indicator_engine - IndicatorEngine
+       Returns:
+          consumer function for BarStreamProcessor
+    '''
+    def consumer(ticker, timespan, bars):
+        indicator_engine.update([ticker], timespan)
+    return consumer
+
+
+class CorrelationConsumer:
+    '''CorrelationConsumer is a class that feeds streamed closes into a CorrelationEngine. Bars
+       of the same timestamp are collected into one price row, and a row is added to the engine
+       once a bar with a later timestamp arrives, since the bars of the row can still change until then.
+       Bars at or before the last row added to the engine (late bars of another ticker, or updates
+       of a bar already added) can not be applied any more, they are counted in late and dropped
+    '''
+
+    def __init__(self, engine, timespan="minute"):
+        '''Constructor
+           Inputs:
+              engine - CorrelationEngine, bars of tickers it does not hold are ignored
+              timespan - timespan of the bars fed to the engine
+        '''
+        self.engine = engine
+        self.timespan = timespan
+        self._columns = {ticker.lower(): index for index, ticker in enumerate(engine.tickers)}
+        self._rows = {}
+        self._lock = threading.Lock()
+        self.late = 0
+
+    def __call__(self, ticker, timespan, bars):
+        column = self._columns.get(ticker)
+        if timespan != self.timespan or column is None:
+            return
+
+        with self._lock:
+            for bar in bars:
+                last = self.engine.last_timestamp
+                if last is not None and bar["date"] <= last:
+                    self.late += 1
+                    continue
+                row = self._rows.get(bar["date"])
+                if row is None:
+                    row = self._rows[bar["date"]] = np.full(len(self._columns), np.nan)
+                row[column] = bar["close"]
+
+            if not self._rows:
+                return
+            latest = max(self._rows)
+            complete = sorted(timestamp for timestamp in self._rows if timestamp < latest)
+            self._add(complete)
+
+    def flush(self):
+        '''Adds the rows still waiting for a later bar, for example when the stream ends
+        '''
+        with self._lock:
+            self._add(sorted(self._rows))
+
+    def _add(self, timestamps):
+        '''Moves complete rows into the engine
+        '''
+        if not timestamps:
+            return
+        prices = np.vstack([self._rows.pop(timestamp) for timestamp in timestamps])
+        self.engine.add_prices(np.array(timestamps, dtype=np.int64), prices)
+
+
+def main(argv=None):
+    '''Command line entry point
+       Inputs:
+          argv - command line arguments, sys.argv if None
+    '''
+    parser = argparse.ArgumentParser(description="Stream aggregate bars into Redis")
+    parser.add_argument("tickers", nargs="*", help="tickers to subscribe to on the polygon.io websocket, or to correlate with --replay")
+    parser.add_argument("--replay", help="replay a file of recorded websocket messages instead")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 for as fast as possible")
+    parser.add_argument("--timespan", default="minute", help="minute or second (default: minute)")
+    parser.add_argument("--chart", action="store_true", help="serve charts that update as bars arrive")
+    parser.add_argument("--indicators", action="store_true", help="update the stored indicators as bars arrive")
+    parser.add_argument("--correlation", action="store_true",
+                        help="correlate the returns of the tickers as bars arrive and print the matrix at the end")
+    parser.add_argument("--correlation-window", type=int, default=None,
+                        help="also correlate the last N returns (default: full history only)")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        source = FileReplaySource(args.replay, speed=args.speed)
+    elif args.tickers:
+        source = PolygonWebSocketSource(args.tickers, timespan=args.timespan)
+    else:
+        parser.error("give tickers or --replay")
+    if args.correlation and len(args.tickers) < 2:
+        parser.error("--correlation needs at least two tickers")
+
+    processor = BarStreamProcessor()
+    if args.indicators:
+        from IndicatorEngine import IndicatorEngine
+
+        processor.consumers.append(indicator_consumer(IndicatorEngine(processor.redis_store)))
+    correlation_consumer = None
+    if args.correlation:
+        from CorrelationEngine import CorrelationEngine
+
+        correlation_consumer = CorrelationConsumer(CorrelationEngine(args.tickers, window=args.correlation_window),
+                                                   timespan=args.timespan)
+        processor.consumers.append(correlation_consumer)
+    chart_server = None
+    if args.chart:
+        from ChartServer import ChartServer
+
+        chart_server = ChartServer(processor.redis_store, timespan=args.timespan, version_check_interval=60.0)
+        processor.consumers.append(chart_consumer(chart_server))
+        threading.Thread(target=chart_server.serve_forever, daemon=True).start()
+
+    try:
+        stats = processor.run(source)
+    except KeyboardInterrupt:
+        stats = processor.stats
+    finally:
+        if chart_server is not None:
+            chart_server.shutdown()
+
+    print("{} messages, {} bars stored, {} late bars ignored, {:.3f} ms per message".format(
+        stats["messages"], stats["bars"], stats["late"], 1000.0 * stats["seconds"] / max(1, stats["messages"])))
+
+    if correlation_consumer is not None:
+        correlation_consumer.flush()
+        engine = correlation_consumer.engine
+        print("correlation of returns ({} bars too late to correlate):".format(correlation_consumer.late))
+        print(engine.tickers)
+        print(engine.correlation())
+        if args.correlation_window:
+            print("last {} returns:".format(args.correlation_window))
+            print(engine.window_correlation())
+
+
+if __name__ == "__main__":
+    main()
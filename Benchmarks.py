@@ -0,0 +1,378 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+import numpy as np
+import redis
+from AggregateBars import AggregateBars
+from AggregateSync import AggregateSync, WATERMARKS_KEY
+from BinaryBarStore import BinaryBarStore
+from CorrelationEngine import CorrelationEngine
+from FakeRESTClient import FakeRESTClient, fake_tickers
+from MarketMovers import rank_movers
+from NewsIngest import NewsIngest, NEWS_IDS_KEY
+from PolygonIoAPIWrapper import PolygonIoAPIWrapper
+from RedisJSONStore import RedisJSONStore, aggregate_key, decode_json_document
+from RequestScheduler import RequestScheduler
+from SnapshotSync import SnapshotSync, SNAPSHOT_DIGESTS_KEY, SNAPSHOT_TICKERS_KEY
+
+GROUPS = ("ingest", "snapshot", "redis", "decode", "correlation", "news")
+
+# daily bars stored per ticker by the Redis benchmarks, the window Assignment3 stores
+REDIS_WINDOW = ("day", "2023-01-01", "2024-02-29")
+
+# Redis database used when no URL is given and fakeredis is not installed, away from the default database 0
+DEFAULT_REDIS_URL = 'redis://localhost:6379/15'
+
+
+def benchmark_redis(url=None):
+    '''Picks the Redis the benchmarks run against - the given URL, else an in-process fakeredis
+       server when fakeredis is installed, else a local Redis
+       Inputs:
+          url - Redis URL such as redis://localhost:6379/15, None to pick automatically
+       Returns:
+          tuple (text connection, binary connection, description of the target)
+    '''
+    if url is None:
+        try:
+            import fakeredis
+        except ImportError:
+            url = DEFAULT_REDIS_URL
+        else:
+            server = fakeredis.FakeServer()
+            return (fakeredis.FakeRedis(server=server, decode_responses=True),
+                    fakeredis.FakeRedis(server=server, decode_responses=False), "fakeredis")
+
+    return (redis.Redis.from_url(url, decode_responses=True),
+            redis.Redis.from_url(url, decode_responses=False), url)
+
+
+def git_revision():
+    '''Returns:
+          short hash of the checked out commit, None outside a git checkout
+    '''
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmarks:
+    '''Benchmarks is a class that times the ingest, storage and processing hot paths without a
+       polygon.io key or the remote Redis. Data comes from FakeRESTClient and is written to a local
+       Redis or fakeredis, every benchmark is run once to warm up and then timed repeat times,
+       and only keys of the fake BNCH tickers are written and cleaned up
+    '''
+
+    def __init__(self, redis_connection, binary_connection, sizes=(10, 100, 500), ingest_tickers=8,
+                 timespan="minute", from_="2024-01-01", to="2024-01-31", correlation_bars=2000, repeat=5):
+        '''Constructor
+           Inputs:
+              redis_connection - Redis connection with decode_responses=True
+              binary_connection - Redis connection to the same server with decode_responses=False
+              sizes - universe sizes (number of tickers) of the snapshot, Redis and correlation benchmarks
+              ingest_tickers - number of tickers downloaded by the ingest benchmarks
+              timespan, from_, to - window of the bars of every fake ticker
+              correlation_bars - number of price rows of the correlation benchmarks
+              repeat - number of timed runs of every benchmark
+        '''
+        self.redis_connection = redis_connection
+        self.binary_connection = binary_connection
+        self.sizes = list(sizes)
+        self.ingest_tickers = ingest_tickers
+        self.timespan = timespan
+        self.from_ = from_
+        self.to = to
+        self.correlation_bars = correlation_bars
+        self.repeat = repeat
+
+        self.fake_client = FakeRESTClient(universe=max(self.sizes))
+        # a scheduler that never waits, so its bookkeeping is timed but not the plan's quota
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.polygon_client = PolygonIoAPIWrapper(client=self.fake_client, scheduler=RequestScheduler(10 ** 9))
+        self.redis_store = RedisJSONStore(redis_connection)
+        self.results = []
+        self.report = print
+
+    def run(self, groups=GROUPS, report=print):
+        '''Runs the benchmarks of the selected groups
+           Inputs:
+              groups - names from GROUPS
+              report - function called with a line per finished benchmark, None for no output
+           Returns:
+              list of result dicts
+        '''
+        for group in groups:
+            if group not in GROUPS:
+                raise ValueError("unknown benchmark group {}".format(group))
+
+        self.report = report
+        self.cleanup()
+        try:
+            for group in groups:
+                getattr(self, "bench_" + group)()
+        finally:
+            self.cleanup()
+        return self.results
+
+    def measure(self, name, size, items, unit, fn, setup=None):
+        '''Times a function and records the result
+           Inputs:
+              name - benchmark name such as redis.json_set_many
+              size - universe size or other scale of the run
+              items - number of units processed by one call of fn, for the rate
+              unit - what items counts, such as bars or keys
+              fn - function without arguments to time
+              setup - function without arguments run before every call, not timed
+        '''
+        timings = []
+        # keep anything the timed code prints out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            for run in range(self.repeat + 1):
+                if setup is not None:
+                    setup()
+                start = time.perf_counter()
+                fn()
+                if run:
+                    timings.append(time.perf_counter() - start)
+
+        median = statistics.median(timings)
+        result = {
+            "benchmark": name,
+            "size": size,
+            "items": items,
+            "unit": unit,
+            "repeat": self.repeat,
+            "min_seconds": min(timings),
+            "median_seconds": median,
+            "rate": items / median if median > 0 else None
+            }
+        self.results.append(result)
+        if self.report is not None:
+            self.report("{:<28}{:>7}{:>12.3f} ms{:>16,.0f} {}/s".format(name, size, median * 1000, result["rate"] or 0, unit))
+
+    def bench_ingest(self):
+        '''Download and conversion of paginated aggregates, then the end to end sync into Redis
+        '''
+        tickers = fake_tickers(self.ingest_tickers)
+        bars = sum(len(self.fake_client.timestamps(self.timespan, self.from_, self.to)) for ticker in tickers)
+        size = len(tickers)
+
+        self.measure("ingest.json_aggregates", size, bars, "bars", lambda: [
+            self.polygon_client.json_aggregates(ticker, self.timespan, self.from_, self.to) for ticker in tickers])
+        self.measure("ingest.json_aggregates_many", size, bars, "bars", lambda: self.polygon_client.json_aggregates_many(
+            tickers, self.timespan, self.from_, self.to))
+        self.measure("ingest.aggregate_bars", size, bars, "bars", lambda: [
+            self.polygon_client.aggregate_bars(ticker, self.timespan, self.from_, self.to) for ticker in tickers])
+
+        aggregate_sync = AggregateSync(self.polygon_client, self.redis_store)
+        self.measure("ingest.sync_many", size, bars, "bars",
+                     lambda: aggregate_sync.sync_many(tickers, self.timespan, self.from_, self.to),
+                     setup=self.cleanup)
+
+    def bench_snapshot(self):
+        '''Snapshot conversion, diff-only snapshot writes and the movers ranking
+        '''
+        for size in self.sizes:
+            tickers = fake_tickers(size)
+            self.measure("snapshot.records", size, size, "tickers", lambda: self.polygon_client.snapshots(tickers))
+            self.measure("snapshot.columns", size, size, "tickers", lambda: self.polygon_client.snapshot_columns(tickers))
+
+            columns = self.polygon_client.snapshot_columns(tickers)
+            snapshot_syncs = []
+
+            def fresh_sync():
+                self.cleanup()
+                snapshot_syncs[:] = [SnapshotSync(self.polygon_client, self.redis_connection)]
+
+            self.measure("snapshot.store_full", size, size, "tickers",
+                         lambda: snapshot_syncs[0].store_columns(columns), setup=fresh_sync)
+            self.measure("snapshot.store_unchanged", size, size, "tickers",
+                         lambda: snapshot_syncs[0].store_columns(columns))
+            self.measure("snapshot.rank_movers", size, size, "tickers",
+                         lambda: rank_movers(columns, k=20, by="intraday"))
+
+    def bench_redis(self):
+        '''RedisJSON and binary round trips for universes of stored aggregates
+        '''
+        timespan, from_, to = REDIS_WINDOW
+        records = self.polygon_client.aggregates(fake_tickers(1)[0], timespan, from_, to)
+        bars = AggregateBars.from_records(records)
+        binary_store = BinaryBarStore(self.binary_connection)
+
+        for size in self.sizes:
+            tickers = fake_tickers(size)
+            keys = [aggregate_key(ticker.lower(), timespan) for ticker in tickers]
+            documents = {key: records for key in keys}
+
+            self.measure("redis.json_set_many", size, size, "keys", lambda: self.redis_store.set_many(documents))
+            self.measure("redis.json_get_many", size, size, "keys", lambda: self.redis_store.get_many(keys))
+            self.measure("redis.json_get_many_close", size, size, "keys",
+                         lambda: self.redis_store.get_many(keys, path='$[*].close'))
+            self.measure("redis.get_versions", size, size, "keys", lambda: self.redis_store.get_versions(keys))
+
+            self.measure("redis.binary_write", size, size, "keys",
+                         lambda: [binary_store.write(ticker, timespan, bars) for ticker in tickers])
+            self.measure("redis.binary_read_many", size, size, "keys",
+                         lambda: binary_store.read_many(tickers, timespan))
+
+    def bench_decode(self):
+        '''Parsing stored aggregates into Python objects and columns
+        '''
+        records = self.polygon_client.aggregates(fake_tickers(1)[0], self.timespan, self.from_, self.to)
+        text = json.dumps(records)
+        payload = AggregateBars.from_records(records).to_bytes()
+        size = len(records)
+
+        self.measure("decode.json_document", size, size, "bars", lambda: decode_json_document(text))
+        self.measure("decode.from_records", size, size, "bars", lambda: AggregateBars.from_records(records))
+        self.measure("decode.from_bytes", size, size, "bars", lambda: AggregateBars.from_bytes(payload))
+
+    def bench_correlation(self):
+        '''Correlation of returns across universes, from aligned prices with a few missing bars
+        '''
+        rows = self.correlation_bars
+        timestamps = np.arange(rows, dtype=np.int64) * 60000
+
+        for size in self.sizes:
+            rng = np.random.default_rng(size)
+            prices = 100.0 * np.exp(np.cumsum(rng.normal(0.0, 0.01, (rows, size)), axis=0))
+            prices[rng.random((rows, size)) < 0.02] = np.nan
+            tickers = fake_tickers(size)
+
+            def correlate():
+                engine = CorrelationEngine(tickers)
+                engine.add_prices(timestamps, prices)
+                return engine.correlation()
+
+            self.measure("correlation.full", size, rows * size, "prices", correlate)
+
+    def bench_news(self):
+        '''Incremental news ingest, first for unseen tickers and then for tickers without new articles
+        '''
+        tickers = fake_tickers(self.ingest_tickers)
+        articles = self.fake_client.news_per_ticker * len(tickers)
+        news_ingest = NewsIngest(self.polygon_client, self.redis_connection, max_articles=self.fake_client.news_per_ticker)
+
+        self.measure("news.ingest_new", len(tickers), articles, "articles",
+                     lambda: news_ingest.ingest_many(tickers), setup=self.cleanup)
+        self.measure("news.ingest_unchanged", len(tickers), len(tickers), "tickers",
+                     lambda: news_ingest.ingest_many(tickers))
+
+    def cleanup(self):
+        '''Removes everything the benchmarks wrote, only keys and members of the fake tickers
+        '''
+        connection = self.redis_connection
+        keys = set()
+        for pattern in ("*bnch*", "*BNCH*", "news:article:bench*"):
+            keys.update(connection.scan_iter(match=pattern, count=1000))
+        keys = list(keys)
+        for start in range(0, len(keys), 1000):
+            connection.delete(*keys[start:start + 1000])
+
+        for hash_key, pattern in ((SNAPSHOT_DIGESTS_KEY, "BNCH*"), (WATERMARKS_KEY, "bnch*")):
+            fields = [field for field, value in connection.hscan_iter(hash_key, match=pattern)]
+            if fields:
+                connection.hdel(hash_key, *fields)
+        for set_key, pattern in ((SNAPSHOT_TICKERS_KEY, "BNCH*"), (NEWS_IDS_KEY, "bench*")):
+            members = list(connection.sscan_iter(set_key, match=pattern))
+            if members:
+                connection.srem(set_key, *members)
+
+
+def save_results(report, directory):
+    '''Writes a report as JSON, named by time and commit so runs of different versions sit side by side
+       Inputs:
+          report - dict built by main
+          directory - directory of the result files, created if missing
+       Returns:
+          path of the file written
+    '''
+    os.makedirs(directory, exist_ok=True)
+    name = "benchmarks-{}-{}.json".format(report["created"].replace(":", "").replace("-", ""), report["git"] or "nogit")
+    path = os.path.join(directory, name)
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+    return path
+
+
+def compare(results, baseline):
+    '''Compares the median time of every benchmark with a previous run
+       Inputs:
+          results - list of result dicts
+          baseline - report dict loaded from an earlier result file
+       Returns:
+          list of lines, one per benchmark found in both runs
+    '''
+    previous = {(result["benchmark"], result["size"]): result for result in baseline["results"]}
+    lines = []
+    for result in results:
+        old = previous.get((result["benchmark"], result["size"]))
+        if old is None or not old["median_seconds"]:
+            continue
+        change = (result["median_seconds"] / old["median_seconds"] - 1) * 100
+        lines.append("{:<28}{:>7}{:>+10.1f} %  ({:.3f} ms -> {:.3f} ms)".format(
+            result["benchmark"], result["size"], change, old["median_seconds"] * 1000, result["median_seconds"] * 1000))
+    return lines
+
+
+def main(argv=None):
+    '''Command line entry point
+       Inputs:
+          argv - command line arguments, sys.argv if None
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark the ingest, storage and processing hot paths offline")
+    parser.add_argument("groups", nargs="*", help="benchmark groups to run: " + ", ".join(GROUPS) + " (default: all)")
+    parser.add_argument("--sizes", default="10,100,500", help="universe sizes, comma separated (default: 10,100,500)")
+    parser.add_argument("--ingest-tickers", type=int, default=8, help="tickers downloaded by the ingest benchmarks (default: 8)")
+    parser.add_argument("--timespan", default="minute", help="timespan of the fake bars (default: minute)")
+    parser.add_argument("--from", dest="from_", default="2024-01-01", help="first day of the fake bars")
+    parser.add_argument("--to", default="2024-01-31", help="last day of the fake bars")
+    parser.add_argument("--correlation-bars", type=int, default=2000, help="price rows of the correlation benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of every benchmark (default: 5)")
+    parser.add_argument("--redis-url", help="Redis to use, fakeredis or " + DEFAULT_REDIS_URL + " if not given")
+    parser.add_argument("--output", default="benchmark_results", help="directory of the result files")
+    parser.add_argument("--compare", help="result file of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    unknown = [group for group in args.groups if group not in GROUPS]
+    if unknown:
+        parser.error("unknown groups: {}".format(", ".join(unknown)))
+
+    redis_connection, binary_connection, target = benchmark_redis(args.redis_url)
+    benchmarks = Benchmarks(redis_connection, binary_connection, [int(size) for size in args.sizes.split(",")],
+                            args.ingest_tickers, args.timespan, args.from_, args.to, args.correlation_bars, args.repeat)
+
+    created = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    print("redis:", target)
+    results = benchmarks.run(args.groups or GROUPS)
+
+    report = {
+        "created": created,
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "redis": target,
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "results": results
+        }
+    print("results written to", save_results(report, args.output))
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        print("compared with", args.compare, "(positive is slower)")
+        for line in compare(results, baseline):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
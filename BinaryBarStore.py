@@ -0,0 +1,179 @@
+from db_config import get_redis_connection
+from AggregateBars import AggregateBars, FORMAT_VERSION
+
+# bars are kept under stocks:bars:v<format version>:<ticker>:<timespan>, next to the stocks:aggregate:* JSON keys
+KEY_PREFIX = 'stocks:bars:v{}'.format(FORMAT_VERSION)
+
+class BinaryBarStore:
+    '''BinaryBarStore is a class that stores aggregates in Redis as packed little-endian
+       binary columns (see AggregateBars.to_bytes) instead of JSON text. Bars are split into chunks
+       of a fixed number of bars, each in its own key, and a small hash per ticker and timespan
+       records how many bars and chunks there are. Reads return NumPy views over the bytes
+       received from Redis, so nothing is parsed
+    '''
+
+    def __init__(self, redis_connection=None, chunk_size=65536):
+        '''Constructor
+           Inputs:
+              redis_connection - Redis connection created with decode_responses=False, a new one
+                 is created from config.yaml if None
+              chunk_size - number of bars stored in each chunk key
+        '''
+        if redis_connection is None:
+            redis_connection = get_redis_connection(decode_responses=False)
+
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+
+        self.redis_connection = redis_connection
+        self.chunk_size = chunk_size
+
+    def write(self, ticker, timespan, bars):
+        '''Replaces the stored bars of a ticker
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              bars - AggregateBars in date order
+        '''
+        key = self._key(ticker, timespan)
+        old_chunks = self._meta(key)["chunks"]
+
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        chunks = self._queue_chunks(pipeline, key, 0, bars)
+        # drop chunks left over from a longer previous write
+        for index in range(chunks, old_chunks):
+            pipeline.delete(self._chunk_key(key, index))
+        if len(bars) == 0:
+            pipeline.hdel(key, 'last')
+        self._queue_meta(pipeline, key, len(bars), chunks, bars)
+        pipeline.execute()
+
+    def append(self, ticker, timespan, bars):
+        '''Appends the bars newer than the last stored one. Only the last, partially filled chunk
+           is rewritten, full chunks are never touched again
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              bars - AggregateBars in date order
+           Returns:
+              number of bars appended
+        '''
+        key = self._key(ticker, timespan)
+        meta = self._meta(key)
+        if meta["chunks"] == 0:
+            self.write(ticker, timespan, bars)
+            return len(bars)
+
+        if meta["last"] is not None:
+            bars = bars[bars.timestamp > meta["last"]]
+        if len(bars) == 0:
+            return 0
+
+        last_index = meta["chunks"] - 1
+        last_chunk = AggregateBars.from_bytes(self.redis_connection.get(self._chunk_key(key, last_index)))
+        merged = AggregateBars.concatenate([last_chunk, bars])
+
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        chunks = last_index + self._queue_chunks(pipeline, key, last_index, merged)
+        self._queue_meta(pipeline, key, meta["count"] + len(bars), chunks, bars)
+        pipeline.execute()
+
+        return len(bars)
+
+    def read(self, ticker, timespan):
+        '''Reads the stored bars of a ticker with two round trips (meta data, then every chunk)
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+           Returns:
+              AggregateBars, whose columns are read-only views when the bars fit in one chunk
+        '''
+        return self.read_many([ticker], timespan)[ticker]
+
+    def read_many(self, tickers, timespan):
+        '''Reads the stored bars of many tickers with two round trips in total
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+           Returns:
+              dict of ticker to AggregateBars, empty for tickers without stored bars
+        '''
+        keys = [self._key(ticker, timespan) for ticker in tickers]
+
+        pipeline = self.redis_connection.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hget(key, 'chunks')
+        chunk_counts = [int(count or 0) for count in pipeline.execute()]
+
+        chunk_keys = []
+        for key, chunks in zip(keys, chunk_counts):
+            chunk_keys.extend(self._chunk_key(key, index) for index in range(chunks))
+        payloads = self.redis_connection.mget(chunk_keys) if chunk_keys else []
+
+        results = {}
+        position = 0
+        for ticker, chunks in zip(tickers, chunk_counts):
+            parts = [AggregateBars.from_bytes(payload) for payload in payloads[position:position + chunks] if payload]
+            position += chunks
+            results[ticker] = AggregateBars.concatenate(parts)
+
+        return results
+
+    def read_closes(self, tickers, timespan):
+        '''Reads the timestamp and close columns of many tickers, for the correlation step
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+           Returns:
+              dict of ticker to (timestamp array, close array)
+        '''
+        return {ticker: (bars.timestamp, bars.close) for ticker, bars in self.read_many(tickers, timespan).items()}
+
+    def delete(self, ticker, timespan):
+        '''Removes the stored bars of a ticker
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+        '''
+        key = self._key(ticker, timespan)
+        chunks = self._meta(key)["chunks"]
+        self.redis_connection.delete(key, *[self._chunk_key(key, index) for index in range(chunks)])
+
+    def _key(self, ticker, timespan):
+        '''Builds the key of the meta data hash, chunk keys add :<chunk index>
+        '''
+        return '{}:{}:{}'.format(KEY_PREFIX, ticker.lower(), timespan)
+
+    def _chunk_key(self, key, index):
+        '''Builds the key of one chunk
+        '''
+        return '{}:{}'.format(key, index)
+
+    def _meta(self, key):
+        '''Reads the meta data hash
+        '''
+        count, chunks, last = self.redis_connection.hmget(key, 'count', 'chunks', 'last')
+        return {
+            "count": int(count or 0),
+            "chunks": int(chunks or 0),
+            "last": int(last) if last is not None else None
+            }
+
+    def _queue_chunks(self, pipeline, key, first_index, bars):
+        '''Queues the writes of bars split into chunk_size chunks, starting at first_index
+           Returns:
+              number of chunks queued
+        '''
+        chunks = 0
+        for start in range(0, len(bars), self.chunk_size):
+            pipeline.set(self._chunk_key(key, first_index + chunks), bars[start:start + self.chunk_size].to_bytes())
+            chunks += 1
+        return chunks
+
+    def _queue_meta(self, pipeline, key, count, chunks, bars):
+        '''Queues the update of the meta data hash
+        '''
+        meta = {"count": count, "chunks": chunks, "version": FORMAT_VERSION}
+        if len(bars):
+            meta["last"] = int(bars.timestamp[-1])
+        pipeline.hset(key, mapping=meta)
@@ -0,0 +1,288 @@
+import collections
+import gzip
+import hashlib
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+from RedisJSONStore import RedisJSONStore, aggregate_key
+from AggregateQuery import AggregateQuery
+
+# ticker symbols accepted in URLs, anything else is answered with 404 before it reaches a page or a Redis key
+TICKER_PATTERN = re.compile(r'^[A-Za-z0-9.\-]{1,12}$')
+
+# https://www.highcharts.com/blog/products/stock/
+# JavaScript StockChart with Date-Time Axis, %DATA_URL% and %TITLE% are filled in per chart
+CHART_HTML = """
+<!DOCTYPE HTML>
+<html>
+<head>
+
+<style>
+#container {
+    height: 750px;
+    min-width: 310px;
+}
+</style>
+
+<script src="https://code.highcharts.com/stock/highstock.js"></script>
+<script src="https://code.highcharts.com/stock/modules/data.js"></script>
+<script src="https://code.highcharts.com/stock/modules/exporting.js"></script>
+<script src="https://code.highcharts.com/stock/modules/accessibility.js"></script>
+
+<div id="container"></div>
+
+<script type="text/javascript">
+Highcharts.getJSON('%DATA_URL%', function (data) {
+    // create the chart
+    Highcharts.stockChart('container', {
+        rangeSelector: {
+            selected: 1
+        },
+
+        title: {
+            text: '%TITLE%'
+        },
+
+        series: [{
+            type: 'candlestick',
+            name: '%TITLE%',
+            data: data
+        }]
+    });
+});
+</script>
+</head>
+<body>
+"""
+
+
+def chart_values(records):
+    '''Formats aggregate records the way the Highcharts candlestick series expects them
+       Inputs:
+          records - list of aggregate dicts (see PolygonIoAPIWrapper.aggregates)
+       Returns:
+          list of [date, open, high, low, close, volume] lists
+    '''
+    return [[r["date"], r["open"], r["high"], r["low"], r["close"], r["volume"]] for r in records]
+
+
+def bar_values(bars):
+    '''Columnar version of chart_values
+       Inputs:
+          bars - AggregateBars
+       Returns:
+          list of [date, open, high, low, close, volume] lists, missing (NaN) values become None
+    '''
+    columns = [bars.timestamp, bars.open, bars.high, bars.low, bars.close, bars.volume]
+    # NaN has no JSON spelling, json.dumps would write a bare NaN the browser can not parse
+    columns = [[None if value != value else value for value in column.tolist()] for column in columns]
+    return [list(values) for values in zip(*columns)]
+
+
+def query_time(value):
+    '''Parses a from / to query parameter
+       Inputs:
+          value - string from the query string, YYYY-MM-DD or milliseconds since the epoch, or None
+       Returns:
+          int milliseconds for all-digit values, the string (or None) unchanged otherwise
+    '''
+    if value is not None and value.isdigit():
+        return int(value)
+    return value
+
+
+class _Payload:
+    '''A response body serialized once, with its gzip version and ETag
+    '''
+
+    def __init__(self, body, content_type, version):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=6)
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.content_type = content_type
+        self.version = version
+        self.checked = time.monotonic()
+
+
+class ChartServer:
+    '''ChartServer is a class that serves Highcharts candlestick charts for every stored ticker.
+       /chart/<ticker> returns the page and /data/<ticker> the bars from Redis, optionally limited
+       with the from, to, timespan (resample to) and points (downsample to) query parameters. Each payload is
+       serialized and gzipped once and cached until the version counter of its Redis key changes
+       (or invalidate() is called), clients revalidate with ETag / If-None-Match, and every request
+       is handled on its own thread so one slow client does not block the others
+    '''
+
+    def __init__(self, redis_store=None, port=8887, timespan="day", version_check_interval=1.0, points=2000,
+                 cache_size=256):
+        '''Constructor
+           Inputs:
+              redis_store - RedisJSONStore used to read the aggregates, a new one is created if None
+              port - TCP port to listen on
+              timespan - timespan of the aggregates served
+              version_check_interval - seconds a cached payload is served before its Redis version
+                 is checked again
+              points - number of points requested by the chart page, so the browser never receives
+                 more bars than it can draw
+              cache_size - maximum number of payloads kept in memory, the least recently used are dropped
+        '''
+        if redis_store is None:
+            redis_store = RedisJSONStore()
+
+        self.redis_store = redis_store
+        self.port = port
+        self.timespan = timespan
+        self.version_check_interval = version_check_interval
+        self.points = points
+        self.cache_size = cache_size
+        self.query = AggregateQuery(redis_store)
+
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._httpd = None
+
+    def invalidate(self, ticker=None):
+        '''Drops cached payloads, for example after new bars were ingested
+           Inputs:
+              ticker - ticker to drop, every ticker if None
+        '''
+        with self._lock:
+            if ticker is None:
+                self._cache.clear()
+            else:
+                for cached in [cached for cached in self._cache if cached[0] == ticker.lower()]:
+                    del self._cache[cached]
+
+    def payload(self, ticker, from_=None, to=None, resample_to=None, points=None):
+        '''Returns the cached data payload of a ticker, rebuilding it when its Redis version changed
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              from_, to, resample_to, points - see AggregateQuery.bars
+           Returns:
+              _Payload, or None if the ticker has no stored aggregates
+        '''
+        ticker = ticker.lower()
+        key = aggregate_key(ticker, self.timespan)
+        cache_key = (ticker, from_, to, resample_to, points)
+
+        with self._lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache.move_to_end(cache_key)
+        if cached is not None and time.monotonic() - cached.checked < self.version_check_interval:
+            return cached
+
+        version = self.redis_store.get_versions([key])[key]
+        if cached is not None and cached.version == version:
+            cached.checked = time.monotonic()
+            return cached
+
+        bars = self.query.bars(ticker, self.timespan, from_, to, resample_to, points)
+        if len(bars) == 0:
+            return None
+
+        payload = _Payload(json.dumps(bar_values(bars), allow_nan=False).encode(), "application/json", version)
+        with self._lock:
+            # payloads of the same ticker built from an older version can never be served again
+            for cached in [cached for cached, other in self._cache.items()
+                           if cached[0] == ticker and other.version != version]:
+                del self._cache[cached]
+            self._cache[cache_key] = payload
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return payload
+
+    def page(self, ticker):
+        '''Returns the chart page of a ticker
+           Inputs:
+              ticker - string containing a stock's ticker symbol, matching TICKER_PATTERN
+           Returns:
+              bytes of the HTML page
+        '''
+        if not TICKER_PATTERN.match(ticker):
+            raise ValueError("invalid ticker")
+        data_url = '/data/' + urllib.parse.quote(ticker.lower())
+        if self.points:
+            data_url += '?points=' + str(self.points)
+        html = CHART_HTML.replace('%DATA_URL%', data_url)
+        return html.replace('%TITLE%', ticker.upper() + ' Stock Price').encode()
+
+    def serve_forever(self):
+        '''Runs the server until a KeyboardInterrupt is received
+        '''
+        server = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                parts = [p for p in url.path.split('/') if p]
+                if len(parts) == 2 and not TICKER_PATTERN.match(parts[1]):
+                    self.send_error(404)
+                elif len(parts) == 2 and parts[0] == 'data':
+                    params = urllib.parse.parse_qs(url.query)
+                    try:
+                        payload = server.payload(
+                            parts[1],
+                            from_=query_time(params.get('from', [None])[0]),
+                            to=query_time(params.get('to', [None])[0]),
+                            resample_to=params.get('timespan', [None])[0],
+                            points=int(params['points'][0]) if 'points' in params else None)
+                    except ValueError as e:
+                        self.send_error(400, str(e))
+                        return
+                    if payload is None:
+                        self.send_error(404, "no aggregates stored for " + parts[1])
+                    else:
+                        self._send_payload(payload)
+                elif len(parts) == 2 and parts[0] == 'chart':
+                    self._send_body(server.page(parts[1]), "text/html")
+                else:
+                    self.send_error(404)
+
+            def _send_payload(self, payload):
+                if self.headers.get("If-None-Match") == payload.etag:
+                    self.send_response(304)
+                    self.send_header("ETag", payload.etag)
+                    self.end_headers()
+                    return
+                gzip_ok = "gzip" in self.headers.get("Accept-Encoding", "")
+                self._send_body(payload.gzip_body if gzip_ok else payload.body, payload.content_type,
+                                payload.etag, "gzip" if gzip_ok else None)
+
+            def _send_body(self, body, content_type, etag=None, encoding=None):
+                self.send_response(200)
+                self.send_header("Content-type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                    self.send_header("Cache-Control", "no-cache")
+                if encoding is not None:
+                    self.send_header("Content-Encoding", encoding)
+                    self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # one line per request would dominate the console with many dashboard users
+                pass
+
+        # handle ctrl-c KeyboardInterrupt to exit the program gracefully
+        try:
+            with http.server.ThreadingHTTPServer(("", self.port), handler) as httpd:
+                self._httpd = httpd
+                print("serving at port", self.port)
+                httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\nExiting gracefully...")
+        finally:
+            self._httpd = None
+
+    def shutdown(self):
+        '''Stops a server started with serve_forever from another thread
+        '''
+        if self._httpd is not None:
+            self._httpd.shutdown()
@@ -0,0 +1,217 @@
+import collections
+import numpy as np
+
+
+def align_series(series, tickers=None):
+    '''Aligns the close prices of many tickers on the union of their timestamps
+       Inputs:
+          series - dict of ticker to (timestamps, closes), both 1-D sequences in date order
+          tickers - order of the matrix columns, the order of series if None
+       Returns:
+          tuple (timestamps int64 array of length T, prices float64 array of shape T x N), NaN where a ticker has no bar
+    '''
+    if tickers is None:
+        tickers = list(series)
+
+    stamps = [np.asarray(series[ticker][0], dtype=np.int64) if ticker in series else np.empty(0, dtype=np.int64) for ticker in tickers]
+    timestamps = np.unique(np.concatenate(stamps)) if stamps else np.empty(0, dtype=np.int64)
+
+    prices = np.full((len(timestamps), len(tickers)), np.nan)
+    for column, ticker in enumerate(tickers):
+        if ticker not in series:
+            continue
+        rows = np.searchsorted(timestamps, stamps[column])
+        prices[rows, column] = np.asarray(series[ticker][1], dtype=np.float64)
+
+    return timestamps, prices
+
+
+def percent_returns(prices, previous=None):
+    '''Simple returns between consecutive rows, NaN where either price is missing
+       Inputs:
+          prices - float64 array of shape T x N
+          previous - optional price row preceding the first row, for incremental updates
+       Returns:
+          float64 array of shape T x N (T-1 x N if previous is None)
+    '''
+    if previous is not None:
+        prices = np.vstack([previous, prices])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return prices[1:] / prices[:-1] - 1.0
+
+
+class _PairwiseStats:
+    '''Sums needed for the pairwise-complete correlation of N series. Entry (i, j) only counts
+       rows where both series i and j have a value, the same rule pandas DataFrame.corr() uses
+    '''
+
+    def __init__(self, size):
+        self.n = np.zeros((size, size))
+        self.sx = np.zeros((size, size))
+        self.sxx = np.zeros((size, size))
+        self.sxy = np.zeros((size, size))
+
+    def add(self, returns, sign=1.0):
+        '''Adds (or with sign=-1 removes) a block of return rows using four matrix products
+        '''
+        mask = ~np.isnan(returns)
+        values = np.where(mask, returns, 0.0)
+        present = mask.astype(np.float64)
+        self.n += sign * (present.T @ present)
+        self.sx += sign * (values.T @ present)
+        self.sxx += sign * ((values * values).T @ present)
+        self.sxy += sign * (values.T @ values)
+
+    def correlation(self, min_periods):
+        '''Returns:
+              N x N correlation matrix, NaN where fewer than min_periods rows are shared
+        '''
+        n = self.n
+        covariance = n * self.sxy - self.sx * self.sx.T
+        variance_x = n * self.sxx - self.sx * self.sx
+        variance_y = variance_x.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlation = covariance / np.sqrt(variance_x * variance_y)
+        correlation[n < max(min_periods, 2)] = np.nan
+        np.clip(correlation, -1.0, 1.0, out=correlation)
+        return correlation
+
+
+class CorrelationEngine:
+    '''CorrelationEngine is a class that computes the correlation of daily returns for a large
+       universe of tickers. Prices are aligned into one contiguous matrix and the correlation
+       comes from running sums updated with blocked matrix products, so new bars only add their
+       own rows instead of recomputing the whole history, and a rolling window only adds the rows
+       entering and removes the rows leaving it
+    '''
+
+    def __init__(self, tickers, window=None, min_periods=2, block_size=512):
+        '''Constructor
+           Inputs:
+              tickers - list of ticker symbols, the order of the matrix rows and columns
+              window - number of most recent returns used by window_correlation, None to disable
+              min_periods - minimum number of shared returns for a pair to get a correlation
+              block_size - number of rows added per matrix product, bounds temporary memory
+        '''
+        self.tickers = list(tickers)
+        self.window = window
+        self.min_periods = min_periods
+        self.block_size = block_size
+
+        self._full = _PairwiseStats(len(self.tickers))
+        self._window = _PairwiseStats(len(self.tickers)) if window else None
+        self._window_rows = collections.deque()
+        self._last_prices = None
+        self._last_timestamp = None
+
+    def add_series(self, series):
+        '''Adds new bars for any of the tickers. Bars at or before the last added timestamp are
+           ignored, even for a ticker that had no bar at that timestamp yet - the returns of those
+           rows are already in the running sums and can not be changed. Add the bars of every
+           ticker up to the same time together so a lagging ticker does not lose its bars
+           Inputs:
+              series - dict of ticker to (timestamps, closes)
+           Returns:
+              number of new price rows added
+        '''
+        timestamps, prices = align_series(series, self.tickers)
+        if self._last_timestamp is not None:
+            newer = timestamps > self._last_timestamp
+            timestamps, prices = timestamps[newer], prices[newer]
+        return self.add_prices(timestamps, prices)
+
+    def add_prices(self, timestamps, prices):
+        '''Adds price rows already aligned to the tickers
+           Inputs:
+              timestamps - int64 array of length T, strictly increasing and after every timestamp added so far
+              prices - float64 array of shape T x N, NaN for missing bars
+           Returns:
+              number of price rows added
+        '''
+        if len(timestamps) == 0:
+            return 0
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if np.any(np.diff(timestamps) <= 0):
+            raise ValueError("timestamps must be strictly increasing")
+        if self._last_timestamp is not None and timestamps[0] <= self._last_timestamp:
+            raise ValueError("timestamp {} is not after the last added timestamp {}".format(int(timestamps[0]), self._last_timestamp))
+
+        returns = percent_returns(prices, self._last_prices)
+        self._last_prices = prices[-1]
+        self._last_timestamp = int(timestamps[-1])
+
+        for start in range(0, len(returns), self.block_size):
+            block = returns[start:start + self.block_size]
+            self._full.add(block)
+            if self._window is not None:
+                self._slide(block)
+
+        return len(timestamps)
+
+    @property
+    def last_timestamp(self):
+        '''Timestamp of the last price row added, None before any row
+        '''
+        return self._last_timestamp
+
+    def correlation(self):
+        '''Returns:
+              N x N correlation matrix of returns over the full history
+        '''
+        return self._full.correlation(self.min_periods)
+
+    def window_correlation(self):
+        '''Returns:
+              N x N correlation matrix of the most recent window returns
+        '''
+        if self._window is None:
+            raise ValueError("CorrelationEngine was created without a window")
+        return self._window.correlation(self.min_periods)
+
+    def to_frame(self, correlation):
+        '''Labels a correlation matrix with the tickers, ready for StockDataProcessing.plot_correlation_heatmap
+           Inputs:
+              correlation - N x N array from correlation() or window_correlation()
+           Returns:
+              pandas DataFrame
+        '''
+        import pandas as pd
+
+        return pd.DataFrame(correlation, index=self.tickers, columns=self.tickers)
+
+    @staticmethod
+    def rolling(timestamps, prices, window, step=1, min_periods=2):
+        '''Computes the correlation matrix of every rolling window of returns. Each step adds the
+           rows entering the window and removes the rows leaving it, so the cost per step does
+           not depend on the window length
+           Inputs:
+              timestamps - int64 array of length T
+              prices - float64 array of shape T x N
+              window - number of returns in each window
+              step - number of returns between consecutive windows
+              min_periods - minimum number of shared returns for a pair to get a correlation
+           Returns:
+              generator of (timestamp of the last bar in the window, N x N correlation matrix)
+        '''
+        returns = percent_returns(prices)
+        if len(returns) < window:
+            return
+
+        stats = _PairwiseStats(prices.shape[1])
+        stats.add(returns[:window])
+        yield int(timestamps[window]), stats.correlation(min_periods)
+
+        for end in range(window + step, len(returns) + 1, step):
+            stats.add(returns[end - step:end])
+            stats.add(returns[end - step - window:end - window], sign=-1.0)
+            yield int(timestamps[end]), stats.correlation(min_periods)
+
+    def _slide(self, block):
+        '''Adds a block of returns to the rolling window and removes the oldest rows past its length
+        '''
+        self._window.add(block)
+        self._window_rows.extend(block)
+        excess = len(self._window_rows) - self.window
+        if excess > 0:
+            leaving = np.array([self._window_rows.popleft() for _ in range(excess)])
+            self._window.add(leaving, sign=-1.0)
@@ -0,0 +1,193 @@
+import time
+import zlib
+import numpy as np
+from polygon.rest.models import Agg, MinuteSnapshot, Publisher, TickerNews, TickerSnapshot
+from LocalHistoryStore import to_millis
+
+# bar spacing in milliseconds
+_STEPS = {"second": 1000, "minute": 60 * 1000, "hour": 60 * 60 * 1000, "day": 24 * 60 * 60 * 1000}
+# regular US session in UTC milliseconds after midnight, 14:30 - 21:00
+_SESSION = (14 * 60 * 60 * 1000 + 30 * 60 * 1000, 21 * 60 * 60 * 1000)
+# polygon.io daily bars are stamped at midnight New York time
+_DAY_OFFSET = 5 * 60 * 60 * 1000
+
+
+def fake_tickers(count):
+    '''Builds ticker symbols for a fake universe
+       Inputs:
+          count - number of tickers
+       Returns:
+          list of strings such as BNCH0001
+    '''
+    return ["BNCH{:04d}".format(index) for index in range(1, count + 1)]
+
+
+class FakeRESTClient:
+    '''FakeRESTClient is a class with the parts of the polygon.io RESTClient interface used by
+       PolygonIoAPIWrapper, generating realistic data locally instead of calling the API. Prices are
+       seeded random walks per ticker, so the same ticker and window always give the same bars.
+       Lists are returned page by page through _get, like the real client, so a RequestScheduler
+       wrapped around _get paces them the same way
+    '''
+
+    def __init__(self, universe=500, page_size=50000, latency=0.0, news_per_ticker=200):
+        '''Constructor
+           Inputs:
+              universe - number of tickers returned by a full-market snapshot
+              page_size - number of results per page
+              latency - seconds every page takes to arrive, to simulate the network
+              news_per_ticker - number of news articles available for every ticker
+        '''
+        self.universe = universe
+        self.page_size = page_size
+        self.latency = latency
+        self.news_per_ticker = news_per_ticker
+        self.pages = 0
+        self._aggs = {}
+
+    def _get(self, path, params=None):
+        '''Stands in for the request of one page
+        '''
+        self.pages += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return path
+
+    def _paginate(self, path, items, page_size=None):
+        '''Yields items a page at a time, requesting each page only when the caller reaches it
+        '''
+        page_size = page_size or self.page_size
+        for start in range(0, len(items), page_size):
+            self._get(path, {"offset": start})
+            yield from items[start:start + page_size]
+
+    def _random(self, ticker, salt=0):
+        '''Random generator seeded by ticker, stable across runs and processes
+        '''
+        return np.random.default_rng(zlib.crc32(ticker.encode()) + salt)
+
+    def timestamps(self, timespan, from_, to):
+        '''Bar timestamps of a window - weekdays only, and only the regular session for intraday bars
+           Inputs:
+              timespan - second, minute, hour or day
+              from_, to - window bounds in YYYY-MM-DD or milliseconds
+           Returns:
+              int64 array of timestamps in milliseconds
+        '''
+        if timespan not in _STEPS:
+            raise ValueError("unsupported timespan {}".format(timespan))
+        day = _STEPS["day"]
+        start = to_millis(from_)
+        end = to_millis(to, end_of_day=True)
+
+        if timespan == "day":
+            first = start - start % day + _DAY_OFFSET
+            timestamps = np.arange(first, end + 1, day, dtype=np.int64)
+        else:
+            first = start - start % day
+            timestamps = np.arange(first, end + 1, _STEPS[timespan], dtype=np.int64)
+            in_day = timestamps % day
+            timestamps = timestamps[(in_day >= _SESSION[0]) & (in_day < _SESSION[1])]
+
+        # 1970-01-01 was a Thursday, so day number + 3 mod 7 gives 0 for Monday
+        weekday = (timestamps // day + 3) % 7
+        timestamps = timestamps[(weekday < 5) & (timestamps >= start) & (timestamps <= end)]
+        return timestamps
+
+    def list_aggs(self, ticker, multiplier, timespan, from_, to, **kwargs):
+        '''Generator of Agg objects, like RESTClient.list_aggs. The bars of a window are generated
+           once and kept, so repeated benchmark runs time the caller and not the generator
+        '''
+        cache_key = (ticker, timespan, from_, to)
+        if cache_key not in self._aggs:
+            self._aggs[cache_key] = self._generate_aggs(ticker, timespan, from_, to)
+        return self._paginate("/v2/aggs/ticker/{}".format(ticker), self._aggs[cache_key])
+
+    def _generate_aggs(self, ticker, timespan, from_, to):
+        '''Builds the Agg objects of a window
+        '''
+        timestamps = self.timestamps(timespan, from_, to)
+        count = len(timestamps)
+        rng = self._random(ticker)
+        close = 50.0 + 450.0 * rng.random() * np.exp(np.cumsum(rng.normal(0.0, 0.002, count)))
+        open_ = np.concatenate([close[:1], close[:-1]])
+        spread = np.abs(rng.normal(0.0, 0.001, count)) * close
+        high = np.maximum(open_, close) + spread
+        low = np.minimum(open_, close) - spread
+        volume = rng.integers(100, 100000, count)
+        transactions = np.maximum(1, volume // 100)
+
+        return [
+            Agg(open=o, high=h, low=l, close=c, volume=float(v), vwap=(h + l + c) / 3, timestamp=t, transactions=n)
+            for o, h, l, c, v, t, n in zip(open_.tolist(), high.tolist(), low.tolist(), close.tolist(),
+                                          volume.tolist(), timestamps.tolist(), transactions.tolist())
+            ]
+
+    def _snapshot(self, ticker, updated):
+        '''Builds the TickerSnapshot of one ticker
+        '''
+        rng = self._random(ticker, salt=1)
+        prev_close = 50.0 + 450.0 * rng.random()
+        prev_open = prev_close * (1 + rng.normal(0.0, 0.01))
+        day_open = prev_close * (1 + rng.normal(0.0, 0.005))
+        day_close = day_open * (1 + rng.normal(0.0, 0.02))
+        volume = float(rng.integers(10000, 10000000))
+
+        def day_bar(open_, close, volume):
+            return Agg(open=open_, high=max(open_, close) * 1.005, low=min(open_, close) * 0.995, close=close,
+                       volume=volume, vwap=(open_ + close) / 2)
+
+        return TickerSnapshot(
+            ticker=ticker,
+            todays_change=day_close - prev_close,
+            todays_change_percent=(day_close - prev_close) / prev_close * 100,
+            updated=updated,
+            day=day_bar(day_open, day_close, volume),
+            prev_day=day_bar(prev_open, prev_close, volume * 0.9),
+            min=MinuteSnapshot(accumulated_volume=volume, open=day_close, high=day_close, low=day_close, close=day_close,
+                               volume=volume / 390, vwap=day_close, timestamp=updated // 1000000, transactions=100)
+            )
+
+    def get_snapshot_all(self, market_type, tickers=None, **kwargs):
+        '''List of TickerSnapshot objects for the fake universe or the given tickers
+        '''
+        self._get("/v2/snapshot/locale/us/markets/{}/tickers".format(market_type))
+        updated = time.time_ns()
+        return [self._snapshot(ticker, updated) for ticker in (tickers or fake_tickers(self.universe))]
+
+    def get_snapshot_direction(self, market_type, direction, **kwargs):
+        '''The 20 biggest gainers or losers of the fake universe
+        '''
+        snapshots = self.get_snapshot_all(market_type)
+        snapshots.sort(key=lambda snap: snap.todays_change_percent, reverse=direction == "gainers")
+        return snapshots[:20]
+
+    def get_snapshot_ticker(self, market_type, ticker, **kwargs):
+        '''TickerSnapshot of one ticker
+        '''
+        self._get("/v2/snapshot/locale/us/markets/{}/tickers/{}".format(market_type, ticker))
+        return self._snapshot(ticker, time.time_ns())
+
+    def list_ticker_news(self, ticker=None, limit=None, **kwargs):
+        '''Generator of TickerNews objects, newest first, limit articles per page. Every fifth
+           article has the same id for every ticker, so articles are shared between tickers like real news
+        '''
+        hour = 60 * 60 * 1000
+        newest = int(time.time() * 1000) // hour * hour
+        seed = zlib.crc32(ticker.encode())
+
+        articles = []
+        for index in range(self.news_per_ticker):
+            published = newest - index * hour
+            articles.append(TickerNews(
+                id="bench{}".format(index if index % 5 == 0 else seed * 10000 + index),
+                title="{} headline {}".format(ticker, index),
+                author="Benchmark",
+                publisher=Publisher(name="Benchmark Wire"),
+                published_utc=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(published / 1000)),
+                article_url="https://example.com/{}/{}".format(ticker, index),
+                description="Generated article {} about {}".format(index, ticker),
+                tickers=[ticker],
+                keywords=["benchmark"]
+                ))
+        return self._paginate("/v2/reference/news", articles, limit)
@@ -0,0 +1,446 @@
+import numpy as np
+import redis
+import Metrics
+from AggregateBars import AggregateBars
+from RedisJSONStore import RedisJSONStore, aggregate_key, decode_json_document, version_key
+
+# inside one block of ewm, decay ** -k stays below this - far from overflow, and the float64
+# rounding error it brings is still negligible next to the prices
+_EWM_RANGE = 1e12
+
+
+def indicator_key(ticker, timespan="day"):
+    '''Builds the Redis key that holds the indicators of a ticker, next to its aggregates
+       Inputs:
+          ticker - string containing a stock's ticker symbol
+          timespan - string containing a timespan window (second, minute, hour, day, month)
+       Returns:
+          string such as stocks:indicators:lmt
+    '''
+    key = 'stocks:indicators:' + ticker.lower()
+    if timespan != "day":
+        key += ':' + timespan
+    return key
+
+
+def ewm(values, alpha, initial=None):
+    '''Exponential moving average down the rows of a matrix, average = previous + alpha * (value - previous),
+       for every column at once. The recursion is solved in closed form over blocks of rows, so
+       the Python loop runs once per block instead of once per bar
+       Inputs:
+          values - float64 array of shape T x N, NaN is only allowed after the last value of a column
+          alpha - smoothing factor, 0 < alpha <= 1
+          initial - float64 array of length N holding the average before the first row, NaN (or
+             None for every column) to start from the first value
+       Returns:
+          float64 array of shape T x N
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0 or alpha >= 1.0:
+        return values.copy()
+
+    previous = np.full(values.shape[1:], np.nan) if initial is None else np.asarray(initial, dtype=np.float64)
+    previous = np.where(np.isnan(previous), values[0], previous)
+
+    decay = 1.0 - alpha
+    block = max(1, int(np.log(_EWM_RANGE) / -np.log(decay)))
+    averages = np.empty_like(values)
+    for start in range(0, len(values), block):
+        rows = values[start:start + block]
+        # row j is decay^(j+1) * previous + alpha * sum over i <= j of decay^(j-i) * value i
+        powers = (decay ** np.arange(1, len(rows) + 1)).reshape((-1,) + (1,) * (values.ndim - 1))
+        averages[start:start + len(rows)] = powers * (previous + alpha * np.cumsum(rows / powers, axis=0))
+        previous = averages[start + len(rows) - 1]
+    return averages
+
+
+def _rolling(values, window, offset):
+    '''Sums and counts of the non-NaN values in a trailing window of rows
+       Inputs:
+          values - float64 array of shape L x N
+          window - number of rows in the window, at most offset + 1
+          offset - first row a sum is returned for
+       Returns:
+          tuple (sums, counts), arrays of shape (L - offset) x N
+    '''
+    present = ~np.isnan(values)
+    zero = np.zeros((1,) + values.shape[1:])
+    sums = np.concatenate([zero, np.cumsum(np.where(present, values, 0.0), axis=0)])
+    counts = np.concatenate([zero, np.cumsum(present, axis=0)])
+    end = slice(offset + 1, None)
+    start = slice(offset + 1 - window, len(values) + 1 - window)
+    return sums[end] - sums[start], counts[end] - counts[start]
+
+
+def _to_json(values):
+    '''Converts an array to a list RedisJSON accepts, NaN becomes null
+    '''
+    return [None if value != value else value for value in np.asarray(values).tolist()]
+
+
+def _from_json(values):
+    '''Converts a stored list back to float64, null becomes NaN
+    '''
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+class IndicatorEngine:
+    '''IndicatorEngine is a class that computes technical indicators (SMA, EMA, RSI, MACD,
+       Bollinger bands, ATR and rolling VWAP) from the stored aggregates. Many tickers are computed
+       together as the columns of one matrix, and the results are kept in Redis next to the bars
+       with the state needed to continue - the last closes of the rolling windows and the value of
+       every exponential average. Updates only read and compute the bars added since the state
+       was saved. The state is saved before the last bar, which is computed again on the next
+       update since BarStreamProcessor replaces it while it is still forming.
+       The exponential averages (EMA, MACD, and Wilder's smoothing for RSI and ATR) start from
+       the first value, and every indicator is NaN until it has seen enough bars
+    '''
+
+    def __init__(self, redis_store=None, sma=(20, 50), ema=(20,), rsi=14, macd=(12, 26, 9), bollinger=(20, 2.0),
+                 atr=14, vwap=20, batch_size=100):
+        '''Constructor
+           Inputs:
+              redis_store - RedisJSONStore used to read the bars and store the indicators, a new one is created if None
+              sma - periods of the simple moving averages of the close
+              ema - periods of the exponential moving averages of the close
+              rsi - period of the relative strength index, None to skip it
+              macd - (fast period, slow period, signal period), None to skip it
+              bollinger - (period, number of standard deviations), None to skip it
+              atr - period of the average true range, None to skip it
+              vwap - number of bars in the rolling volume weighted average price, None to skip it
+              batch_size - number of tickers computed and written together
+        '''
+        if redis_store is None:
+            redis_store = RedisJSONStore()
+
+        periods = list(sma) + list(ema) + [rsi, atr, vwap] + list(macd or ()) + ([bollinger[0]] if bollinger else [])
+        if any(period is not None and period < 1 for period in periods):
+            raise ValueError("indicator periods must be at least 1")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+
+        self.redis_store = redis_store
+        self.redis_connection = redis_store.redis_connection
+        self.batch_size = batch_size
+        # stored with the state, a state saved with other parameters is computed again from scratch
+        self.params = {"sma": list(sma), "ema": list(ema), "rsi": rsi, "macd": list(macd) if macd else None,
+                       "bollinger": list(bollinger) if bollinger else None, "atr": atr, "vwap": vwap}
+
+        # number of closes before the last bar kept in the state for the rolling windows
+        windows = list(sma) + ([bollinger[0]] if bollinger else []) + ([vwap] if vwap else [])
+        self.tail = max(windows, default=1) - 1
+
+        self.columns = ["sma_{}".format(period) for period in sma] + ["ema_{}".format(period) for period in ema]
+        if rsi:
+            self.columns.append("rsi_{}".format(rsi))
+        if macd:
+            self.columns += ["macd", "macd_signal", "macd_histogram"]
+        if bollinger:
+            self.columns += ["bollinger_middle", "bollinger_upper", "bollinger_lower"]
+        if atr:
+            self.columns.append("atr_{}".format(atr))
+        if vwap:
+            self.columns.append("vwap_{}".format(vwap))
+
+    def update(self, tickers, timespan="day", force=False):
+        '''Brings the stored indicators of many tickers up to date with their bars. Tickers whose
+           bars did not change since the last update are skipped, the others are computed from
+           their saved state, batch_size tickers at a time
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              timespan - timespan the bars were stored with
+              force - compute every ticker again from its first bar
+           Returns:
+              dict of ticker to number of bars computed, 0 for tickers already up to date or without bars
+        '''
+        tickers = list(tickers)
+        counts = {}
+        for start in range(0, len(tickers), self.batch_size):
+            counts.update(self._update_batch(tickers[start:start + self.batch_size], timespan, force))
+        return counts
+
+    def indicators(self, tickers, timespan="day", last=None):
+        '''Reads stored indicators
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              timespan - timespan the bars were stored with
+              last - number of most recent bars to return, None for every bar
+           Returns:
+              dict of ticker to dict of column name to array - date as int64 milliseconds and
+              every indicator as float64, NaN before it has seen enough bars. Tickers never
+              updated get an empty dict
+        '''
+        tickers = list(tickers)
+        stored = self.redis_store.get_many([indicator_key(ticker, timespan) for ticker in tickers], path='.columns')
+
+        results = {}
+        for ticker in tickers:
+            columns = stored[indicator_key(ticker, timespan)]
+            if columns is None:
+                results[ticker] = {}
+                continue
+            rows = slice(-last, None) if last else slice(None)
+            results[ticker] = {name: np.array(values[rows], dtype=np.int64) if name == "date" else _from_json(values[rows])
+                               for name, values in columns.items()}
+        return results
+
+    def compute(self, bars, states=None):
+        '''Computes the indicators of many tickers together, without touching Redis
+           Inputs:
+              bars - dict of ticker to AggregateBars in date order. A ticker with a state must start
+                 with the bar of timestamp state["last"], the one the state was saved before
+              states - dict of ticker to a state returned by an earlier call, tickers without one start from scratch
+           Returns:
+              dict of ticker to (dict of column name to array for every bar given, state to continue from)
+        '''
+        states = states or {}
+        tickers = [ticker for ticker in bars if len(bars[ticker])]
+        if not tickers:
+            return {}
+
+        with Metrics.timer("processing_seconds", step="indicators"):
+            results = self._compute(tickers, bars, [states.get(ticker) or self._empty_state() for ticker in tickers])
+        Metrics.increment("processing_items_total", sum(len(bars[ticker]) for ticker in tickers), step="indicators")
+        return results
+
+    def _compute(self, tickers, bars, states):
+        '''Computes a batch as T x N matrices, one column per ticker. Columns shorter than the
+           longest one are padded with NaN at the end, which never reaches their own rows
+        '''
+        params = self.params
+        count = len(tickers)
+        columns = np.arange(count)
+        lengths = np.array([len(bars[ticker]) for ticker in tickers])
+        rows = int(lengths.max())
+
+        def matrix(name):
+            values = np.full((rows, count), np.nan)
+            for column, ticker in enumerate(tickers):
+                values[:lengths[column], column] = bars[ticker].columns[name]
+            return values
+
+        def state_matrix(name):
+            return np.column_stack([_from_json(state[name]) for state in states]).reshape(self.tail, count)
+
+        def state_row(values):
+            return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+        close, high, low, volume, vwap = (matrix(name) for name in ("close", "high", "low", "volume", "vwap"))
+        # the bars before the first row - closes for the rolling windows, and the previous close
+        closes = np.vstack([state_matrix("close"), close])
+        price = np.where(np.isnan(vwap), (high + low + close) / 3.0, vwap)
+        price_volumes = np.vstack([state_matrix("price_volume"), price * volume])
+        volumes = np.vstack([state_matrix("volume"), volume])
+        previous_close = state_row([state["previous_close"] for state in states])
+        previous = np.vstack([previous_close, close[:-1]])
+        # number of bars seen up to every row
+        seen = np.array([state["count"] for state in states]) + np.arange(1, rows + 1)[:, None]
+
+        averages = {}
+
+        def average(name, values, alpha):
+            averages[name] = ewm(values, alpha, state_row([state["ewm"].get(name) for state in states]))
+            return averages[name]
+
+        output = {}
+        for period in params["sma"]:
+            sums, counts = _rolling(closes, period, self.tail)
+            output["sma_{}".format(period)] = np.where(counts == period, sums / period, np.nan)
+
+        for period in params["ema"]:
+            name = "ema_{}".format(period)
+            output[name] = np.where(seen >= period, average(name, close, 2.0 / (period + 1)), np.nan)
+
+        if params["rsi"]:
+            period = params["rsi"]
+            # the very first bar has no change
+            change = np.where(np.isnan(previous), 0.0, close - previous)
+            gain = average("rsi_gain", np.maximum(change, 0.0), 1.0 / period)
+            loss = average("rsi_loss", np.maximum(-change, 0.0), 1.0 / period)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rsi = np.where(gain + loss > 0, 100.0 * gain / (gain + loss), 50.0)
+            output["rsi_{}".format(period)] = np.where(seen > period, rsi, np.nan)
+
+        if params["macd"]:
+            fast, slow, signal = params["macd"]
+            line = average("macd_fast", close, 2.0 / (fast + 1)) - average("macd_slow", close, 2.0 / (slow + 1))
+            signal_line = average("macd_signal", line, 2.0 / (signal + 1))
+            output["macd"] = np.where(seen >= slow, line, np.nan)
+            output["macd_signal"] = np.where(seen >= slow + signal - 1, signal_line, np.nan)
+            output["macd_histogram"] = output["macd"] - output["macd_signal"]
+
+        if params["bollinger"]:
+            period, width = params["bollinger"]
+            # shift every column by its first close, so the sum of squares does not lose the variance to rounding
+            shifted = closes - close[0]
+            sums, counts = _rolling(shifted, period, self.tail)
+            squares, _ = _rolling(shifted * shifted, period, self.tail)
+            mean = sums / period
+            deviation = np.sqrt(np.maximum(squares / period - mean * mean, 0.0))
+            middle = np.where(counts == period, close[0] + mean, np.nan)
+            output["bollinger_middle"] = middle
+            output["bollinger_upper"] = middle + width * deviation
+            output["bollinger_lower"] = middle - width * deviation
+
+        if params["atr"]:
+            period = params["atr"]
+            # fmax ignores the NaN distances of the very first bar, leaving the high - low range
+            true_range = np.fmax(high - low, np.fmax(np.abs(high - previous), np.abs(low - previous)))
+            output["atr_{}".format(period)] = np.where(seen >= period, average("atr", true_range, 1.0 / period), np.nan)
+
+        if params["vwap"]:
+            period = params["vwap"]
+            weighted, counts = _rolling(price_volumes, period, self.tail)
+            total, _ = _rolling(volumes, period, self.tail)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                output["vwap_{}".format(period)] = np.where((counts == period) & (total > 0), weighted / total, np.nan)
+
+        # the state before the last bar of every column - row lengths - 1 once the old state is put in front
+        last_rows = lengths - 1
+        tail_rows = last_rows[None, :] + np.arange(self.tail)[:, None]
+        new_previous = np.vstack([previous_close, close])[last_rows, columns]
+        new_averages = {name: np.vstack([state_row([state["ewm"].get(name) for state in states]), stacked])[last_rows, columns]
+                        for name, stacked in averages.items()}
+        tails = {name: stacked[tail_rows, columns] for name, stacked in
+                 (("close", closes), ("price_volume", price_volumes), ("volume", volumes))}
+
+        results = {}
+        for column, ticker in enumerate(tickers):
+            length = lengths[column]
+            values = {"date": bars[ticker].timestamp}
+            values.update((name, output[name][:length, column]) for name in self.columns)
+            state = {
+                "params": params,
+                "last": int(bars[ticker].timestamp[-1]),
+                "count": int(states[column]["count"] + length - 1),
+                "previous_close": _to_json(new_previous[column:column + 1])[0],
+                "ewm": {name: _to_json(average_row[column:column + 1])[0] for name, average_row in new_averages.items()}
+                }
+            state.update((name, _to_json(tail[:, column])) for name, tail in tails.items())
+            results[ticker] = (values, state)
+        return results
+
+    def _empty_state(self):
+        '''State of a ticker without any bar
+        '''
+        empty = [None] * self.tail
+        return {"params": self.params, "last": None, "count": 0, "previous_close": None, "ewm": {},
+                "close": empty, "price_volume": empty, "volume": empty}
+
+    def _update_batch(self, tickers, timespan, force):
+        '''Updates one batch of tickers - one round trip for the states and versions, one for the
+           new bars, and one transaction writing every result. The indicator keys are watched, so
+           when another updater wrote one of them meanwhile the batch is read and computed again
+           instead of appending the same rows twice
+        '''
+        indicator_keys = [indicator_key(ticker, timespan) for ticker in tickers]
+        with self.redis_connection.pipeline(transaction=True) as transaction:
+            while True:
+                transaction.watch(*indicator_keys)
+                counts, writes = self._compute_batch(tickers, timespan, force)
+                if not writes:
+                    transaction.unwatch()
+                    return counts
+                transaction.multi()
+                for key, state, columns, replace in writes:
+                    self._queue_write(transaction, key, state, columns, replace)
+                try:
+                    transaction.execute()
+                    return counts
+                except redis.WatchError:
+                    continue
+
+    def _compute_batch(self, tickers, timespan, force):
+        '''Reads and computes one batch of tickers
+           Returns:
+              tuple (dict of ticker to number of rows written, list of (key, state, columns, replace) writes,
+              see _queue_write)
+        '''
+        aggregate_keys = [aggregate_key(ticker, timespan) for ticker in tickers]
+        pipeline = self.redis_connection.pipeline(transaction=False)
+        pipeline.json().mget([indicator_key(ticker, timespan) for ticker in tickers], '.state')
+        pipeline.mget([version_key(key) for key in aggregate_keys])
+        stored_states, versions = pipeline.execute()
+
+        counts = {}
+        states = {}
+        starts = {}
+        for ticker, state, version in zip(tickers, stored_states, versions):
+            if force or state is None or state.get("params") != self.params:
+                states[ticker], starts[ticker] = None, None
+            elif state.get("source_version") == int(version or 0):
+                counts[ticker] = 0
+            else:
+                states[ticker], starts[ticker] = state, state["count"]
+
+        loaded = self._read_bars(starts, timespan)
+        # history was rewritten or backfilled before the saved state, start over
+        restart = {ticker: None for ticker, (bars, version) in loaded.items()
+                   if states[ticker] is not None and (len(bars) == 0 or bars.timestamp[0] != states[ticker]["last"])}
+        if restart:
+            states.update(restart)
+            loaded.update(self._read_bars(restart, timespan))
+
+        results = self.compute({ticker: bars for ticker, (bars, version) in loaded.items()},
+                               {ticker: state for ticker, state in states.items() if state is not None})
+
+        writes = []
+        for ticker in loaded:
+            if ticker not in results:
+                counts[ticker] = 0
+                continue
+            values, state = results[ticker]
+            state["source_version"] = loaded[ticker][1]
+            columns = {name: _to_json(column) for name, column in values.items()}
+            writes.append((indicator_key(ticker, timespan), state, columns, states[ticker] is None))
+            counts[ticker] = len(values["date"])
+
+        return counts, writes
+
+    def _queue_write(self, pipeline, key, state, columns, replace):
+        '''Queues the write of new indicator rows
+           Inputs:
+              pipeline - transaction pipeline the commands are queued on
+              key - indicator key
+              state - state to store
+              columns - dict of column name to list of new values
+              replace - True to write the whole document, False to replace its last row and append the others
+        '''
+        if replace:
+            pipeline.json().set(key, '.', {"state": state, "columns": columns})
+        else:
+            for name, column in columns.items():
+                # the first bar is the last one stored, it may have changed while it was forming
+                pipeline.json().arrpop(key, '.columns.' + name)
+                pipeline.json().arrappend(key, '.columns.' + name, *column)
+            pipeline.json().set(key, '.state', state)
+        pipeline.incr(version_key(key))
+
+    def _read_bars(self, starts, timespan):
+        '''Reads the bars of many tickers with their versions in one transaction
+           Inputs:
+              starts - dict of ticker to index of the first bar to read, None for every bar
+              timespan - timespan the bars were stored with
+           Returns:
+              dict of ticker to (AggregateBars, version the bars were read at)
+        '''
+        if not starts:
+            return {}
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        for ticker, start in starts.items():
+            key = aggregate_key(ticker, timespan)
+            pipeline.exists(key + ':chunks')
+            pipeline.json().get(key, '.' if start is None else '$[{}:]'.format(start))
+            pipeline.get(version_key(key))
+        results = pipeline.execute()
+
+        loaded = {}
+        for index, ticker in enumerate(starts):
+            chunked, records, version = results[3 * index:3 * index + 3]
+            if chunked:
+                # backfilled bars are stored in chunks in front of the document, the start counts them too
+                key = aggregate_key(ticker, timespan)
+                records = self.redis_store.with_chunked(key, decode_json_document(self.redis_store.get(key)))
+                records = records[starts[ticker] or 0:]
+            loaded[ticker] = (AggregateBars.from_records(decode_json_document(records) or []), int(version or 0))
+        return loaded
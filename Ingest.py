@@ -0,0 +1,46 @@
+'''
+  Ingest-only entry point for scheduled (cron) runs. Runs the Data # stages of Assignment3 -
+  API to RedisJSON - and nothing else, so matplotlib, seaborn and pandas are never imported.
+  The exit status is 1 when a stage failed, for the scheduler to notice
+'''
+
+import argparse
+import sys
+import Metrics
+from Assignment3 import Assignment3, INGEST_STAGES
+from Pipeline import print_results
+
+
+def main(argv=None):
+    '''Command line entry point
+       Inputs:
+          argv - command line arguments, sys.argv if None
+       Returns:
+          exit status
+    '''
+    parser = argparse.ArgumentParser(description="Load stock data from polygon.io into Redis")
+    parser.add_argument("stages", nargs="*", help="stages to run (default: " + " ".join(INGEST_STAGES) + ")")
+    parser.add_argument("--force", action="store_true", help="run stages even when their output is still fresh")
+    parser.add_argument("--quiet", action="store_true", help="only print failed stages")
+    parser.add_argument("--metrics", action="store_true", help="record timings and print them at the end")
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.stages if name not in INGEST_STAGES]
+    if unknown:
+        parser.error("not an ingest stage: {}".format(", ".join(unknown)))
+
+    if args.metrics:
+        Metrics.enable()
+
+    results = Assignment3().build_pipeline().run(args.stages or INGEST_STAGES, force=args.force)
+    failed = {name: result for name, result in results.items() if result["status"] in ("failed", "blocked")}
+    print_results(failed if args.quiet else results)
+
+    if args.metrics:
+        print(Metrics.summary())
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
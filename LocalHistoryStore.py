@@ -0,0 +1,144 @@
+import datetime
+import os
+import numpy as np
+from AggregateBars import AggregateBars, COLUMNS
+
+
+def to_millis(value, end_of_day=False):
+    '''Converts a query bound to a timestamp in milliseconds
+       Inputs:
+          value - YYYY-MM-DD string, datetime.date, datetime.datetime or timestamp in milliseconds
+          end_of_day - for dates, return the last millisecond of the day instead of the first
+       Returns:
+          timestamp in milliseconds, or None if value is None
+    '''
+    if value is None:
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.date.fromisoformat(value)
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc)
+        if end_of_day:
+            value += datetime.timedelta(days=1) - datetime.timedelta(milliseconds=1)
+    elif value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return int(value.timestamp() * 1000)
+
+
+class LocalHistoryStore:
+    '''LocalHistoryStore is a class that keeps a local on-disk copy of the aggregates, one
+       directory per ticker and timespan holding one raw little-endian file per column.
+       Files are only ever appended to and are read through memory maps, so repeated analysis
+       runs on the same machine read history from the page cache without network or parsing
+    '''
+
+    def __init__(self, root="history"):
+        '''Constructor
+           Inputs:
+              root - directory holding the history files, created if missing
+        '''
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def append(self, ticker, timespan, bars):
+        '''Appends the bars newer than the last stored one. A bar with the timestamp of the last
+           stored one replaces it, since the last bar may have been partial when it was stored
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              bars - AggregateBars in date order
+           Returns:
+              number of bars appended, including a replaced last bar
+        '''
+        directory = self._directory(ticker, timespan)
+        os.makedirs(directory, exist_ok=True)
+
+        count = self._count(directory)
+        self._truncate(directory, count)
+
+        if count:
+            last = self._column(directory, "timestamp", np.dtype("<i8"), count)[-1]
+            bars = bars[bars.timestamp >= last]
+            if len(bars) and bars.timestamp[0] == last:
+                # the timestamp column is cut first, so a crash here leaves count - 1 complete bars
+                count -= 1
+                self._truncate(directory, count)
+        if len(bars) == 0:
+            return 0
+
+        # the timestamp column is written last, so a crash in between never exposes a partial bar
+        for name, dtype in COLUMNS[1:] + COLUMNS[:1]:
+            with open(os.path.join(directory, name + ".bin"), "ab") as file:
+                file.write(np.ascontiguousarray(bars.columns[name], dtype=dtype).tobytes())
+
+        return len(bars)
+
+    def query(self, ticker, timespan, from_=None, to=None):
+        '''Reads the bars between two dates, found by binary search on the timestamp column
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              from_ - first date to include (see to_millis), None for the first stored bar
+              to - last date to include (see to_millis), None for the last stored bar
+           Returns:
+              AggregateBars whose columns are read-only memory maps of the history files
+        '''
+        directory = self._directory(ticker, timespan)
+        count = self._count(directory)
+        if count == 0:
+            return AggregateBars.empty()
+
+        timestamps = self._column(directory, "timestamp", np.dtype("<i8"), count)
+        start = 0 if from_ is None else int(np.searchsorted(timestamps, to_millis(from_), side="left"))
+        stop = count if to is None else int(np.searchsorted(timestamps, to_millis(to, end_of_day=True), side="right"))
+
+        columns = {}
+        for name, dtype in COLUMNS:
+            columns[name] = self._column(directory, name, dtype, count)[start:stop]
+        return AggregateBars(columns)
+
+    def last_timestamp(self, ticker, timespan):
+        '''Returns:
+              timestamp in milliseconds of the last stored bar, or None if nothing is stored
+        '''
+        directory = self._directory(ticker, timespan)
+        count = self._count(directory)
+        if count == 0:
+            return None
+        return int(self._column(directory, "timestamp", np.dtype("<i8"), count)[-1])
+
+    def clear(self, ticker, timespan):
+        '''Drops the stored bars of a ticker and timespan
+        '''
+        directory = self._directory(ticker, timespan)
+        if os.path.isdir(directory):
+            self._truncate(directory, 0)
+
+    def _directory(self, ticker, timespan):
+        '''Builds the directory of a ticker and timespan
+        '''
+        return os.path.join(self.root, ticker.lower(), timespan)
+
+    def _count(self, directory):
+        '''Number of complete bars, taken from the size of the timestamp file
+        '''
+        path = os.path.join(directory, "timestamp.bin")
+        if not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // np.dtype("<i8").itemsize
+
+    def _column(self, directory, name, dtype, count):
+        '''Memory maps the first count values of a column file
+        '''
+        return np.memmap(os.path.join(directory, name + ".bin"), dtype=dtype, mode="r", shape=(count,))
+
+    def _truncate(self, directory, count):
+        '''Drops values past count left behind by an interrupted append
+        '''
+        for name, dtype in COLUMNS:
+            path = os.path.join(directory, name + ".bin")
+            if os.path.exists(path) and os.path.getsize(path) > count * dtype.itemsize:
+                with open(path, "r+b") as file:
+                    file.truncate(count * dtype.itemsize)
@@ -0,0 +1,116 @@
+import numpy as np
+
+# percent change definitions - (open column, close column, volume column)
+CHANGES = {
+    "prev_day": ("prev_day_open", "prev_day_close", "prev_day_volume"),
+    "intraday": ("day_open", "day_close", "day_volume")
+    }
+
+
+def columns_from_records(records):
+    '''Converts snapshot records as stored in RedisJSON (see PolygonIoAPIWrapper.snapshots) to the
+       flat columns returned by PolygonIoAPIWrapper.snapshot_columns and SnapshotSync.read
+       Inputs:
+          records - list of snapshot dicts
+       Returns:
+          dict of column name to list of values
+    '''
+    columns = {"ticker": [], "todays_change_percent": []}
+    for prefix in ("day", "prev_day"):
+        for field in ("open", "close", "volume"):
+            columns[prefix + "_" + field] = []
+
+    for record in records:
+        columns["ticker"].append(record.get("ticker"))
+        columns["todays_change_percent"].append(record.get("todays_change_percent"))
+        for prefix in ("day", "prev_day"):
+            # the stored records keep each day as a list holding one dict
+            day = (record.get(prefix) or [{}])[-1]
+            for field in ("open", "close", "volume"):
+                columns[prefix + "_" + field].append(day.get(field))
+    return columns
+
+
+def _float_column(columns, name):
+    '''Converts a column to a float64 array, None becomes NaN
+    '''
+    return np.array([np.nan if value is None else value for value in columns[name]], dtype=np.float64)
+
+
+def percent_changes(columns, by="prev_day"):
+    '''Computes the percent change of every ticker in one vectorized pass
+       Inputs:
+          columns - dict of column name to list of values (see columns_from_records)
+          by - prev_day (previous day's open to close) or intraday (today's open to close)
+       Returns:
+          dict of open, close, volume and percent_change float64 arrays, NaN where data is missing
+    '''
+    if by not in CHANGES:
+        raise ValueError("by must be one of {}".format(", ".join(CHANGES)))
+
+    open_column, close_column, volume_column = CHANGES[by]
+    opens = _float_column(columns, open_column)
+    closes = _float_column(columns, close_column)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change = np.where(opens != 0, (closes - opens) / opens * 100, np.nan)
+
+    return {
+        "open": opens,
+        "close": closes,
+        "volume": _float_column(columns, volume_column),
+        "percent_change": change
+        }
+
+
+def rank_movers(columns, k=20, by="prev_day", largest=True, min_volume=None, min_price=None,
+                sectors=None, sector_of=None):
+    '''Finds the biggest gainers (or losers) among any number of stored snapshots. The top k are
+       selected with a partition instead of a full sort, and nothing is printed or stored
+       Inputs:
+          columns - dict of column name to list of values (see columns_from_records)
+          k - number of tickers to return
+          by - prev_day or intraday (see percent_changes)
+          largest - True for the biggest gainers, False for the biggest losers
+          min_volume - only keep tickers that traded at least this volume
+          min_price - only keep tickers that closed at or above this price
+          sectors - only keep tickers in one of these sectors, requires sector_of
+          sector_of - dict of ticker to sector, snapshots do not carry sector data themselves
+       Returns:
+          list of dicts with ticker, open, close, volume and percent_change, best first
+    '''
+    changes = percent_changes(columns, by)
+    tickers = np.array(columns["ticker"], dtype=object)
+    change = changes["percent_change"]
+
+    keep = ~np.isnan(change)
+    if min_volume is not None:
+        keep &= changes["volume"] >= min_volume
+    if min_price is not None:
+        keep &= changes["close"] >= min_price
+    if sectors is not None:
+        if sector_of is None:
+            raise ValueError("sector_of is required to filter by sector")
+        sectors = set(sectors)
+        keep &= np.array([sector_of.get(ticker) in sectors for ticker in tickers], dtype=bool)
+
+    candidates = np.flatnonzero(keep)
+    if k <= 0 or len(candidates) == 0:
+        return []
+
+    # negate so the wanted end is always the smallest values
+    scores = -change[candidates] if largest else change[candidates]
+    if k < len(candidates):
+        candidates = candidates[np.argpartition(scores, k - 1)[:k]]
+        scores = -change[candidates] if largest else change[candidates]
+    candidates = candidates[np.argsort(scores, kind="stable")]
+
+    return [
+        {
+            "ticker": tickers[row],
+            "open": float(changes["open"][row]),
+            "close": float(changes["close"][row]),
+            "volume": float(changes["volume"][row]),
+            "percent_change": float(change[row])
+        }
+        for row in candidates
+        ]
@@ -0,0 +1,250 @@
+import bisect
+import contextlib
+import functools
+import http.server
+import threading
+import time
+import config
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# returned by timer() while metrics are disabled, so a disabled timer allocates nothing
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class MetricsRegistry:
+    '''MetricsRegistry is a class that holds counters and latency histograms keyed by name and
+       labels. Every recording function returns straight away while the registry is disabled,
+       so instrumented code costs one attribute check per call when metrics are off
+    '''
+
+    def __init__(self, enabled=False, buckets=LATENCY_BUCKETS):
+        '''Constructor
+           Inputs:
+              enabled - whether values are recorded
+              buckets - upper bounds in seconds of the histogram buckets, in increasing order
+        '''
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        '''Adds to a counter
+           Inputs:
+              name - counter name, such as redis_commands_total
+              value - amount added
+              labels - label names and values, such as command="JSON.SET"
+        '''
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        '''Records one latency in a histogram
+           Inputs:
+              name - histogram name, such as redis_command_seconds
+              seconds - measured latency
+              labels - label names and values
+        '''
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            histogram["counts"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def timer(self, name, **labels):
+        '''Times a with block into a histogram
+           Inputs:
+              name - histogram name
+              labels - label names and values
+           Returns:
+              context manager
+        '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def timed(self, name, **labels):
+        '''Decorator that times every call of a function into a histogram
+           Inputs:
+              name - histogram name
+              labels - label names and values
+        '''
+        def decorator(fn):
+            @functools.wraps(fn)
+            def timed_fn(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Timer(self, name, labels):
+                    return fn(*args, **kwargs)
+            return timed_fn
+        return decorator
+
+    def snapshot(self):
+        '''Reads every metric
+           Returns:
+              dict with the lists of counters (name, labels, value) and histograms (name, labels,
+              count, sum and the cumulative count of every bucket bound)
+        '''
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                buckets = []
+                for bound, count in zip(self.buckets + (float("inf"),), histogram["counts"]):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                histograms.append({"name": name, "labels": dict(labels), "count": histogram["count"],
+                                   "sum": histogram["sum"], "buckets": buckets})
+        return {"counters": counters, "histograms": histograms}
+
+    def reset(self):
+        '''Drops every recorded value
+        '''
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def prometheus_text(self):
+        '''Formats every metric in the Prometheus text exposition format
+           Returns:
+              string
+        '''
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+
+        for counter in snapshot["counters"]:
+            if counter["name"] not in typed:
+                lines.append("# TYPE {} counter".format(counter["name"]))
+                typed.add(counter["name"])
+            lines.append("{}{} {}".format(counter["name"], _labels(counter["labels"]), _number(counter["value"])))
+
+        for histogram in snapshot["histograms"]:
+            name = histogram["name"]
+            if name not in typed:
+                lines.append("# TYPE {} histogram".format(name))
+                typed.add(name)
+            for bound, count in histogram["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("{}_bucket{} {}".format(name, _labels(dict(histogram["labels"], le=le)), count))
+            lines.append("{}_sum{} {}".format(name, _labels(histogram["labels"]), repr(histogram["sum"])))
+            lines.append("{}_count{} {}".format(name, _labels(histogram["labels"]), histogram["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        '''Formats a short human readable table - count, total, mean and slowest bucket of every histogram,
+           then every counter
+           Returns:
+              string
+        '''
+        snapshot = self.snapshot()
+        lines = []
+        for histogram in snapshot["histograms"]:
+            name = histogram["name"] + _labels(histogram["labels"])
+            slowest = next(bound for bound, count in histogram["buckets"] if count == histogram["count"])
+            lines.append("{:<60}{:>8}{:>12.3f} s{:>10.2f} ms  <= {} s".format(
+                name, histogram["count"], histogram["sum"], 1000 * histogram["sum"] / max(1, histogram["count"]), slowest))
+        for counter in snapshot["counters"]:
+            lines.append("{:<60}{:>8}".format(counter["name"] + _labels(counter["labels"]), _number(counter["value"])))
+        return "\n".join(lines)
+
+    def serve(self, port=9464, address=""):
+        '''Serves the metrics in the Prometheus text format on /metrics from a background thread
+           Inputs:
+              port - TCP port to listen on
+              address - address to bind, every interface by default
+           Returns:
+              the ThreadingHTTPServer, call shutdown() on it to stop serving
+        '''
+        registry = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes every few seconds would flood the console
+                pass
+
+        httpd = http.server.ThreadingHTTPServer((address, port), handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+
+class _Timer:
+    '''Context manager recording the time spent in a with block
+    '''
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None:
+            self.registry.increment(self.name.replace("_seconds", "") + "_errors_total", **self.labels)
+        return False
+
+
+def _labels(labels):
+    '''Formats labels as {name="value",...}, empty without labels
+    '''
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in sorted(labels.items())) + "}"
+
+
+def _number(value):
+    '''Formats a counter value without a trailing .0 for whole numbers
+    '''
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# the process wide registry used by the instrumented modules, off unless config.py turns it on
+REGISTRY = MetricsRegistry(enabled=getattr(config, "MetricsEnabled", False))
+
+
+def enable(enabled=True):
+    '''Turns recording on or off for the process wide registry
+    '''
+    REGISTRY.enabled = enabled
+
+
+increment = REGISTRY.increment
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+timed = REGISTRY.timed
+snapshot = REGISTRY.snapshot
+reset = REGISTRY.reset
+prometheus_text = REGISTRY.prometheus_text
+summary = REGISTRY.summary
+serve = REGISTRY.serve
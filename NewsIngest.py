@@ -0,0 +1,189 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from db_config import get_redis_connection
+
+# set of the id of every stored article
+NEWS_IDS_KEY = 'news:ids'
+# articles are stored once, news:article:<id>
+NEWS_ARTICLE_KEY_PREFIX = 'news:article:'
+# sorted set of article ids per ticker, scored by publication time
+NEWS_TICKER_KEY_PREFIX = 'news:ticker:'
+# hash of ticker to the publication time in milliseconds of the newest article of the range that
+# is stored without gaps - reading stops there, and it only moves once a run reached it
+NEWS_COMPLETE_KEY = 'news:complete'
+
+
+def news_ticker_key(ticker):
+    '''Builds the key of the sorted set holding the articles of a ticker
+       Inputs:
+          ticker - string containing a stock's ticker symbol
+       Returns:
+          string containing the Redis key
+    '''
+    return NEWS_TICKER_KEY_PREFIX + ticker.lower()
+
+
+def _published_millis(published_utc):
+    '''Converts the RFC 3339 publication time of an article, such as 2024-02-29T14:05:00Z, to milliseconds
+    '''
+    published = datetime.datetime.fromisoformat(published_utc.replace("Z", "+00:00"))
+    return int(published.timestamp() * 1000)
+
+
+class NewsIngest:
+    '''NewsIngest is a class that stores news articles incrementally. Articles are read newest first
+       and reading stops at the first stored article at or before the newest article of the range
+       known to be complete, so polling a ticker with no news costs a single short page. That
+       marker only moves once a run reached it (or, for a new ticker, read all its articles or
+       max_articles of them), so an interrupted run is resumed instead of leaving a gap. Each article is stored once however many tickers it
+       mentions, and a sorted set per ticker makes "latest N articles" a range read
+    '''
+
+    def __init__(self, polygon_client, redis_connection=None, page_size=20, max_articles=1000):
+        '''Constructor
+           Inputs:
+              polygon_client - PolygonIoAPIWrapper used to download the news
+              redis_connection - Redis connection object, a new one is created from config.yaml if None
+              page_size - number of articles requested per page
+              max_articles - maximum number of articles read for a ticker seen for the first time
+        '''
+        if redis_connection is None:
+            redis_connection = get_redis_connection()
+
+        self.polygon_client = polygon_client
+        self.redis_connection = redis_connection
+        self.page_size = page_size
+        self.max_articles = max_articles
+        self._migrated = set()
+
+    def ingest(self, ticker):
+        '''Stores the articles of a ticker published since the last complete ingest
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+           Returns:
+              number of new articles for the ticker
+        '''
+        ticker_key = self._ticker_key(ticker)
+        complete = self.redis_connection.hget(NEWS_COMPLETE_KEY, ticker.lower())
+        complete = int(complete) if complete is not None else None
+        new_articles = 0
+        newest = None
+        page = []
+        done = False
+
+        for article in self.polygon_client.iter_news(ticker, page_size=self.page_size):
+            if newest is None:
+                newest = _published_millis(article["published_utc"])
+            page.append(article)
+            # check a whole page against Redis at once instead of one article at a time
+            if len(page) == self.page_size:
+                stored, done = self._store_page(ticker_key, page, complete)
+                new_articles += stored
+                page = []
+                if done:
+                    break
+                if new_articles >= self.max_articles:
+                    # a new ticker is complete down to max_articles, a known one still has a gap to fill
+                    done = complete is None
+                    break
+        else:
+            if page:
+                stored, done = self._store_page(ticker_key, page, complete)
+                new_articles += stored
+            # every article of the ticker was read
+            done = True
+
+        if done and newest is not None and (complete is None or newest > complete):
+            self.redis_connection.hset(NEWS_COMPLETE_KEY, ticker.lower(), newest)
+
+        return new_articles
+
+    def ingest_many(self, tickers, max_workers=8):
+        '''Ingests the news of many tickers at once on a bounded thread pool
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              max_workers - maximum number of tickers ingested at the same time
+           Returns:
+              tuple of two dicts keyed by ticker - (number of new articles, exception raised for that ticker)
+        '''
+        results = {}
+        errors = {}
+
+        if not tickers:
+            return results, errors
+
+        workers = max(1, min(max_workers, len(tickers)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for ticker in tickers:
+                futures[ticker] = executor.submit(self.ingest, ticker)
+
+            for ticker, future in futures.items():
+                try:
+                    results[ticker] = future.result()
+                except Exception as e:
+                    errors[ticker] = e
+
+        return results, errors
+
+    def latest(self, ticker, count=20):
+        '''Reads the most recent stored articles of a ticker
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              count - number of articles
+           Returns:
+              list of article dicts, newest first
+        '''
+        ids = self.redis_connection.zrevrange(self._ticker_key(ticker), 0, count - 1)
+        if not ids:
+            return []
+        articles = self.redis_connection.json().mget([NEWS_ARTICLE_KEY_PREFIX + article_id for article_id in ids], '.')
+        return [article for article in articles if article is not None]
+
+    def _ticker_key(self, ticker):
+        '''Returns news_ticker_key(ticker), the first time a ticker is seen the sorted set stored under
+           the upper-case key used before is merged into it
+        '''
+        ticker_key = news_ticker_key(ticker)
+        old_key = NEWS_TICKER_KEY_PREFIX + ticker.upper()
+        if ticker_key not in self._migrated and old_key != ticker_key:
+            if self.redis_connection.exists(old_key):
+                pipeline = self.redis_connection.pipeline(transaction=True)
+                pipeline.zunionstore(ticker_key, [ticker_key, old_key], aggregate="MAX")
+                pipeline.delete(old_key)
+                pipeline.execute()
+            self._migrated.add(ticker_key)
+        return ticker_key
+
+    def _store_page(self, ticker_key, page, complete):
+        '''Stores the articles of a page that are not stored for the ticker yet, up to the first stored
+           article published at or before complete
+           Returns:
+              tuple (number of new articles for the ticker, True if a stored article was reached)
+        '''
+        ids = [article["id"] for article in page]
+        pipeline = self.redis_connection.pipeline(transaction=False)
+        pipeline.zmscore(ticker_key, ids)
+        pipeline.smismember(NEWS_IDS_KEY, ids)
+        in_ticker, in_store = pipeline.execute()
+
+        pipeline = self.redis_connection.pipeline(transaction=False)
+        stored = 0
+        done = False
+        for article, ticker_score, known in zip(page, in_ticker, in_store):
+            published = _published_millis(article["published_utc"])
+            if ticker_score is not None:
+                if complete is not None and published <= complete:
+                    done = True
+                    break
+                # stored by a run that was interrupted before reaching the complete range
+                continue
+            if not known:
+                pipeline.json().set(NEWS_ARTICLE_KEY_PREFIX + article["id"], '.', article)
+                pipeline.sadd(NEWS_IDS_KEY, article["id"])
+            pipeline.zadd(ticker_key, {article["id"]: published})
+            stored += 1
+
+        if stored:
+            pipeline.execute()
+        return stored, done
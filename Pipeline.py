@@ -0,0 +1,169 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import Metrics
+
+# hash of stage name to the time it last finished successfully
+PIPELINE_STAGES_KEY = 'pipeline:stages'
+
+
+class Stage:
+    '''Stage is a class that describes one step of a Pipeline
+    '''
+
+    def __init__(self, name, run, depends=(), max_age=None, default=True, main_thread=False):
+        '''Constructor
+           Inputs:
+              name - unique name of the stage, used on the command line
+              run - function without arguments that does the work
+              depends - names of the stages that must finish before this one starts
+              max_age - seconds the output of the stage stays fresh, it is skipped while fresh.
+                 None to always run it
+              default - whether the stage runs when no stages are selected
+              main_thread - run the stage on the calling thread once no other stage is running,
+                 for work such as matplotlib windows or servers waiting for ctrl-c
+        '''
+        self.name = name
+        self.run = run
+        self.depends = tuple(depends)
+        self.max_age = max_age
+        self.default = default
+        self.main_thread = main_thread
+
+
+class Pipeline:
+    '''Pipeline is a class that runs stages with declared dependencies. Independent stages run
+       at the same time on a thread pool, so the total time is the critical path instead of the
+       sum of every stage. Stages whose output is still fresh are skipped and every stage is timed
+    '''
+
+    def __init__(self, redis_connection=None, max_workers=8):
+        '''Constructor
+           Inputs:
+              redis_connection - Redis connection used to remember when stages last finished,
+                 None to run every stage every time
+              max_workers - maximum number of stages running at the same time
+        '''
+        self.redis_connection = redis_connection
+        self.max_workers = max_workers
+        self.stages = {}
+
+    def add(self, stage):
+        '''Adds a stage, its dependencies must have been added before it
+           Inputs:
+              stage - Stage
+        '''
+        if stage.name in self.stages:
+            raise ValueError("duplicate stage {}".format(stage.name))
+        for dependency in stage.depends:
+            if dependency not in self.stages:
+                raise ValueError("stage {} depends on unknown stage {}".format(stage.name, dependency))
+        self.stages[stage.name] = stage
+
+    def run(self, selected=None, force=False):
+        '''Runs the selected stages and the stages they depend on
+           Inputs:
+              selected - names of the stages to run, every default stage if None
+              force - run stages even when their output is still fresh
+           Returns:
+              dict of stage name to dict with status (ran, fresh, failed or blocked), seconds and error
+        '''
+        if selected is None:
+            selected = [name for name, stage in self.stages.items() if stage.default]
+        names = self._with_dependencies(selected)
+        last_finished = self._last_finished(names)
+
+        results = {}
+        running = {}
+        main_ready = []
+        pending = list(names)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running or main_ready:
+                for name in list(pending):
+                    stage = self.stages[name]
+                    states = [results.get(dependency, {}).get("status") for dependency in stage.depends]
+                    if any(state in ("failed", "blocked") for state in states):
+                        results[name] = {"status": "blocked", "seconds": 0.0, "error": None}
+                        pending.remove(name)
+                    elif all(state in ("ran", "fresh") for state in states):
+                        pending.remove(name)
+                        if not force and self._fresh(stage, last_finished.get(name)):
+                            results[name] = {"status": "fresh", "seconds": 0.0, "error": None}
+                        elif stage.main_thread:
+                            main_ready.append(name)
+                        else:
+                            running[executor.submit(self._timed, stage)] = name
+
+                if not running:
+                    if main_ready:
+                        name = main_ready.pop(0)
+                        results[name] = self._timed(self.stages[name])
+                        self._finished(name, results[name])
+                    continue
+
+                done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    self._finished(name, results[name])
+
+        return results
+
+    def _finished(self, name, result):
+        '''Remembers when a stage finished successfully
+        '''
+        if result["status"] == "ran" and self.redis_connection is not None:
+            self.redis_connection.hset(PIPELINE_STAGES_KEY, name, time.time())
+
+    def _timed(self, stage):
+        '''Runs one stage and times it, errors are returned instead of raised
+        '''
+        start = time.perf_counter()
+        try:
+            stage.run()
+            result = {"status": "ran", "seconds": time.perf_counter() - start, "error": None}
+        except Exception as e:
+            result = {"status": "failed", "seconds": time.perf_counter() - start, "error": e}
+        Metrics.observe("pipeline_stage_seconds", result["seconds"], stage=stage.name, status=result["status"])
+        return result
+
+    def _with_dependencies(self, selected):
+        '''Adds every stage the selected stages depend on, in the order the stages were added
+        '''
+        needed = set()
+        todo = list(selected)
+        while todo:
+            name = todo.pop()
+            if name not in self.stages:
+                raise ValueError("unknown stage {}".format(name))
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].depends)
+        return [name for name in self.stages if name in needed]
+
+    def _last_finished(self, names):
+        '''Reads when the stages last finished successfully
+        '''
+        if self.redis_connection is None or not names:
+            return {}
+        values = self.redis_connection.hmget(PIPELINE_STAGES_KEY, names)
+        return {name: float(value) for name, value in zip(names, values) if value is not None}
+
+    def _fresh(self, stage, last_finished):
+        '''Decides whether the output of a stage is still fresh
+        '''
+        if stage.max_age is None or last_finished is None:
+            return False
+        return time.time() - last_finished < stage.max_age
+
+
+def print_results(results):
+    '''Prints one line per stage with its status and time
+       Inputs:
+          results - dict returned by Pipeline.run
+    '''
+    for name, result in results.items():
+        line = "{:<20}{:<10}{:>8.2f} s".format(name, result["status"], result["seconds"])
+        if result["error"] is not None:
+            line += "  " + repr(result["error"])
+        print(line)
@@ -4,44 +4,133 @@ from polygon.rest.models import TickerSnapshot
 from polygon.rest.models import Agg
 from polygon.rest.models import Exchange
 from polygon.rest.models import TickerNews
+from concurrent.futures import ThreadPoolExecutor
+from AggregateBars import AggregateBars
+from RequestScheduler import RequestScheduler, PRIORITY_SNAPSHOT, PRIORITY_BACKFILL
+import Metrics
+import contextlib
 import json
+import threading
+
+# flat snapshot columns - column name, snapshot attribute, attribute of that object (None for the snapshot itself)
+SNAPSHOT_COLUMNS = [
+    ("ticker", "ticker", None),
+    ("todays_change_percent", "todays_change_percent", None),
+    ("todays_change", "todays_change", None),
+    ("updated", "updated", None)
+    ] + [
+    (prefix + "_" + field, prefix, field)
+    for prefix in ("day", "prev_day")
+    for field in ("open", "high", "low", "close", "volume", "vwap")
+    ] + [
+    ("min_" + field, "min", field)
+    for field in ("accumulated_volume", "open", "high", "low", "close", "volume", "vwap", "timestamp", "transactions")
+    ]
 
 class PolygonIoAPIWrapper:
     '''PolygonIoAPIWrapper is a class that wraps around the polygon.io API
        It is primarily used to return data from most functions in JSON format
     '''
     
-    def __init__(self):
-        '''Constructor that reads in the API key from a config.py file
-           and stores the polygon.io RESTClient in the client member variable
+    def __init__(self, client=None, scheduler=None):
+        '''Constructor that reads in the API key from a config.py file. The polygon.io
+           RESTClient is created the first time the client member variable is used
+           Inputs:
+              client - object with the RESTClient interface, such as a local fake for testing.
+                 A RESTClient using the API key is created if None
+              scheduler - RequestScheduler pacing the requests. One sized to config.PolygonRequestsPerMinute
+                 is created if None, requests are not paced when that setting is missing
         '''
         
         # fill config.py with polygon.io API key
         self.polygon_io_key = config.PolygonKey
-        print(self.polygon_io_key)
         
-        # get the RESTCLient using my API key
-        self.client = RESTClient(api_key=self.polygon_io_key)
+        if scheduler is None:
+            requests_per_minute = getattr(config, "PolygonRequestsPerMinute", None)
+            if requests_per_minute:
+                scheduler = RequestScheduler(requests_per_minute)
+        self.scheduler = scheduler
+        
+        # the RESTClient is created on the first request, so building the wrapper costs nothing
+        self._client = client
+        self._client_ready = False
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        '''The polygon.io RESTClient (or the client passed to the constructor), with every request
+           timed and paced. It is set up on first use
+        '''
+        if not self._client_ready:
+            with self._client_lock:
+                if not self._client_ready:
+                    self._client = self._prepare_client(self._client)
+                    self._client_ready = True
+        return self._client
+
+    def _prepare_client(self, client):
+        '''Creates the RESTClient using my API key if no client was given, and wraps its requests
+        '''
+        if client is None:
+            # the scheduler retries 429s with backoff, the client's own immediate retries would only burn quota
+            client = RESTClient(api_key=self.polygon_io_key, retries=0 if self.scheduler else 3)
+
+        # every page of every call goes through the client's _get, so timing and pacing it covers everything.
+        # the timer sits inside the scheduler so it measures the request, not the wait for a token
+        client._get = Metrics.timed("polygon_page_seconds")(client._get)
+        if self.scheduler is not None:
+            client._get = self.scheduler.wrap(client._get)
+        return client
  
-    def json_aggregates(self, ticker, timespan, from_, to):
-        '''Aggregates are used to show data (opening, closing, high, low) for a specific stock over a specified period of time
+    def _priority(self, priority):
+        '''Sets the scheduler priority of the requests made inside a with block
+           Inputs:
+              priority - one of the PRIORITY_* values from RequestScheduler
+        '''
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.priority(priority)
+ 
+    def _iter_aggs(self, ticker, timespan, from_, to):
+        '''Generator over the Agg objects of list_aggs, fetched lazily at backfill priority
+        '''
+        aggs = self.client.list_aggs(ticker=ticker, multiplier=1, timespan=timespan, from_=from_, to=to)
+        while True:
+            # only set the priority while fetching, not while the caller holds the generator
+            with self._priority(PRIORITY_BACKFILL):
+                agg = next(aggs, None)
+            if agg is None:
+                break
+            yield agg
+
+    def aggregate_bars(self, ticker, timespan, from_, to):
+        '''Columnar version of aggregates, built straight from list_aggs without any per-bar dict
            Inputs:
               ticker - string containing a stock's ticker symbol
               timespan - string containing a timespan window (second, minute, hour, day, month)
               from_ - start time of the window in YYYY-MM-DD
               to - end time of the window in YYYY-MM-DD
            Returns:
-              aggregate data in JSON format
+              AggregateBars holding one NumPy array per field
         '''
-        # list aggregates as bars
-        aggs = []
-        for a in self.client.list_aggs(ticker=ticker, multiplier=1, timespan=timespan, from_=from_, to=to):
-            aggs.append(a)
-        #print(aggs)
-        
-        data = []
-        for agg in aggs:
-            new_record = {
+        with Metrics.timer("polygon_call_seconds", method="aggregate_bars"):
+            bars = AggregateBars.from_aggs(self._iter_aggs(ticker, timespan, from_, to))
+        Metrics.increment("polygon_items_total", len(bars), method="aggregate_bars")
+        return bars
+
+    def iter_aggregates(self, ticker, timespan, from_, to):
+        '''Generator version of aggregates that consumes list_aggs lazily, one bar at a time,
+           so only the current page of bars is held in memory however long the window is
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              from_ - start time of the window in YYYY-MM-DD
+              to - end time of the window in YYYY-MM-DD
+           Returns:
+              generator of aggregate data dicts, one per bar
+        '''
+        for agg in self._iter_aggs(ticker, timespan, from_, to):
+            yield {
                 "date": agg.timestamp,
                 "open": agg.open,
                 "high": agg.high,
@@ -51,52 +140,160 @@ class PolygonIoAPIWrapper:
                 "vwap": agg.vwap,
                 "transactions": agg.transactions
                 }
-            data.append(new_record)
 
-        values = [[v for k, v in d.items()] for d in data]
-        
-        json_aggs = json.dumps(data)
+    def aggregates(self, ticker, timespan, from_, to):
+        '''Aggregates are used to show data (opening, closing, high, low) for a specific stock over a specified period of time
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              from_ - start time of the window in YYYY-MM-DD
+              to - end time of the window in YYYY-MM-DD
+           Returns:
+              aggregate data as a list of dicts, ready to be stored as a native JSON array
+        '''
+        with Metrics.timer("polygon_call_seconds", method="aggregates"):
+            data = list(self.iter_aggregates(ticker, timespan, from_, to))
+        Metrics.increment("polygon_items_total", len(data), method="aggregates")
+        return data
+
+    def _serialize(self, what, data):
+        '''Converts data to JSON text, timing it and counting the bytes produced
+           Inputs:
+              what - name of the data used as the metric label, such as aggregates
+              data - JSON serializable value
+           Returns:
+              JSON text
+        '''
+        with Metrics.timer("serialize_seconds", what=what):
+            text = json.dumps(data)
+        Metrics.increment("serialized_bytes_total", len(text), what=what)
+        return text
+
+    def json_aggregates(self, ticker, timespan, from_, to):
+        '''Aggregates are used to show data (opening, closing, high, low) for a specific stock over a specified period of time
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              from_ - start time of the window in YYYY-MM-DD
+              to - end time of the window in YYYY-MM-DD
+           Returns:
+              aggregate data in JSON format
+        '''
+        json_aggs = self._serialize("aggregates", self.aggregates(ticker, timespan, from_, to))
         #print(json_aggs)
         
         return json_aggs
     
-    def json_snapshots(self, tickers):
+    def json_aggregates_many(self, tickers, timespan, from_, to, max_workers=8, native=False):
+        '''Fetches aggregates for many tickers at once on a bounded thread pool, so the total time
+           is close to the slowest ticker instead of the sum of every paginated list_aggs call
+           Inputs:
+              tickers - list of strings containing stock ticker symbols
+              timespan - string containing a timespan window (second, minute, hour, day, month)
+              from_ - start time of the window in YYYY-MM-DD
+              to - end time of the window in YYYY-MM-DD
+              max_workers - maximum number of requests in flight at the same time
+              native - if True return lists of dicts (see aggregates) instead of JSON strings
+           Returns:
+              tuple of two dicts keyed by ticker - (aggregate data, exception raised for that ticker)
+        '''
+        results = {}
+        errors = {}
+        
+        if not tickers:
+            return results, errors
+        
+        fetch = self.aggregates if native else self.json_aggregates
+        
+        # never start more threads than there are tickers
+        workers = max(1, min(max_workers, len(tickers)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for ticker in tickers:
+                futures[ticker] = executor.submit(fetch, ticker, timespan, from_, to)
+            
+            # one failing ticker must not lose the results of the others
+            for ticker, future in futures.items():
+                try:
+                    results[ticker] = future.result()
+                except Exception as e:
+                    errors[ticker] = e
+        
+        return results, errors
+    
+    def _snapshot_record(self, snap):
+        '''Converts a single TickerSnapshot into the dict stored in Redis
+           Inputs:
+              snap - TickerSnapshot returned by the polygon.io RESTClient
+           Returns:
+              snapshot data as a dict
+        '''
+        return {
+            "ticker": snap.ticker,
+            "todays_change_percent": snap.todays_change_percent,
+            "todays_change": snap.todays_change,
+            "updated": snap.updated,
+            "day": [
+                {"open": snap.day.open, "high": snap.day.high, "low": snap.day.low, "close": snap.day.close, "volume": snap.day.volume, "vwap": snap.day.vwap}
+            ],
+            "min": [
+                {"accumulated_volume": snap.min.accumulated_volume, "open": snap.min.open, "high": snap.min.high, "low": snap.min.low, "close": snap.min.close, "volume": snap.min.volume, "vwap": snap.min.vwap, "timestamp": snap.min.timestamp, "transactions": snap.min.transactions}
+            ],
+            "prev_day": [
+                {"open": snap.prev_day.open, "high": snap.prev_day.high, "low": snap.prev_day.low, "close": snap.prev_day.close, "volume": snap.prev_day.volume, "vwap": snap.prev_day.vwap}
+            ]
+            }
+
+    def snapshots(self, tickers):
         '''Snapshots show the latest 2-day span of data for a list of stocks, specified by their tickers
            Inputs:
               tickers - list of strings containing stock tickers
            Returns:
-              snapshot data for each stock in JSON format
+              snapshot data for each stock as a list of dicts
         '''       
         # how to get all tickers
         #snapshot = self.client.get_snapshot_all("stocks")
         
         # just get snapshot of the stocks from the input tickers
-        self.snapshot = self.client.get_snapshot_all("stocks", tickers)
-        print(self.snapshot)
+        with self._priority(PRIORITY_SNAPSHOT), Metrics.timer("polygon_call_seconds", method="snapshots"):
+            self.snapshot = self.client.get_snapshot_all("stocks", tickers)
         
-        data = []
-        for snap in self.snapshot:
-            new_record = {
-                "ticker": snap.ticker,
-                "todays_change_percent": snap.todays_change_percent,
-                "todays_change": snap.todays_change,
-                "updated": snap.updated,
-                "day": [
-                    {"open": snap.day.open, "high": snap.day.high, "low": snap.day.low, "close": snap.day.close, "volume": snap.day.volume, "vwap": snap.day.vwap}
-                ],
-                "min": [
-                    {"accumulated_volume": snap.min.accumulated_volume, "open": snap.min.open, "high": snap.min.high, "low": snap.min.low, "close": snap.min.close, "volume": snap.min.volume, "vwap": snap.min.vwap, "timestamp": snap.min.timestamp, "transactions": snap.min.transactions}
-                ],
-                "prev_day": [
-                    {"open": snap.prev_day.open, "high": snap.prev_day.high, "low": snap.prev_day.low, "close": snap.prev_day.close, "volume": snap.prev_day.volume, "vwap": snap.prev_day.vwap}
-                ]
-                }
-            data.append(new_record)
+        with Metrics.timer("convert_seconds", what="snapshots"):
+            data = [self._snapshot_record(snap) for snap in self.snapshot]
+        Metrics.increment("polygon_items_total", len(data), method="snapshots")
+
+        return data
 
-        values = [[v for k, v in d.items()] for d in data]
+    def snapshot_columns(self, tickers=None):
+        '''Snapshots converted column by column instead of one nested dict per ticker, which keeps
+           a full-market pull (about 11k tickers) cheap to convert
+           Inputs:
+              tickers - list of strings containing stock tickers, None for the whole market
+           Returns:
+              dict of column name (see SNAPSHOT_COLUMNS) to list of values, one per ticker
+        '''
+        with self._priority(PRIORITY_SNAPSHOT), Metrics.timer("polygon_call_seconds", method="snapshot_columns"):
+            snapshots = self.client.get_snapshot_all("stocks", tickers)
         
-        json_snap = json.dumps(data)
-        print(json_snap)
+        with Metrics.timer("convert_seconds", what="snapshot_columns"):
+            columns = {}
+            for name, attribute, field in SNAPSHOT_COLUMNS:
+                values = [getattr(snap, attribute, None) for snap in snapshots]
+                if field is not None:
+                    values = [getattr(value, field, None) for value in values]
+                columns[name] = values
+        Metrics.increment("polygon_items_total", len(snapshots), method="snapshot_columns")
+        return columns
+
+    def json_snapshots(self, tickers):
+        '''Snapshots show the latest 2-day span of data for a list of stocks, specified by their tickers
+           Inputs:
+              tickers - list of strings containing stock tickers
+           Returns:
+              snapshot data for each stock in JSON format
+        '''
+        json_snap = self._serialize("snapshots", self.snapshots(tickers))
+        #print(json_snap)
         return json_snap
         
     def snapshot_percent_change(self):
@@ -120,14 +317,13 @@ class PolygonIoAPIWrapper:
                                 percent_change)
                         )
 
-    def json_biggest_gainers(self):
+    def biggest_gainers(self):
         '''Snapshot data for today's 20 biggest gainers
-           Inputs:
-              tickers - list of strings containing stock tickers
            Returns:
-              snapshot data for each stock in JSON format
+              snapshot data for each stock as a list of dicts
         '''    
-        gainers = self.client.get_snapshot_direction("stocks", "gainers")
+        with self._priority(PRIORITY_SNAPSHOT), Metrics.timer("polygon_call_seconds", method="gainers"):
+            gainers = self.client.get_snapshot_direction("stocks", "gainers")
         #print(gainers)
         
         # print ticker with % change
@@ -139,40 +335,27 @@ class PolygonIoAPIWrapper:
         #            print("{:<15}{:.2f} %".format(gainer.ticker, gainer.todays_change_percent))
         #print()
         
-        data = []
-        for snap in gainers:
-            new_record = {
-                "ticker": snap.ticker,
-                "todays_change_percent": snap.todays_change_percent,
-                "todays_change": snap.todays_change,
-                "updated": snap.updated,
-                "day": [
-                    {"open": snap.day.open, "high": snap.day.high, "low": snap.day.low, "close": snap.day.close, "volume": snap.day.volume, "vwap": snap.day.vwap}
-                ],
-                "min": [
-                    {"accumulated_volume": snap.min.accumulated_volume, "open": snap.min.open, "high": snap.min.high, "low": snap.min.low, "close": snap.min.close, "volume": snap.min.volume, "vwap": snap.min.vwap, "timestamp": snap.min.timestamp, "transactions": snap.min.transactions}
-                ],
-                "prev_day": [
-                    {"open": snap.prev_day.open, "high": snap.prev_day.high, "low": snap.prev_day.low, "close": snap.prev_day.close, "volume": snap.prev_day.volume, "vwap": snap.prev_day.vwap}
-                ]
-                }
-            data.append(new_record)
+        data = [self._snapshot_record(snap) for snap in gainers]
 
-        values = [[v for k, v in d.items()] for d in data]
-        
-        json_snap = json.dumps(data)
+        return data
+
+    def json_biggest_gainers(self):
+        '''Snapshot data for today's 20 biggest gainers
+           Returns:
+              snapshot data for each stock in JSON format
+        '''
+        json_snap = self._serialize("gainers", self.biggest_gainers())
         #print(json_snap)
         
         return json_snap
 
-    def json_biggest_losers(self):
+    def biggest_losers(self):
         '''Snapshot data for today's 20 biggest losers
-           Inputs:
-              tickers - list of strings containing stock tickers
            Returns:
-              snapshot data for each stock in JSON format
+              snapshot data for each stock as a list of dicts
         '''    
-        losers = self.client.get_snapshot_direction("stocks", "losers")
+        with self._priority(PRIORITY_SNAPSHOT), Metrics.timer("polygon_call_seconds", method="losers"):
+            losers = self.client.get_snapshot_direction("stocks", "losers")
         #print(losers)
 
         # print ticker with % change
@@ -184,28 +367,16 @@ class PolygonIoAPIWrapper:
         #            print("{:<15}{:.2f} %".format(loser.ticker, loser.todays_change_percent))
         #print()
         
-        data = []
-        for snap in losers:
-            new_record = {
-                "ticker": snap.ticker,
-                "todays_change_percent": snap.todays_change_percent,
-                "todays_change": snap.todays_change,
-                "updated": snap.updated,
-                "day": [
-                    {"open": snap.day.open, "high": snap.day.high, "low": snap.day.low, "close": snap.day.close, "volume": snap.day.volume, "vwap": snap.day.vwap}
-                ],
-                "min": [
-                    {"accumulated_volume": snap.min.accumulated_volume, "open": snap.min.open, "high": snap.min.high, "low": snap.min.low, "close": snap.min.close, "volume": snap.min.volume, "vwap": snap.min.vwap, "timestamp": snap.min.timestamp, "transactions": snap.min.transactions}
-                ],
-                "prev_day": [
-                    {"open": snap.prev_day.open, "high": snap.prev_day.high, "low": snap.prev_day.low, "close": snap.prev_day.close, "volume": snap.prev_day.volume, "vwap": snap.prev_day.vwap}
-                ]
-                }
-            data.append(new_record)
+        data = [self._snapshot_record(snap) for snap in losers]
 
-        values = [[v for k, v in d.items()] for d in data]
-        
-        json_snap = json.dumps(data)
+        return data
+
+    def json_biggest_losers(self):
+        '''Snapshot data for today's 20 biggest losers
+           Returns:
+              snapshot data for each stock in JSON format
+        '''
+        json_snap = self._serialize("losers", self.biggest_losers())
         #print(json_snap)
         
         return json_snap
@@ -215,16 +386,18 @@ class PolygonIoAPIWrapper:
            Inputs:
               ticker - string containing a stock's ticker symbol
         '''     
-        snappy = self.client.get_snapshot_ticker("stocks", ticker=ticker)
+        with self._priority(PRIORITY_SNAPSHOT):
+            snappy = self.client.get_snapshot_ticker("stocks", ticker=ticker)
         print(snappy)
     
-    def json_exchanges(self):
+    def exchanges(self):
         '''List of all exchanges 
            Returns:
-              exchange data in JSON format
+              exchange data as a list of dicts
         '''      
-        exchanges = self.client.get_exchanges()
-        print(exchanges)
+        with Metrics.timer("polygon_call_seconds", method="exchanges"):
+            exchanges = self.client.get_exchanges()
+        #print(exchanges)
 
         # loop over exchanges
         #for exchange in exchanges:
@@ -240,6 +413,7 @@ class PolygonIoAPIWrapper:
         data = []
         for exchange in exchanges:
             new_record = {
+                "id": exchange.id,
                 "type": exchange.type,
                 "asset_class": exchange.asset_class,
                 "locale": exchange.locale,
@@ -252,13 +426,42 @@ class PolygonIoAPIWrapper:
                 }
             data.append(new_record)
 
-        values = [[v for k, v in d.items()] for d in data]
-        
-        json_ex = json.dumps(data)
+        return data
+
+    def json_exchanges(self):
+        '''List of all exchanges 
+           Returns:
+              exchange data in JSON format
+        '''
+        json_ex = self._serialize("exchanges", self.exchanges())
         #print(json_ex)
         
         return json_ex
                 
+    def conditions(self):
+        '''List all conditions that polygon.io uses
+           Returns:
+              condition data as a list of dicts
+        '''
+        data = []
+        with Metrics.timer("polygon_call_seconds", method="conditions"):
+            conditions = list(self.client.list_conditions(limit=1000))
+        for c in conditions:
+            new_record = {
+                "id": c.id,
+                "name": c.name,
+                "abbreviation": c.abbreviation,
+                "type": c.type,
+                "asset_class": c.asset_class,
+                "data_types": c.data_types,
+                "description": c.description,
+                "exchange": c.exchange,
+                "legacy": c.legacy
+                }
+            data.append(new_record)
+
+        return data
+
     def print_conditions(self):
         '''List all conditions that polygon.io uses
         '''
@@ -267,22 +470,40 @@ class PolygonIoAPIWrapper:
             conditions.append(c)
         print(conditions)
                 
-    def print_news(self, ticker):
-        '''Prints news articles for specific ticker sysmbol, with url and synposis, limiting to 1000 entries
-           In addition, prints the most recent 20 articles titles
+    def iter_news(self, ticker, page_size=50):
+        '''Generator over the news articles of a ticker, newest first. Pages of page_size articles
+           are only requested as the caller advances, so stopping early saves the remaining requests
+           Inputs:
+              ticker - string containing a stock's ticker symbol
+              page_size - number of articles requested per page
+           Returns:
+              generator of article dicts
         '''
-        news = []
-        for n in self.client.list_ticker_news(ticker, order="desc", limit=1000):
-            news.append(n)
-        #print(news)
-
-        # print date + title
-        for index, item in enumerate(news):
+        news = self.client.list_ticker_news(ticker, order="desc", sort="published_utc", limit=page_size)
+        for item in news:
             # verify this is news
-            if isinstance(item, TickerNews):
-                print("{:<25}{:<15}".format(item.published_utc, item.title))
+            if not isinstance(item, TickerNews):
+                continue
+            
+            yield {
+                "id": item.id,
+                "title": item.title,
+                "author": item.author,
+                "publisher": getattr(item.publisher, "name", None),
+                "published_utc": item.published_utc,
+                "article_url": item.article_url,
+                "description": item.description,
+                "tickers": item.tickers or [],
+                "keywords": item.keywords or []
+                }
+            Metrics.increment("polygon_items_total", method="news")
+
+    def print_news(self, ticker):
+        '''Prints the titles of the 21 most recent news articles for specific ticker sysmbol
+        '''
+        # print date + title, only the first page is downloaded
+        for index, item in enumerate(self.iter_news(ticker, page_size=21)):
+            print("{:<25}{:<15}".format(item["published_utc"], item["title"]))
 
             if index == 20:
                 break
-        
-    
\ No newline at end of file
@@ -0,0 +1,296 @@
+import datetime
+import json
+from db_config import get_redis_connection
+from AggregateBars import AggregateBars
+
+# every document written through the store has a counter version:<key>
+VERSION_KEY_PREFIX = 'version:'
+
+
+def aggregate_key(ticker, timespan="day"):
+    '''Builds the Redis key that holds the aggregates of a ticker. Daily bars keep the original
+       stocks:aggregate:<ticker> key, other timespans get the timespan appended
+       Inputs:
+          ticker - string containing a stock's ticker symbol
+          timespan - string containing a timespan window (second, minute, hour, day, month)
+       Returns:
+          string containing the Redis key
+    '''
+    key = 'stocks:aggregate:' + ticker.lower()
+    if timespan != "day":
+        key += ':' + timespan
+    return key
+
+
+def version_key(key):
+    '''Builds the key of the counter bumped every time a document is written, so readers that
+       cache a document can tell whether their copy is still current
+       Inputs:
+          key - string containing the Redis key of the document
+       Returns:
+          string containing the Redis key of the version counter
+    '''
+    return VERSION_KEY_PREFIX + key
+
+
+def chunk_id(timestamp, chunk="month"):
+    '''Names the chunk a bar belongs to when bars are stored in chunks
+       Inputs:
+          timestamp - bar timestamp in milliseconds
+          chunk - chunk size, either day or month
+       Returns:
+          string such as 2023-01 for month chunks or 2023-01-05 for day chunks
+    '''
+    date = datetime.datetime.fromtimestamp(timestamp / 1000, tz=datetime.timezone.utc)
+    if chunk == "day":
+        return date.strftime("%Y-%m-%d")
+    if chunk == "month":
+        return date.strftime("%Y-%m")
+    raise ValueError("chunk must be day or month")
+
+
+def decode_json_document(value):
+    '''Turns a value read from RedisJSON into Python objects. Native documents are returned
+       as they are, while older double-encoded documents (a JSON string holding JSON text) are parsed
+       Inputs:
+          value - value returned by a RedisJSON read, or the raw JSON text
+       Returns:
+          the decoded list or dict, or None if the value is None
+    '''
+    # a JSON string stored as a scalar can take up to two passes to unwrap
+    for _ in range(2):
+        if not isinstance(value, str):
+            break
+        value = json.loads(value)
+    return value
+
+
+class RedisJSONStore:
+    '''RedisJSONStore is a class that wraps around a Redis connection and groups
+       RedisJSON writes into pipelines and reads into JSON.MGET calls, so that storing
+       or loading many keys costs a handful of network round trips instead of one per key
+    '''
+
+    def __init__(self, redis_connection=None, batch_size=100):
+        '''Constructor that stores the Redis connection and the batch size
+           Inputs:
+              redis_connection - Redis connection object, a new one is created from config.yaml if None
+              batch_size - maximum number of keys sent to Redis in a single round trip
+        '''
+        if redis_connection is None:
+            redis_connection = get_redis_connection()
+
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+
+        self.redis_connection = redis_connection
+        self.batch_size = batch_size
+
+    def set(self, key, value, path='.'):
+        '''Stores a single JSON document
+           Inputs:
+              key - string containing the Redis key
+              value - JSON serializable value to store
+              path - JSON path to set, the root by default
+        '''
+        self.set_many({key: value}, path=path)
+
+    def get(self, key, path='.'):
+        '''Reads a single JSON document
+           Inputs:
+              key - string containing the Redis key
+              path - JSON path to read, the root by default. JSONPath expressions starting with $
+                 (for example $[*].close) return a list of every match
+           Returns:
+              the stored value, or None if the key does not exist
+        '''
+        return self.get_many([key], path=path)[key]
+
+    def set_many(self, items, path='.'):
+        '''Stores many JSON documents, sending at most batch_size JSON.SET commands per pipeline
+           Inputs:
+              items - dict of Redis key to JSON serializable value
+              path - JSON path to set in every document, the root by default
+        '''
+        pending = list(items.items())
+
+        for start in range(0, len(pending), self.batch_size):
+            # no MULTI/EXEC needed, the pipeline is only used to save round trips
+            pipeline = self.redis_connection.pipeline(transaction=False)
+            for key, value in pending[start:start + self.batch_size]:
+                pipeline.json().set(key, path, value)
+                pipeline.incr(version_key(key))
+            pipeline.execute()
+
+    def get_many(self, keys, path='.'):
+        '''Reads many JSON documents with one JSON.MGET per batch_size keys
+           Inputs:
+              keys - list of strings containing the Redis keys
+              path - JSON path to read from every document, the root by default
+           Returns:
+              dict of Redis key to stored value, None for keys that do not exist
+        '''
+        keys = list(keys)
+        results = {}
+
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            values = self.redis_connection.json().mget(batch, path)
+            for key, value in zip(batch, values):
+                results[key] = value
+
+        return results
+
+    def set_chunked(self, key, records, chunk="month", merge=False):
+        '''Stores a stream of bars as one JSON array per day or month, under <key>:<chunk id>.
+           Records are consumed lazily and each chunk is written as soon as it is complete, so
+           memory use stays flat no matter how many bars the stream holds. The chunk ids are kept
+           in the <key>:chunks sorted set, scored by the timestamp of their first bar
+           Inputs:
+              key - string containing the Redis key prefix, such as stocks:aggregate:lmt:minute
+              records - iterable of bar dicts in date order, such as PolygonIoAPIWrapper.iter_aggregates
+              chunk - chunk size, either day or month
+              merge - keep the bars already stored in a chunk at timestamps the records do not have,
+                 so a stream covering part of a chunk does not drop the rest of it
+           Returns:
+              number of bars written
+        '''
+        count = 0
+        current_id = None
+        current = []
+
+        for record in records:
+            record_id = chunk_id(record["date"], chunk)
+            if record_id != current_id and current:
+                # write each chunk as soon as it is complete, so at most one chunk is held in memory
+                self._write_chunk(key, current_id, current, merge)
+                current = []
+            current_id = record_id
+            current.append(record)
+            count += 1
+
+        if current:
+            self._write_chunk(key, current_id, current, merge)
+        if count:
+            self.redis_connection.incr(version_key(key))
+
+        return count
+
+    def iter_chunked(self, key, before=None):
+        '''Reads back bars stored with set_chunked in date order, loading batch_size chunks per round trip
+           Inputs:
+              key - string containing the Redis key prefix used with set_chunked
+              before - only read the bars with an earlier timestamp, every bar if None
+           Returns:
+              generator of bar dicts
+        '''
+        if before is None:
+            chunk_ids = self.redis_connection.zrange(key + ':chunks', 0, -1)
+        else:
+            chunk_ids = self.redis_connection.zrangebyscore(key + ':chunks', '-inf', '(' + str(before))
+
+        for start in range(0, len(chunk_ids), self.batch_size):
+            chunk_keys = [key + ':' + chunk for chunk in chunk_ids[start:start + self.batch_size]]
+            for chunk in self.redis_connection.json().mget(chunk_keys, '.'):
+                if not chunk:
+                    continue
+                if before is not None:
+                    chunk = [record for record in chunk if record["date"] < before]
+                yield from chunk
+
+    def get_chunked(self, key):
+        '''Reads every bar stored with set_chunked
+           Inputs:
+              key - string containing the Redis key prefix used with set_chunked
+           Returns:
+              list of bar dicts in date order, or None if nothing was stored under the prefix
+        '''
+        if not self.redis_connection.exists(key + ':chunks'):
+            return None
+        return list(self.iter_chunked(key))
+
+    def with_chunked(self, key, records):
+        '''Puts the bars backfilled in chunks (see set_chunked) in front of a stored document. Streaming
+           and syncing write a document under the key itself, the chunks keep the history before it
+           Inputs:
+              key - string containing the Redis key, such as stocks:aggregate:lmt:minute
+              records - decoded document stored under the key, a list of bar dicts, or None
+           Returns:
+              list of bar dicts in date order, the chunked bars older than the first bar of the
+              document followed by the document
+        '''
+        if not records:
+            return self.get_chunked(key) or []
+        older = list(self.iter_chunked(key, before=records[0]["date"]))
+        return older + records if older else records
+
+    def _write_chunk(self, key, chunk, records, merge=False):
+        '''Writes one chunk and its entry in the chunk index with one round trip
+        '''
+        if merge:
+            stored = decode_json_document(self.redis_connection.json().get(key + ':' + chunk)) or []
+            dates = {record["date"] for record in records}
+            kept = [record for record in stored if record["date"] not in dates]
+            if kept:
+                records = sorted(kept + records, key=lambda record: record["date"])
+        pipeline = self.redis_connection.pipeline(transaction=False)
+        pipeline.json().set(key + ':' + chunk, '.', records)
+        pipeline.zadd(key + ':chunks', {chunk: records[0]["date"]})
+        pipeline.execute()
+
+    def get_versions(self, keys):
+        '''Reads the version counters of many documents in one round trip
+           Inputs:
+              keys - list of strings containing the Redis keys of the documents
+           Returns:
+              dict of Redis key to version, 0 for documents that were never written through the store
+        '''
+        keys = list(keys)
+        if not keys:
+            return {}
+        versions = self.redis_connection.mget([version_key(key) for key in keys])
+        return {key: int(version or 0) for key, version in zip(keys, versions)}
+
+    def get_bars(self, key):
+        '''Reads a stored aggregate document into columnar form
+           Inputs:
+              key - string containing the Redis key, such as stocks:aggregate:lmt
+           Returns:
+              AggregateBars holding the bars, empty if the key does not exist. Bars backfilled
+              in chunks (see set_chunked) before the document are included, see with_chunked
+        '''
+        return AggregateBars.from_records(self.with_chunked(key, decode_json_document(self.get(key))))
+
+    def get_field(self, key, field):
+        '''Reads one field of every record in a native JSON array, such as the close of every bar,
+           without moving the rest of the document over the network
+           Inputs:
+              key - string containing the Redis key
+              field - name of the field to read from every record
+           Returns:
+              list with the field value of every record, empty if the key does not exist
+        '''
+        values = self.get(key, path='$[*].' + field)
+        return values if values is not None else []
+
+    def get_slice(self, key, start=None, stop=None):
+        '''Reads a slice of the records in a native JSON array, such as the last 30 bars, on the server side
+           Inputs:
+              key - string containing the Redis key
+              start - index of the first record, negative values count from the end
+              stop - index after the last record, None for the end of the array
+           Returns:
+              list of records in the slice, empty if the key does not exist
+        '''
+        path = '$[{}:{}]'.format('' if start is None else start, '' if stop is None else stop)
+        values = self.get(key, path=path)
+        return values if values is not None else []
+
+    def scan_keys(self, pattern):
+        '''Finds every key matching a pattern without blocking Redis the way KEYS does
+           Inputs:
+              pattern - glob style pattern such as stocks:aggregate:*
+           Returns:
+              list of matching keys
+        '''
+        return list(self.redis_connection.scan_iter(match=pattern, count=self.batch_size))
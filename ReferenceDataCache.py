@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from db_config import get_redis_connection
+
+# reference data is kept in Redis as reference:<name>
+REFERENCE_KEY_PREFIX = 'reference:'
+
+# refresh policies
+REFRESH_TTL = "ttl"        # download again once the data is older than max_age
+REFRESH_NEVER = "never"    # only download when no layer holds the data
+REFRESH_ALWAYS = "always"  # download on every load()
+
+
+class ReferenceDataCache:
+    '''ReferenceDataCache is a class that caches the exchanges and conditions reference data,
+       which almost never changes, in three layers: an in-process memo, Redis (with a TTL) and an
+       optional local JSON file. Every copy carries a version stamp (a hash of the data) and the
+       time it was downloaded. Lookups by id or MIC are dict lookups on the memo and never touch
+       the network once the data is loaded
+    '''
+
+    def __init__(self, polygon_client, redis_connection=None, path=None, policy=REFRESH_TTL, max_age=24 * 60 * 60):
+        '''Constructor
+           Inputs:
+              polygon_client - PolygonIoAPIWrapper used to download the data
+              redis_connection - Redis connection object, a new one is created from config.yaml if None
+              path - directory for the local file layer, None to disable it
+              policy - REFRESH_TTL, REFRESH_NEVER or REFRESH_ALWAYS
+              max_age - seconds before data is downloaded again with REFRESH_TTL, also the Redis TTL
+        '''
+        if policy not in (REFRESH_TTL, REFRESH_NEVER, REFRESH_ALWAYS):
+            raise ValueError("unknown refresh policy {}".format(policy))
+
+        if redis_connection is None:
+            redis_connection = get_redis_connection()
+
+        self.polygon_client = polygon_client
+        self.redis_connection = redis_connection
+        self.path = path
+        self.policy = policy
+        self.max_age = max_age
+
+        # name - (download function, fields every record is indexed by)
+        self._datasets = {
+            "exchanges": (polygon_client.exchanges, ("id", "mic", "operating_mic")),
+            "conditions": (polygon_client.conditions, ("id",))
+            }
+        self._memo = {}
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def load(self, name, force=False):
+        '''Makes sure the memo holds the data set, reading it from the first layer that has a
+           usable copy (memo, Redis, local file, polygon.io) and filling the layers above it
+           Inputs:
+              name - exchanges or conditions
+              force - download the data whatever the refresh policy
+           Returns:
+              dict with the version, fetched time and data (list of records)
+        '''
+        with self._lock:
+            entry = self._memo.get(name)
+            if entry is not None and not force and self._usable(entry):
+                return entry
+
+            entry = from_redis = from_file = None
+            if self.policy != REFRESH_ALWAYS and not force:
+                from_redis = self._read_redis(name)
+                entry = from_redis if from_redis is not None and self._usable(from_redis) else None
+                if entry is None:
+                    from_file = self._read_file(name)
+                    entry = from_file if from_file is not None and self._usable(from_file) else None
+
+            if entry is None:
+                download, fields = self._datasets[name]
+                entry = self._entry(download())
+
+            # write the copy back to the layers that did not have it
+            if from_redis is None or from_redis["version"] != entry["version"]:
+                self._write_redis(name, entry)
+            if self.path is not None and (from_file is None or from_file["version"] != entry["version"]):
+                self._write_file(name, entry)
+
+            self._memo[name] = entry
+            self._indexes[name] = self._index(name, entry["data"])
+            return entry
+
+    def refresh(self, name):
+        '''Downloads a data set again, whatever the policy
+           Inputs:
+              name - exchanges or conditions
+           Returns:
+              dict with the version, fetched time and data (list of records)
+        '''
+        return self.load(name, force=True)
+
+    def exchanges(self):
+        '''Returns:
+              list of exchange dicts (see PolygonIoAPIWrapper.exchanges)
+        '''
+        return self._data("exchanges")
+
+    def conditions(self):
+        '''Returns:
+              list of condition dicts (see PolygonIoAPIWrapper.conditions)
+        '''
+        return self._data("conditions")
+
+    def exchange_by_id(self, exchange_id):
+        '''Returns:
+              exchange dict, or None if there is no exchange with that id
+        '''
+        return self._lookup("exchanges", "id", exchange_id)
+
+    def exchange_by_mic(self, mic):
+        '''Looks up an exchange by MIC, falling back to the operating MIC
+           Returns:
+              exchange dict, or None if there is no exchange with that MIC
+        '''
+        return self._lookup("exchanges", "mic", mic) or self._lookup("exchanges", "operating_mic", mic)
+
+    def condition_by_id(self, condition_id):
+        '''Returns:
+              condition dict, or None if there is no condition with that id
+        '''
+        return self._lookup("conditions", "id", condition_id)
+
+    def _data(self, name):
+        '''Returns the memoized records of a data set, loading it the first time
+        '''
+        entry = self._memo.get(name)
+        if entry is None:
+            entry = self.load(name)
+        return entry["data"]
+
+    def _lookup(self, name, field, value):
+        '''Dict lookup in the index of a data set, loading it the first time
+        '''
+        indexes = self._indexes.get(name)
+        if indexes is None:
+            self.load(name)
+            indexes = self._indexes[name]
+        return indexes[field].get(value)
+
+    def _index(self, name, data):
+        '''Builds one dict per indexed field
+        '''
+        download, fields = self._datasets[name]
+        return {field: {record[field]: record for record in data if record.get(field) is not None} for field in fields}
+
+    def _usable(self, entry):
+        '''Decides whether a cached copy can be used under the refresh policy
+        '''
+        if self.policy == REFRESH_NEVER:
+            return True
+        if self.policy == REFRESH_ALWAYS:
+            return False
+        return time.time() - entry["fetched"] < self.max_age
+
+    def _entry(self, data):
+        '''Stamps freshly downloaded data with its version and download time
+        '''
+        version = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+        return {"version": version, "fetched": time.time(), "data": data}
+
+    def _read_redis(self, name):
+        '''Reads the Redis copy, None if there is none
+        '''
+        return self.redis_connection.json().get(REFERENCE_KEY_PREFIX + name)
+
+    def _write_redis(self, name, entry):
+        '''Replaces the Redis copy
+        '''
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        pipeline.json().set(REFERENCE_KEY_PREFIX + name, '.', entry)
+        if self.policy == REFRESH_TTL:
+            # let Redis drop copies nobody refreshes, they would be too old to use anyway
+            pipeline.expire(REFERENCE_KEY_PREFIX + name, int(self.max_age))
+        pipeline.execute()
+
+    def _file(self, name):
+        '''Builds the path of the local file copy
+        '''
+        return os.path.join(self.path, name + ".json")
+
+    def _read_file(self, name):
+        '''Reads the local file copy, None if there is none
+        '''
+        if self.path is None or not os.path.exists(self._file(name)):
+            return None
+        with open(self._file(name), "r") as file:
+            return json.load(file)
+
+    def _write_file(self, name, entry):
+        '''Replaces the local file copy
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        # write then rename so a reader never sees a half written file
+        temporary = self._file(name) + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(entry, file)
+        os.replace(temporary, self._file(name))
@@ -0,0 +1,193 @@
+import contextlib
+import heapq
+import itertools
+import random
+import threading
+import time
+
+# request priorities, lower values are sent first
+PRIORITY_SNAPSHOT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKFILL = 2
+
+def is_retryable(exc):
+    '''Decides whether a failed request should be retried, from the HTTP status attached to the
+       exception or from its urllib3 type. Anything else is not retried
+       Inputs:
+          exc - exception raised by the request
+       Returns:
+          True for 429 (too many requests) and 5xx (server error) statuses, and for urllib3
+          connection failures, timeouts and exhausted retries
+    '''
+    status = getattr(exc, "status", None) or getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status", None)
+    if status is not None:
+        try:
+            status = int(status)
+        except (TypeError, ValueError):
+            status = None
+    if status is not None:
+        return status == 429 or 500 <= status < 600
+
+    # urllib3 comes with the polygon.io client, which retries 429 and 5xx itself and raises MaxRetryError when it gives up
+    try:
+        from urllib3.exceptions import MaxRetryError, ProtocolError, TimeoutError
+    except ImportError:
+        return False
+    return isinstance(exc, (MaxRetryError, ProtocolError, TimeoutError))
+
+
+class RequestScheduler:
+    '''RequestScheduler is a class that paces requests to the polygon.io API.
+       A token bucket sized to the plan's limit decides when the next request may go out,
+       waiting requests are released by priority (snapshots before backfill), and requests
+       that fail with 429 or 5xx are retried with jittered exponential backoff
+    '''
+
+    def __init__(self, requests_per_minute, burst=None, max_retries=5, backoff_base=1.0, backoff_max=60.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        '''Constructor
+           Inputs:
+              requests_per_minute - request quota of the polygon.io plan
+              burst - number of requests that may be sent back to back, the per minute quota if None
+              max_retries - number of times a failed request is retried before the error is raised
+              backoff_base - backoff in seconds before the first retry, doubled for every retry
+              backoff_max - upper bound of the backoff in seconds
+              clock - function returning the current time in seconds, can be replaced in tests
+              sleep - function used to sleep during backoff, can be replaced in tests
+        '''
+        if requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive")
+
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst if burst is not None else requests_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self.sleep = sleep
+
+        self._tokens = self.capacity
+        self._last_refill = clock()
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._local = threading.local()
+
+        self._requests = 0
+        self._retries = 0
+        self._failures = 0
+        self._max_queue_depth = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    @contextlib.contextmanager
+    def priority(self, priority):
+        '''Context manager that sets the priority of every request made by the current thread
+           Inputs:
+              priority - one of PRIORITY_SNAPSHOT, PRIORITY_NORMAL or PRIORITY_BACKFILL
+        '''
+        previous = getattr(self._local, "priority", PRIORITY_NORMAL)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def acquire(self, priority=None):
+        '''Blocks until the request may be sent. Requests with a lower priority value are
+           released first, requests with the same priority are released in arrival order
+           Inputs:
+              priority - priority of the request, the one set with priority() if None
+           Returns:
+              seconds spent waiting
+        '''
+        if priority is None:
+            priority = getattr(self._local, "priority", PRIORITY_NORMAL)
+
+        start = self.clock()
+        with self._condition:
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._waiting))
+
+            while True:
+                timeout = None
+                if self._waiting[0] == entry:
+                    self._refill()
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        heapq.heappop(self._waiting)
+                        # let the next request in line check the bucket
+                        self._condition.notify_all()
+                        break
+                    timeout = (1 - self._tokens) / self.rate
+                self._condition.wait(timeout)
+
+            waited = self.clock() - start
+            self._requests += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+        return waited
+
+    def call(self, fn, *args, **kwargs):
+        '''Sends a request through the scheduler
+           Inputs:
+              fn - function that makes the request
+              args, kwargs - arguments passed to fn
+           Returns:
+              the value returned by fn
+        '''
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    with self._condition:
+                        self._failures += 1
+                    raise
+                with self._condition:
+                    self._retries += 1
+                # full jitter keeps many workers from retrying in lock step
+                backoff = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+                self.sleep(random.uniform(0, backoff))
+                attempt += 1
+
+    def wrap(self, fn):
+        '''Wraps a request function so that every call goes through the scheduler
+           Inputs:
+              fn - function that makes the request
+           Returns:
+              function with the same signature as fn
+        '''
+        def scheduled(*args, **kwargs):
+            return self.call(fn, *args, **kwargs)
+        return scheduled
+
+    def stats(self):
+        '''Queue and wait statistics
+           Returns:
+              dict with the number of requests, retries and failures, the current and maximum
+              queue depth and the average and maximum wait time in seconds
+        '''
+        with self._condition:
+            return {
+                "requests": self._requests,
+                "retries": self._retries,
+                "failures": self._failures,
+                "queue_depth": len(self._waiting),
+                "max_queue_depth": self._max_queue_depth,
+                "average_wait": self._total_wait / self._requests if self._requests else 0.0,
+                "max_wait": self._max_wait
+                }
+
+    def _refill(self):
+        '''Adds the tokens earned since the last refill, up to the bucket capacity
+        '''
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
@@ -0,0 +1,225 @@
+import json
+import re
+import redis
+from redis.commands.search.field import NumericField, TagField, TextField
+from redis.commands.search.query import Query
+from db_config import get_redis_connection
+from SnapshotSync import SNAPSHOT_KEY_PREFIX
+
+try:
+    from redis.commands.search.index_definition import IndexDefinition, IndexType
+except ImportError:
+    # redis-py before 5.1
+    from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+SNAPSHOTS_INDEX = 'idx:snapshots'
+MOVERS_INDEX = 'idx:movers'
+EXCHANGES_INDEX = 'idx:exchanges'
+
+# one JSON document per mover, stocks:movers:<gainers|losers>:<ticker>
+MOVERS_KEY_PREFIX = 'stocks:movers:'
+# one JSON document per exchange, exchange:<id>
+EXCHANGE_KEY_PREFIX = 'exchange:'
+
+_TAG_SPECIAL = re.compile(r"([^A-Za-z0-9_])")
+
+
+def escape_tag(value):
+    '''Escapes a value for use inside a RediSearch tag query, such as the dot in BRK.B
+       Inputs:
+          value - string to escape
+       Returns:
+          escaped string
+    '''
+    return _TAG_SPECIAL.sub(r"\\\1", str(value))
+
+
+def _range(field, minimum, maximum):
+    '''Builds a numeric range clause, empty if there are no bounds
+    '''
+    if minimum is None and maximum is None:
+        return ''
+    low = '-inf' if minimum is None else repr(float(minimum))
+    high = '+inf' if maximum is None else repr(float(maximum))
+    return '@{}:[{} {}] '.format(field, low, high)
+
+
+def _tags(field, values):
+    '''Builds a tag clause matching any of the values, empty if there are none
+    '''
+    if not values:
+        return ''
+    return '@{}:{{{}}} '.format(field, '|'.join(escape_tag(value) for value in values))
+
+
+class SearchIndexes:
+    '''SearchIndexes is a class that keeps RediSearch indexes over the snapshot hashes written by
+       SnapshotSync, one JSON document per biggest gainer/loser and one per exchange, so that
+       filtering and sorting run inside Redis and only the matching rows are returned
+    '''
+
+    def __init__(self, redis_connection=None):
+        '''Constructor
+           Inputs:
+              redis_connection - Redis connection object, a new one is created from config.yaml if None
+        '''
+        if redis_connection is None:
+            redis_connection = get_redis_connection()
+
+        self.redis_connection = redis_connection
+
+    def ensure_indexes(self):
+        '''Creates the indexes that do not exist yet. Existing documents with a matching prefix are
+           indexed by Redis in the background, later writes are indexed as they happen
+        '''
+        self._create(SNAPSHOTS_INDEX, IndexDefinition(prefix=[SNAPSHOT_KEY_PREFIX], index_type=IndexType.HASH), [
+            TagField("ticker"),
+            NumericField("todays_change_percent", sortable=True),
+            NumericField("todays_change"),
+            NumericField("day_close", sortable=True),
+            NumericField("day_volume", sortable=True),
+            NumericField("prev_day_close"),
+            NumericField("prev_day_volume", sortable=True)
+            ])
+        self._create(MOVERS_INDEX, IndexDefinition(prefix=[MOVERS_KEY_PREFIX], index_type=IndexType.JSON), [
+            TagField("$.ticker", as_name="ticker"),
+            TagField("$.direction", as_name="direction"),
+            NumericField("$.todays_change_percent", as_name="todays_change_percent", sortable=True),
+            NumericField("$.day[0].close", as_name="day_close", sortable=True),
+            NumericField("$.day[0].volume", as_name="day_volume", sortable=True)
+            ])
+        self._create(EXCHANGES_INDEX, IndexDefinition(prefix=[EXCHANGE_KEY_PREFIX], index_type=IndexType.JSON), [
+            TagField("$.mic", as_name="mic"),
+            TagField("$.operating_mic", as_name="operating_mic"),
+            TagField("$.asset_class", as_name="asset_class"),
+            TagField("$.locale", as_name="locale"),
+            TagField("$.type", as_name="type"),
+            TextField("$.name", as_name="name"),
+            TextField("$.acronym", as_name="acronym")
+            ])
+
+    def store_movers(self, direction, records):
+        '''Stores the biggest gainers or losers one document per ticker, replacing the previous list
+           Inputs:
+              direction - gainers or losers
+              records - list of snapshot dicts (see PolygonIoAPIWrapper.biggest_gainers)
+        '''
+        prefix = MOVERS_KEY_PREFIX + direction + ':'
+        old_keys = set(self.redis_connection.scan_iter(match=prefix + '*'))
+
+        pipeline = self.redis_connection.pipeline(transaction=True)
+        new_keys = set()
+        for record in records:
+            key = prefix + record["ticker"].lower()
+            new_keys.add(key)
+            pipeline.json().set(key, '.', dict(record, direction=direction))
+        stale = old_keys - new_keys
+        if stale:
+            pipeline.delete(*stale)
+        pipeline.execute()
+
+    def store_exchanges(self, records):
+        '''Stores every exchange as its own document
+           Inputs:
+              records - list of exchange dicts (see PolygonIoAPIWrapper.exchanges)
+        '''
+        pipeline = self.redis_connection.pipeline(transaction=False)
+        for index, record in enumerate(records):
+            exchange_id = record.get("id")
+            pipeline.json().set(EXCHANGE_KEY_PREFIX + str(exchange_id if exchange_id is not None else index), '.', record)
+        pipeline.execute()
+
+    def search_snapshots(self, min_change=None, max_change=None, min_volume=None, min_price=None, tickers=None,
+                         sort_by="todays_change_percent", ascending=False, limit=20):
+        '''Finds stored snapshots, for example the tickers that moved more than 5% on volume above 1M
+           Inputs:
+              min_change, max_change - bounds of today's percent change
+              min_volume - minimum volume traded today
+              min_price - minimum latest close of today
+              tickers - only search these tickers
+              sort_by - sortable field to order by (todays_change_percent, day_close, day_volume or prev_day_volume)
+              ascending - sort order
+              limit - maximum number of rows returned
+           Returns:
+              list of snapshot dicts with the hash fields as strings
+        '''
+        query = (_range("todays_change_percent", min_change, max_change)
+                 + _range("day_volume", min_volume, None)
+                 + _range("day_close", min_price, None)
+                 + _tags("ticker", tickers))
+        result = self._search(SNAPSHOTS_INDEX, query, sort_by, ascending, limit)
+        return [self._hash_fields(doc) for doc in result.docs]
+
+    def search_movers(self, direction=None, min_change=None, max_change=None, min_volume=None,
+                      sort_by="todays_change_percent", ascending=False, limit=20):
+        '''Finds stored gainers and losers
+           Inputs:
+              direction - gainers or losers, both if None
+              min_change, max_change - bounds of today's percent change
+              min_volume - minimum volume traded today
+              sort_by - sortable field to order by (todays_change_percent, day_close or day_volume)
+              ascending - sort order
+              limit - maximum number of rows returned
+           Returns:
+              list of snapshot dicts
+        '''
+        query = (_tags("direction", [direction] if direction else None)
+                 + _range("todays_change_percent", min_change, max_change)
+                 + _range("day_volume", min_volume, None))
+        result = self._search(MOVERS_INDEX, query, sort_by, ascending, limit)
+        return [json.loads(doc.json) for doc in result.docs]
+
+    def exchange_by_mic(self, mic):
+        '''Looks up an exchange by its MIC or operating MIC
+           Inputs:
+              mic - market identifier code, such as XNYS
+           Returns:
+              exchange dict, or None if there is none
+        '''
+        query = '({})|({})'.format(_tags("mic", [mic]).strip(), _tags("operating_mic", [mic]).strip())
+        result = self._search(EXCHANGES_INDEX, query, None, True, 1)
+        return json.loads(result.docs[0].json) if result.docs else None
+
+    def search_exchanges(self, text=None, asset_class=None, locale=None, limit=100):
+        '''Finds exchanges by name or acronym text and by asset class or locale
+           Inputs:
+              text - words to look for in the name or acronym
+              asset_class - such as stocks or options
+              locale - such as us
+              limit - maximum number of rows returned
+           Returns:
+              list of exchange dicts
+        '''
+        query = (_tags("asset_class", [asset_class] if asset_class else None)
+                 + _tags("locale", [locale] if locale else None))
+        words = re.findall(r"\w+", text or '')
+        # punctuation-only text has nothing to match on and an empty group is a syntax error
+        if words:
+            query += '(@name|acronym:({})) '.format(' '.join(words))
+        result = self._search(EXCHANGES_INDEX, query, None, True, limit)
+        return [json.loads(doc.json) for doc in result.docs]
+
+    def _create(self, name, definition, fields):
+        '''Creates an index unless it already exists
+        '''
+        try:
+            self.redis_connection.ft(name).info()
+            return
+        except redis.ResponseError:
+            pass
+        self.redis_connection.ft(name).create_index(fields, definition=definition)
+
+    def _search(self, index, query, sort_by, ascending, limit):
+        '''Runs a query, matching every document when there are no clauses
+        '''
+        query = Query(query.strip() or '*').paging(0, limit)
+        if sort_by is not None:
+            query = query.sort_by(sort_by, asc=ascending)
+        return self.redis_connection.ft(index).search(query)
+
+    def _hash_fields(self, doc):
+        '''Turns a search result over hashes into a plain dict
+        '''
+        fields = {key: value for key, value in doc.__dict__.items() if key not in ("id", "payload")}
+        fields["key"] = doc.id
+        return fields
@@ -0,0 +1,150 @@
+import hashlib
+from db_config import get_redis_connection
+from PolygonIoAPIWrapper import SNAPSHOT_COLUMNS
+
+# every ticker is kept in its own hash, stocks:snapshot:<ticker>. Nothing else may use this
+# prefix, the snapshot search index covers every key starting with it
+SNAPSHOT_KEY_PREFIX = 'stocks:snapshot:'
+# set of every ticker with a stored snapshot
+SNAPSHOT_TICKERS_KEY = 'stocks:snapshots:tickers'
+# hash of ticker to digest of the last written values
+SNAPSHOT_DIGESTS_KEY = 'stocks:snapshots:digests'
+
+# the update time changes on every poll, it is stored but does not count as a change
+_IGNORED_COLUMNS = ("ticker", "updated")
+
+# columns read back as int - the nanosecond update time does not fit in a float, and the counts are whole
+# numbers. Every other column except the ticker is a float
+_INT_COLUMNS = ("updated", "min_timestamp", "min_transactions", "day_volume", "prev_day_volume",
+                "min_accumulated_volume", "min_volume")
+
+
+def snapshot_key(ticker):
+    '''Builds the Redis key of the snapshot hash of a ticker
+       Inputs:
+          ticker - string containing a stock's ticker symbol
+       Returns:
+          string containing the Redis key
+    '''
+    return SNAPSHOT_KEY_PREFIX + ticker.lower()
+
+
+class SnapshotSync:
+    '''SnapshotSync is a class that polls snapshots for the whole market (or a list of tickers)
+       and stores each ticker in its own Redis hash. A digest of the values written for every
+       ticker is kept, and tickers whose values did not change since the last poll are not written
+       again, so polling every minute only writes what actually moved
+    '''
+
+    def __init__(self, polygon_client, redis_connection=None, batch_size=500):
+        '''Constructor
+           Inputs:
+              polygon_client - PolygonIoAPIWrapper used to download the snapshots
+              redis_connection - Redis connection object, a new one is created from config.yaml if None
+              batch_size - number of tickers written per pipeline
+        '''
+        if redis_connection is None:
+            redis_connection = get_redis_connection()
+
+        self.polygon_client = polygon_client
+        self.redis_connection = redis_connection
+        self.batch_size = batch_size
+        self._digests = None
+
+    def sync(self, tickers=None):
+        '''Downloads the snapshots and writes the tickers that changed
+           Inputs:
+              tickers - list of strings containing stock tickers, None for the whole market
+           Returns:
+              dict with the number of tickers received, written and skipped
+        '''
+        columns = self.polygon_client.snapshot_columns(tickers)
+        return self.store_columns(columns)
+
+    def store_columns(self, columns):
+        '''Writes the tickers of a column-wise snapshot (see PolygonIoAPIWrapper.snapshot_columns) that changed
+           Inputs:
+              columns - dict of column name to list of values
+           Returns:
+              dict with the number of tickers received, written and skipped
+        '''
+        if self._digests is None:
+            # first poll of this process - compare against what the previous process wrote
+            self._digests = self.redis_connection.hgetall(SNAPSHOT_DIGESTS_KEY)
+
+        names = [name for name, attribute, field in SNAPSHOT_COLUMNS]
+        compared = [name for name in names if name not in _IGNORED_COLUMNS]
+        tickers = columns["ticker"]
+
+        written = 0
+        skipped = 0
+        # digests of the queued tickers, only remembered once their pipeline ran
+        pending = {}
+        pipeline = self.redis_connection.pipeline(transaction=False)
+
+        for row, ticker in enumerate(tickers):
+            if ticker is None:
+                continue
+
+            digest = hashlib.blake2b(repr([columns[name][row] for name in compared]).encode(), digest_size=8).hexdigest()
+            if self._digests.get(ticker) == digest:
+                skipped += 1
+                continue
+
+            # Redis hashes can not hold None, missing values are simply left out
+            mapping = {name: columns[name][row] for name in names if columns[name][row] is not None}
+            key = snapshot_key(ticker)
+            pipeline.delete(key)
+            pipeline.hset(key, mapping=mapping)
+            pipeline.hset(SNAPSHOT_DIGESTS_KEY, ticker, digest)
+            pipeline.sadd(SNAPSHOT_TICKERS_KEY, ticker)
+            pending[ticker] = digest
+            written += 1
+
+            if len(pending) >= self.batch_size:
+                pipeline.execute()
+                self._digests.update(pending)
+                pending = {}
+
+        if pending:
+            pipeline.execute()
+            self._digests.update(pending)
+
+        return {"received": len(tickers), "written": written, "skipped": skipped}
+
+    def read(self, tickers=None):
+        '''Reads stored snapshots back column by column
+           Inputs:
+              tickers - list of strings containing stock tickers, every stored ticker if None
+           Returns:
+              dict of column name to list of values (ints for the columns in _INT_COLUMNS, floats
+              for the others, None when missing), one per ticker
+        '''
+        if tickers is None:
+            tickers = sorted(self.redis_connection.smembers(SNAPSHOT_TICKERS_KEY))
+
+        names = [name for name, attribute, field in SNAPSHOT_COLUMNS]
+        rows = []
+        for start in range(0, len(tickers), self.batch_size):
+            pipeline = self.redis_connection.pipeline(transaction=False)
+            for ticker in tickers[start:start + self.batch_size]:
+                pipeline.hmget(snapshot_key(ticker), names)
+            rows.extend(pipeline.execute())
+
+        columns = {}
+        for index, name in enumerate(names):
+            if name == "ticker":
+                columns[name] = list(tickers)
+            else:
+                convert = _int if name in _INT_COLUMNS else float
+                columns[name] = [convert(row[index]) if row[index] is not None else None for row in rows]
+        return columns
+
+
+def _int(value):
+    '''Parses an int stored by Redis, also when it was written as a float such as 1200.0
+    '''
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
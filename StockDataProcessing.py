@@ -1,11 +1,11 @@
 import datetime
 import http.server
-import socketserver
 import traceback
 import json
-import matplotlib.pyplot as plt
-import seaborn as sns 
-import pandas as pd
+from RedisJSONStore import decode_json_document
+from ChartServer import CHART_HTML, chart_values
+from MarketMovers import columns_from_records, percent_changes
+import Metrics
 
 class StockDataProcessing:
     '''StockDataProcessing is a class that contains the functions used
@@ -21,60 +21,24 @@ class StockDataProcessing:
            the data in a format expected by the Highcharts JavaScript library. 
            It creates a web server that serves an HTML page that includes a candlestick chart 
            of the json_data stock prices using Highcharts.The server listens on port 8887 and
-           exits gracefully when a KeyboardInterrupt is received.
+           exits gracefully when a KeyboardInterrupt is received. Use ChartServer to serve every
+           stored ticker from Redis instead of a single one.
            Inputs:
-              json_data - aggregate of a single stock over a timespan
+              json_data - aggregate of a single stock over a timespan, either a native JSON array or JSON text
         '''
         # Connect to http://localhost:8887 in your browser to view candlestick chart.
         PORT = 8887
 
         # https://www.highcharts.com/blog/products/stock/
         # JavaScript StockChart with Date-Time Axis
-        html = """
-        <!DOCTYPE HTML>
-        <html>
-        <head>
-
-        <style>
-        #container {
-            height: 750px;
-            min-width: 310px;
-        }
-        </style>
-
-        <script src="https://code.highcharts.com/stock/highstock.js"></script>
-        <script src="https://code.highcharts.com/stock/modules/data.js"></script>
-        <script src="https://code.highcharts.com/stock/modules/exporting.js"></script>
-        <script src="https://code.highcharts.com/stock/modules/accessibility.js"></script>
-
-        <div id="container"></div>
-
-        <script type="text/javascript">
-        Highcharts.getJSON('/data', function (data) {
-            // create the chart
-            Highcharts.stockChart('container', {
-                rangeSelector: {
-                    selected: 1
-                },
-
-                title: {
-                    text: 'Stock Price'
-                },
-
-                series: [{
-                    type: 'candlestick',
-                    name: 'Stock Price',
-                    data: data
-                }]
-            });
-        });
-        </script>
-        </head>
-        <body>
-        """
+        html = CHART_HTML.replace('%DATA_URL%', '/data').replace('%TITLE%', 'Stock Price')
         
-        data = json.loads(json.loads(json_data))
-        values = [[v for k, v in d.items()] for d in data]
+        with Metrics.timer("processing_seconds", step="chart_values"):
+            data = decode_json_document(json_data)
+            
+            # serialize once, not on every /data request
+            values = json.dumps(chart_values(data)).encode()
+        Metrics.increment("processing_items_total", len(data), step="chart_values")
 
         class handler(http.server.SimpleHTTPRequestHandler):
             def do_GET(self):
@@ -82,8 +46,7 @@ class StockDataProcessing:
                     self.send_response(200)
                     self.send_header("Content-type", "application/json")
                     self.end_headers()
-                    json_data = json.dumps(values)
-                    self.wfile.write(json_data.encode())
+                    self.wfile.write(values)
                 else:
                     self.send_response(200)
                     self.send_header("Content-type", "text/html")
@@ -93,8 +56,8 @@ class StockDataProcessing:
         # handle ctrl-c KeyboardInterrupt to exit the program gracefully
         try:
             while True:
-                # run http server
-                with socketserver.TCPServer(("", PORT), handler) as httpd:
+                # run http server, one thread per request so a slow client does not block the others
+                with http.server.ThreadingHTTPServer(("", PORT), handler) as httpd:
                     print("serving at port", PORT)
                     httpd.serve_forever()
                 pass
@@ -108,36 +71,44 @@ class StockDataProcessing:
               correlation_matrix - an NxN matrix where the values represent how correlated each row is to each column, 
                  with the diagonal filled in with 1s.
         '''
-        plt.figure(figsize=(8, 8))
-        ax = sns.heatmap(
-            correlation_matrix,
-            annot=True,
-            cmap="coolwarm",
-            vmin=-1,
-            vmax=1,
-            square=True,
-            linewidths=0.5,
-            cbar_kws={"shrink": 0.8})
-        ax.xaxis.tick_top()
-        ax.xaxis.set_label_position("top")
-        plt.title("Correlation Matrix Heatmap", y=1.08)
+        # plotting libraries take a long time to import, only load them when a chart is drawn
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
+        # only the drawing is timed, show() waits until the window is closed
+        with Metrics.timer("processing_seconds", step="correlation_heatmap"):
+            plt.figure(figsize=(8, 8))
+            ax = sns.heatmap(
+                correlation_matrix,
+                annot=True,
+                cmap="coolwarm",
+                vmin=-1,
+                vmax=1,
+                square=True,
+                linewidths=0.5,
+                cbar_kws={"shrink": 0.8})
+            ax.xaxis.tick_top()
+            ax.xaxis.set_label_position("top")
+            plt.title("Correlation Matrix Heatmap", y=1.08)
         plt.show()
         
     def snapshot_percent_change(self, json_data):
         '''Helper function that shows percent change using snapshot data - by ticker, the previous day's open and close values, with percent change
+           Use MarketMovers.rank_movers to rank the tickers instead of printing them
            Inputs:
-              json_data - snapshot data 
+              json_data - snapshot data, either a native JSON array or JSON text
+           Returns:
+              list of (ticker, open, close, percent change) tuples, in the order of the snapshot data
         '''     
-        data = json.loads(json.loads(json_data))
+        with Metrics.timer("processing_seconds", step="snapshot_percent_change"):
+            data = decode_json_document(json_data)
+            columns = columns_from_records(data)
+            changes = percent_changes(columns, by="prev_day")
+        Metrics.increment("processing_items_total", len(data), step="snapshot_percent_change")
         
         # create table with percent change for yesterday's market data
-        for item in data:
-            ticker = item.get('ticker')
-            prev_day = item.get('prev_day')
-            for day in prev_day:
-                prev_day_close = day.get('close')
-                prev_day_open = day.get('open')
-            percent_change = ((prev_day_close - prev_day_open) / prev_day_open * 100)
+        rows = list(zip(columns["ticker"], changes["open"].tolist(), changes["close"].tolist(), changes["percent_change"].tolist()))
+        for ticker, prev_day_open, prev_day_close, percent_change in rows:
             print(
                   "{:<15}{:<15}{:<15}{:.2f} %".format(
                       ticker,
@@ -146,4 +117,4 @@ class StockDataProcessing:
                       percent_change)
                  )
 
-        exit()
\ No newline at end of file
+        return rows
@@ -1,3 +1,9 @@
 #--------------------------------------------------------------------------------
 # Token needed for user authentication.
 PolygonKey = "XXXXXXXXXXXXXXXXXXX" #My polygon.io API Key
+
+# Request quota of the polygon.io plan, used to pace requests (free plan is 5 per minute).
+PolygonRequestsPerMinute = 5
+
+# Record timings and counters of API calls, Redis commands and processing steps (see Metrics.py).
+MetricsEnabled = False
@@ -1,32 +1,185 @@
+import os
+import threading
 import redis
-import yaml
+import redis.client
+import Metrics
 
+# seconds a pooled connection may sit idle before it is checked with PING on its next use
+HEALTH_CHECK_INTERVAL = 30
 
-def load_config():
+_config = None
+_pools = {}
+_clients = {}
+_lock = threading.Lock()
+
+
+def load_config(path=None):
     """Load configuration from the YAML file.
 
+    Args:
+        path (str): YAML file to read. Defaults to config.yaml in the current
+            directory, or next to this module when the current directory has none.
+
     Returns:
         dict: Configuration data.
     """
-    with open("config.yaml", "r") as file:
+    import yaml
+
+    if path is None:
+        path = "config.yaml"
+        if not os.path.exists(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yaml")
+    with open(path, "r") as file:
         return yaml.safe_load(file)
 
 
-config = load_config()
+def get_config():
+    """Return the configuration, reading config.yaml the first time it is needed.
+
+    Returns:
+        dict: Configuration data.
+    """
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                _config = load_config()
+    return _config
+
+
+def __getattr__(name):
+    # db_config.config used to be read at import time, keep it working without that cost
+    if name == "config":
+        return get_config()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def _size(value):
+    """Estimate the bytes of a command argument or reply.
+
+    Decoded replies, such as the lists and dicts RedisJSON reads return, are
+    measured recursively. Numbers count as their decimal digits, the way they
+    travel over the wire.
+
+    Args:
+        value: Argument or reply.
+
+    Returns:
+        int: Number of bytes.
+    """
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (list, tuple, set)):
+        return sum(_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_size(key) + _size(item) for key, item in value.items())
+    if isinstance(value, (int, float)):
+        return len(repr(value))
+    return 0
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client that records every command in Metrics.
+
+    Each command is timed into redis_command_seconds by command name, and the
+    bytes sent and received are counted. While metrics are disabled a command
+    costs one extra flag check.
+    """
+
+    def execute_command(self, *args, **options):
+        if not Metrics.REGISTRY.enabled:
+            return super().execute_command(*args, **options)
+
+        command = str(args[0]).upper()
+        with Metrics.timer("redis_command_seconds", command=command):
+            response = super().execute_command(*args, **options)
+        Metrics.increment("redis_sent_bytes_total", sum(_size(arg) for arg in args[1:]), command=command)
+        Metrics.increment("redis_received_bytes_total", _size(response), command=command)
+        return response
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """Pipeline that records each execute() in Metrics.
+
+    The round trip is timed into redis_pipeline_seconds. The queued commands are
+    counted by name, along with the bytes sent and received.
+    """
+
+    def execute(self, raise_on_error=True):
+        if not Metrics.REGISTRY.enabled:
+            return super().execute(raise_on_error)
+
+        sent = 0
+        for args, options in self.command_stack:
+            Metrics.increment("redis_pipelined_commands_total", command=str(args[0]).upper())
+            sent += sum(_size(arg) for arg in args[1:])
+        commands = len(self.command_stack)
+
+        with Metrics.timer("redis_pipeline_seconds"):
+            response = super().execute(raise_on_error)
+        Metrics.increment("redis_pipeline_commands_total", commands)
+        Metrics.increment("redis_sent_bytes_total", sent, command="PIPELINE")
+        Metrics.increment("redis_received_bytes_total", sum(_size(reply) for reply in response), command="PIPELINE")
+        return response
+
+
+def get_connection_pool(decode_responses=True):
+    """Return the process-wide connection pool, creating it on first use.
+
+    Connections are opened on demand, kept alive with TCP keepalive and
+    checked with PING after HEALTH_CHECK_INTERVAL idle seconds, so a stale
+    connection is replaced instead of failing a command. redis-py resets a
+    pool inherited through fork, so worker processes get their own connections.
+
+    Args:
+        decode_responses (bool): Return str instead of bytes. Pass False for
+            connections that read binary values.
+
+    Returns:
+        ConnectionPool: Pool shared by every connection of the process.
+    """
+    pool = _pools.get(decode_responses)
+    if pool is None:
+        settings = get_config()["redis"]
+        with _lock:
+            pool = _pools.get(decode_responses)
+            if pool is None:
+                pool = _pools[decode_responses] = redis.ConnectionPool(
+                    host=settings["host"],
+                    port=settings["port"],
+                    db=0,
+                    decode_responses=decode_responses,
+                    username=settings["user"],
+                    password=settings["password"],
+                    max_connections=settings.get("max_connections"),
+                    socket_keepalive=True,
+                    health_check_interval=HEALTH_CHECK_INTERVAL,
+                )
+    return pool
+
+
+def get_redis_connection(decode_responses=True):
+    """Return a Redis connection using the configuration.
 
+    The client is created once per process and uses the shared connection
+    pool, so calling this again is cheap and opens no new connection. Redis
+    clients are safe to share between threads.
 
-def get_redis_connection():
-    """Create a Redis connection using the configuration.
+    Args:
+        decode_responses (bool): Return str instead of bytes. Pass False for
+            connections that read binary values.
 
     Returns:
         Redis: Redis connection object.
     """
-    
-    return redis.Redis(
-        host=config["redis"]["host"],
-        port=config["redis"]["port"],
-        db=0,
-        decode_responses=True,
-        username=config["redis"]["user"],
-        password=config["redis"]["password"],
-    )
+    client = _clients.get(decode_responses)
+    if client is None:
+        pool = get_connection_pool(decode_responses)
+        with _lock:
+            client = _clients.get(decode_responses)
+            if client is None:
+                client = _clients[decode_responses] = InstrumentedRedis(connection_pool=pool)
+    return client